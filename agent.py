@@ -6,6 +6,7 @@ import os
 import sys
 import subprocess
 from dotenv import load_dotenv
+from services.control import request
 
 class AsyncProcessManager:
     """A non-blocking process manager for an asyncio application."""
@@ -48,6 +49,27 @@ class AsyncProcessManager:
         await self.start_generator()
         self.logger.info("--- Restart sequence complete ---")
 
+    async def reload_generator(self, config):
+        """Sends the new config to the running generator, which applies only what
+        changed. Falls back to a restart when the generator can't take it."""
+        if not self.process or self.process.returncode is not None:
+            await self.start_generator()
+            return
+
+        try:
+            answer = await asyncio.to_thread(request, {"command": "reload", "config": config})
+        except OSError as e:
+            self.logger.warning(f"Control channel unavailable ({e}), restarting the generator instead.")
+            await self.restart_generator()
+            return
+
+        if answer.get("status") != "ok":
+            self.logger.warning(f"Generator rejected the new config ({answer.get('error')}), restarting it instead.")
+            await self.restart_generator()
+            return
+
+        self.logger.info(f"Configuration applied without restart: {answer}")
+
 async def listen_config(manager, config_path):
     """Listens for new configs and manages the generator process."""
     while True:
@@ -66,8 +88,8 @@ async def listen_config(manager, config_path):
                         json.dump(data.get("config"), config_file, indent=4)
                     logging.info(f"Configuration file '{config_path}' successfully updated.")
                     
-                    # Restart the generator to apply the new config
-                    await manager.restart_generator()
+                    # Apply the new config to the running generator
+                    await manager.reload_generator(data.get("config"))
                     
                     # Send confirmation back to the server
                     await websocket.send(
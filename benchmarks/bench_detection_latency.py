@@ -0,0 +1,118 @@
+"""Measures threshold-crossing detection latency for the timer and event-driven modes.
+
+Readings are injected through MqttAdapter's message callback at random
+moments, alternating Voltagem across the MachineWorking/MachineStopped
+thresholds, and the latency is the time until the event reaches the sender.
+
+Both modes run what main.py runs with MQTT. The timer mode is a ScanScheduler
+reading the tags every ``--scan-rate`` seconds and evaluating what it read.
+The event mode evaluates on the generator's worker thread, notified from the
+message callback, at most once per ``--min-interval``. The intervals can be
+scaled down with ``--scale`` to keep the run short, latencies are then
+reported at production scale as well.
+
+    python -m benchmarks.bench_detection_latency --samples 40 --scale 0.1
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("OUTBOX_DB_PATH", os.path.join(tempfile.mkdtemp(), "outbox.db"))
+
+import paho.mqtt.client as mqtt
+
+from services.config_loader import ConfigLoader
+from services.data_reader import MqttAdapter
+from services.event_generator import EventGenerator
+from services.scan_scheduler import ScanScheduler
+
+
+class LatencySender():
+
+    def __init__(self):
+        self.injected_at = None
+        self.latencies = []
+        self.received = threading.Event()
+
+    def send_event(self, events):
+        if self.injected_at is not None:
+            self.latencies.append(time.perf_counter() - self.injected_at)
+            self.injected_at = None
+            self.received.set()
+
+    def close(self):
+        pass
+
+
+def _message(equipment, plc_address, value):
+    msg = mqtt.MQTTMessage(topic=f"/{equipment.name}/{plc_address}".encode())
+    msg.payload = str(value).encode()
+    return msg
+
+
+def run(mode, samples, scan_rate, min_interval):
+    equipments, _ = ConfigLoader().initialize()
+    equipment = equipments[0]
+    equipments = [equipment]
+
+    shutdown_event = threading.Event()
+    sender = LatencySender()
+    generator = EventGenerator(sender=sender, shutdown_event=shutdown_event, min_interval=min_interval, verbose=False)
+
+    if mode == "event":
+        adapter = MqttAdapter(equipments, on_reading=generator.on_reading)
+    else:
+        adapter = MqttAdapter(equipments)
+
+    for address, value in (("voltage", 10.0), ("good_pieces", 0), ("bad_pieces", 0)):
+        adapter._on_message_callback(None, None, _message(equipment, address, value))
+
+    if mode == "timer":
+        scheduler = ScanScheduler(equipments, adapter, shutdown_event, on_scan=generator.evaluate_equipments, default_rate=scan_rate)
+        threading.Thread(target=scheduler.run, daemon=True).start()
+
+    voltage = 10.0
+    for _ in range(samples):
+        # land anywhere within the scan/coalescing cycles
+        time.sleep(random.uniform(0, scan_rate if mode == "timer" else min_interval * 2))
+
+        voltage = 5.0 if voltage > 6.0 else 25.0
+        sender.received.clear()
+        sender.injected_at = time.perf_counter()
+        adapter._on_message_callback(None, None, _message(equipment, "voltage", voltage))
+
+        sender.received.wait(timeout=scan_rate + min_interval + 5)
+
+        # leave the equipment idle long enough for the next reading to be fresh
+        time.sleep(min_interval)
+
+    shutdown_event.set()
+    generator.shutdown()
+
+    return sender.latencies
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=40)
+    parser.add_argument("--scan-rate", type=float, default=1.0, help="timer mode scan rate (SCAN_RATE)")
+    parser.add_argument("--min-interval", type=float, default=0.5, help="event-driven coalescing interval")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier applied to every interval")
+    args = parser.parse_args()
+
+    for mode in ("timer", "event"):
+        latencies = run(mode, args.samples, args.scan_rate * args.scale, args.min_interval * args.scale)
+
+        p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+        line = f"{mode:<6} n={len(latencies):<4} p50={p50 * 1000:9.2f} ms  p99={p99 * 1000:9.2f} ms"
+        if mode == "timer" and args.scale != 1.0:
+            line += f"  (production scale: p50={p50 / args.scale:.2f} s  p99={p99 / args.scale:.2f} s)"
+        print(line)
@@ -0,0 +1,98 @@
+"""Measures the metrics overhead of the read path at 10k tags.
+
+"push" is the former update_prometheus_on_read: float() and a labels() lookup
+per tag. "collector" is what reading costs now (nothing beyond update_values)
+plus what TagValueCollector costs once per scrape.
+
+Both read paths are timed on the same readings, one cycle each in turn, and
+the overhead is the median of the per-cycle differences, which keeps drifts
+in machine load out of it.
+
+    python -m benchmarks.bench_metrics --equipments 1000 --tags 10 --cycles 20
+"""
+import argparse
+import random
+import statistics
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, generate_latest
+
+from decorator.metric_decorator import TagValueCollector
+from models.equipment import Equipment
+from services.rule_compiler import compile_native
+
+
+def build(count, tags):
+    config = {
+        'tags': [{'name': f"Tag{t}", 'type': 'float', 'plc_address': str(t)} for t in range(tags)],
+        'metadata': {},
+        'event_rules': [{'name': 'High', 'expression': 'Tag0 > 20', 'routing_key': '', 'output': None}],
+    }
+    compiled_rules = {'Tag0 > 20': compile_native('Tag0 > 20')}
+
+    return [Equipment(name=f"EQ{i}", ip="127.0.0.1", code=f"EQ{i}", config=config, compiled_rules=compiled_rules) for i in range(count)]
+
+
+def readings_for(equipments, rng):
+    return [(equipment, {tag['name'] : rng.uniform(0, 30) for tag in equipment.tags}) for equipment in equipments]
+
+
+def push_cycle(batch, gauge, counter):
+    for equipment, readings in batch:
+        equipment.update_values(readings)
+        for tag_name, value in readings.items():
+            gauge.labels(equipment=equipment.name, sensor=tag_name).set(float(value))
+            counter.inc()
+
+
+def collector_cycle(batch):
+    for equipment, readings in batch:
+        equipment.update_values(readings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--equipments", type=int, default=1000)
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--cycles", type=int, default=20)
+    args = parser.parse_args()
+
+    tags = args.equipments * args.tags
+
+    # a private registry, so the former metrics can be declared next to the current ones
+    push_registry = CollectorRegistry()
+    gauge = Gauge('plc_sensor_reading', 'Current value of a PLC sensor', ['equipment', 'sensor'], registry=push_registry)
+    counter = Counter('raw_data_events_total', 'Total number of PLC value readings', registry=push_registry)
+
+    equipments = {label : build(args.equipments, args.tags) for label in ("push", "collector")}
+    timings = {"push": [], "collector": []}
+    for cycle in range(args.cycles):
+        batches = {label : readings_for(equipments[label], random.Random(cycle)) for label in timings}
+        # alternate which one goes first, a warmer cache favours neither
+        for label in (("push", "collector") if cycle % 2 else ("collector", "push")):
+            start = time.perf_counter()
+            if label == "push":
+                push_cycle(batches[label], gauge, counter)
+            else:
+                collector_cycle(batches[label])
+            timings[label].append((time.perf_counter() - start) / tags)
+    overheads = [push - collector for push, collector in zip(timings["push"], timings["collector"])]
+
+    collector_registry = CollectorRegistry()
+    collector_registry.register(TagValueCollector(equipments["collector"]))
+
+    scrapes = {}
+    for label, registry in (("push", push_registry), ("collector", collector_registry)):
+        start = time.perf_counter()
+        for _ in range(args.cycles):
+            generate_latest(registry)
+        scrapes[label] = (time.perf_counter() - start) / args.cycles
+
+    print(f"{tags:,} tags, median of {args.cycles} cycles")
+    for label in ("push", "collector"):
+        per_reading = statistics.median(timings[label])
+        print(f"{label:<9}: {per_reading * 1e9:8.0f} ns/reading  {per_reading * tags * 1000:8.2f} ms/cycle  "
+              f"scrape {scrapes[label] * 1000:7.2f} ms")
+    overhead = statistics.median(overheads)
+    print(f"push costs {overhead * 1e9:.0f} ns/reading ({overhead * tags * 1000:.2f} ms/cycle) more than collector, "
+          f"per-cycle differences ranging {min(overheads) * 1e9:.0f}..{max(overheads) * 1e9:.0f} ns")
@@ -0,0 +1,93 @@
+"""Outbox insert throughput: per-event connections versus per-cycle batches.
+
+``legacy`` reproduces the original store_event path (new connection, WAL
+pragma and schema for every insert), ``single`` is one store_events call
+per event over the persistent connection, ``store_events`` writes each
+cycle in one transaction and ``claim_batch`` drains them as the relay does.
+
+    python -m benchmarks.bench_outbox --events 5000 --batch 50
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+os.environ["OUTBOX_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "outbox.db")
+
+from services import outbox
+
+
+def make_event(i):
+    payload = {
+        "event_name": "MachineWorking",
+        "timestamp": int(time.time()),
+        "metadata": {"plant": "Blumenau", "localization": "Packaging Area -> Canning Line 1"},
+        "data": {"PecasBoas": i},
+    }
+    return {
+        "event_name": "MachineWorking",
+        "routing_key": "machine_status",
+        "created_at": payload["timestamp"],
+        "content_type": "application/json",
+        "payload": payload,
+        "body": json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+    }
+
+
+def bench_legacy(events):
+    start = time.perf_counter()
+    for event in events:
+        conn = sqlite3.connect(outbox.DB_PATH, timeout=10, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            for statement in outbox._SCHEMA:
+                conn.execute(statement)
+            conn.execute(
+                "INSERT INTO outbox_events (event_name, payload, created_at) VALUES (?, ?, ?)",
+                (event["event_name"], json.dumps(event["payload"], ensure_ascii=False), event["created_at"]),
+            )
+        finally:
+            conn.close()
+    return len(events) / (time.perf_counter() - start)
+
+
+def bench_single(events):
+    start = time.perf_counter()
+    for event in events:
+        outbox.store_events([event])
+    return len(events) / (time.perf_counter() - start)
+
+
+def bench_batched(events, batch):
+    start = time.perf_counter()
+    for i in range(0, len(events), batch):
+        outbox.store_events(events[i:i + batch])
+    return len(events) / (time.perf_counter() - start)
+
+
+def bench_claim(batch):
+    claimed = 0
+    start = time.perf_counter()
+    while True:
+        events = outbox.claim_batch("bench", limit=batch)
+        if not events:
+            break
+        claimed += len(events)
+    return claimed / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=50, help="events per evaluation cycle")
+    args = parser.parse_args()
+
+    events = [make_event(i) for i in range(args.events)]
+    outbox.init_db()
+
+    print(f"legacy       : {bench_legacy(events):>12,.0f} inserts/sec")
+    print(f"single       : {bench_single(events):>12,.0f} inserts/sec")
+    print(f"store_events : {bench_batched(events, args.batch):>12,.0f} inserts/sec")
+    print(f"claim_batch  : {bench_claim(args.batch):>12,.0f} claims/sec")
@@ -0,0 +1,176 @@
+"""End-to-end throughput of the pipeline on a synthetic plant.
+
+Generates N equipments x M tags x R rules, steps every tag with a vectorized
+PLCDataReader-style simulator and runs each stage the way main.py does:
+
+- readings: values published per tag through MqttAdapter's callback (via an
+  in-process stand-in for the broker) and read back by the polling loop
+- evaluation: one timer cycle of EventGenerator over every equipment
+- outbox: each cycle's events stored in one transaction, then handed to the
+  dispatch pool publishing into a counting publisher and confirming them
+- relay: OutboxRelay draining a second outbox holding every event of the run,
+  into a counting publisher
+
+Prints a summary, or with --json one JSON object that can be diffed between
+commits, including peak RSS.
+
+    python -m benchmarks.bench_pipeline --equipments 1000 --tags 10 --rules 8 --cycles 10 --json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_directory = tempfile.mkdtemp()
+os.environ["OUTBOX_DB_PATH"] = os.path.join(_directory, "outbox.db")
+# the events the relay drains, stored pending as if the dispatch pool had failed
+RELAY_DB_PATH = os.path.join(_directory, "relay.db")
+
+from benchmarks.synthetic import CountingPublisher, LoopbackClient, PlantSimulator, Tally, make_config
+from services import outbox
+from services.config_loader import ConfigLoader
+from services.data_reader import MqttAdapter
+from services.event_dispatcher import EventDispatcher
+from services.event_generator import EventGenerator
+from services.outbox_relay import OutboxRelay
+
+
+def run(args):
+    config = make_config(args.equipments, args.tags, args.rules, seed=args.seed)
+    equipments = ConfigLoader().build(config)
+    simulator = PlantSimulator(args.equipments, args.tags, seed=args.seed)
+
+    adapter = MqttAdapter(equipments)
+    client = LoopbackClient(adapter)
+    adapter.connect(equipments)
+
+    tally = Tally()
+    shutdown_event = threading.Event()
+    dispatcher = EventDispatcher(CountingPublisher(tally), workers=args.dispatch_workers, max_queue_size=1000)
+    generator = EventGenerator(sender=dispatcher.sender, shutdown_event=shutdown_event, dispatcher=dispatcher)
+
+    addresses = [tag["plc_address"] for tag in equipments[0].tags]
+    topics = [[f"/{equipment.name}/{address}" for address in addresses] for equipment in equipments]
+
+    timings = {"readings": 0.0, "evaluation": 0.0, "outbox": 0.0}
+    counts = {"readings": 0, "evaluations": 0, "events": 0}
+    stored = []
+
+    for _ in range(args.cycles):
+        values = simulator.step_values()
+        # payload encoding is the PLC's job, it stays out of the timings
+        messages = [
+            [(topic, str(value).encode()) for topic, value in zip(equipment_topics, row)]
+            for equipment_topics, row in zip(topics, values.tolist())
+        ]
+
+        start = time.perf_counter()
+        for equipment_messages in messages:
+            for topic, payload in equipment_messages:
+                client.publish(topic, payload)
+        for equipment in equipments:
+            readings = adapter.read(equipment)
+            if readings:
+                equipment.update_values(readings)
+        timings["readings"] += time.perf_counter() - start
+        counts["readings"] += len(equipments) * len(addresses)
+
+        # rules reading a changed tag, whether the threshold index or the expression resolves them
+        counts["evaluations"] += sum(
+            sum(1 for rule in equipment.rules if rule['expression'].tags & equipment.dirty_tags) for equipment in equipments
+        )
+
+        start = time.perf_counter()
+        events = generator.evaluate(equipments)
+        timings["evaluation"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        generator.dispatch(events)
+        timings["outbox"] += time.perf_counter() - start
+        counts["events"] += len(events)
+        stored.extend(events)
+
+    dispatcher.shutdown()
+    stats = outbox.stats()
+    confirmed = stats['rows'].get('published', 0)
+
+    # the dispatch pool confirmed what it published, the relay drains the same
+    # events from an outbox of its own
+    with outbox.database(RELAY_DB_PATH):
+        outbox.store_events(stored)
+
+    relay_tally = Tally()
+    relay = OutboxRelay(sleep_interval=0.05, batch_size=args.relay_batch, workers=args.relay_workers,
+                        sender_factory=lambda: CountingPublisher(relay_tally), db_paths=[RELAY_DB_PATH])
+    relay_thread = threading.Thread(target=relay.start, daemon=True)
+
+    start = time.perf_counter()
+    relay_thread.start()
+    while relay_tally.events < counts["events"] and relay_thread.is_alive():
+        time.sleep(0.005)
+    drain = time.perf_counter() - start
+    relay.running = False
+    relay_thread.join()
+
+    return {
+        "params": {
+            "equipments": args.equipments, "tags": args.tags, "rules": args.rules, "cycles": args.cycles,
+            "dispatch_workers": args.dispatch_workers, "relay_workers": args.relay_workers, "relay_batch": args.relay_batch,
+        },
+        "readings_per_sec": counts["readings"] / timings["readings"],
+        "rule_evaluations_per_sec": counts["evaluations"] / timings["evaluation"],
+        "outbox_inserts_per_sec": counts["events"] / timings["outbox"] if timings["outbox"] else None,
+        "relay_drain_per_sec": relay_tally.events / drain if drain else None,
+        "events": counts["events"],
+        "dispatched_events": tally.events,
+        "dispatch_confirmed_events": confirmed,
+        "relayed_events": relay_tally.events,
+        # KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--equipments", type=int, default=1000)
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--rules", type=int, default=8)
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--dispatch-workers", type=int, default=4)
+    parser.add_argument("--relay-workers", type=int, default=1)
+    parser.add_argument("--relay-batch", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="print one JSON object instead of the summary")
+    args = parser.parse_args()
+
+    # the generator and the relay print every rule and batch, which would be measured too
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run(args)
+    result["revision"] = git_revision()
+    outbox.close()
+
+    if args.json:
+        json.dump(result, sys.stdout)
+        print()
+    else:
+        params = result["params"]
+        print(f"{params['equipments']} equipments x {params['tags']} tags x {params['rules']} rules, {params['cycles']} cycles ({result['events']} events)")
+        print(f"readings         : {result['readings_per_sec']:>14,.0f} /sec")
+        print(f"rule evaluations : {result['rule_evaluations_per_sec']:>14,.0f} /sec")
+        print(f"outbox inserts   : {result['outbox_inserts_per_sec'] or 0:>14,.0f} /sec")
+        print(f"relay drain      : {result['relay_drain_per_sec'] or 0:>14,.0f} /sec")
+        print(f"peak RSS         : {result['peak_rss_mb']:>14,.1f} MiB")
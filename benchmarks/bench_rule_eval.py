@@ -0,0 +1,76 @@
+"""Compares rule evaluations/sec of the native rule compiler against asteval.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_rule_eval --rules 2000 --cycles 20
+"""
+import argparse
+import random
+import time
+
+import asteval
+
+from services.rule_compiler import compile_native
+
+TAGS = ["Voltagem", "PecasBoas", "PecasRejeitadas", "Temperatura", "Pressao"]
+OPERATORS = [">", "<", ">=", "<=", "==", "!="]
+
+
+def make_expressions(count, seed=42):
+    rng = random.Random(seed)
+    expressions = []
+
+    for i in range(count):
+        left = f"{rng.choice(TAGS)} {rng.choice(OPERATORS)} {rng.uniform(0, 30):.2f}"
+        match i % 3:
+            case 0:
+                expressions.append(left)
+            case 1:
+                expressions.append(f"{left} and {rng.choice(TAGS)} > {rng.randint(0, 10)}")
+            case 2:
+                expressions.append(f"({rng.choice(TAGS)} - {rng.choice(TAGS)}) * 2 > {rng.randint(0, 10)} or not {left}")
+
+    return expressions
+
+
+def bench_asteval(expressions, symtable, cycles):
+    interpreter = asteval.Interpreter()
+    nodes = [interpreter.parse(expression) for expression in expressions]
+
+    start = time.perf_counter()
+    for _ in range(cycles):
+        # what EventGenerator did per equipment before running every rule
+        interpreter.symtable.update(symtable)
+        for node in nodes:
+            interpreter.run(node)
+
+    return len(nodes) * cycles / (time.perf_counter() - start)
+
+
+def bench_native(expressions, symtable, cycles):
+    rules = [compile_native(expression) for expression in expressions]
+
+    start = time.perf_counter()
+    for _ in range(cycles):
+        for rule in rules:
+            rule(symtable)
+
+    return len(rules) * cycles / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=2000)
+    parser.add_argument("--cycles", type=int, default=20)
+    args = parser.parse_args()
+
+    expressions = make_expressions(args.rules)
+    symtable = asteval.make_symbol_table()
+    symtable.update({tag: random.uniform(0, 30) for tag in TAGS})
+
+    interpreted = bench_asteval(expressions, symtable, args.cycles)
+    native = bench_native(expressions, {tag: symtable[tag] for tag in TAGS}, args.cycles)
+
+    print(f"asteval : {interpreted:>14,.0f} evaluations/sec")
+    print(f"native  : {native:>14,.0f} evaluations/sec")
+    print(f"speedup : {native / interpreted:>14.1f}x")
@@ -0,0 +1,85 @@
+"""Compares the threshold index against evaluating every threshold rule of a tag.
+
+One equipment with B alarm bands on one tag (``Tag > c`` and ``Tag < c`` pairs),
+fed a random walk. "expressions" evaluates every band on each change, like
+before the index; "index" resolves them with Equipment.flipped_rules.
+
+    python -m benchmarks.bench_thresholds --bands 10 100 1000 --steps 20000
+"""
+import argparse
+import random
+import time
+
+from models.equipment import Equipment
+from services.rule_compiler import compile_native
+
+
+def build(bands):
+    expressions = []
+    for b in range(bands):
+        threshold = round(30.0 * b / bands, 3)
+        expressions += [f"Tag > {threshold}", f"Tag < {threshold}"]
+
+    config = {
+        'tags': [{'name': 'Tag', 'type': 'float', 'plc_address': '0'}],
+        'metadata': {},
+        'event_rules': [{'name': f"Band{r}", 'expression': expression, 'routing_key': '', 'output': None} for r, expression in enumerate(expressions)],
+    }
+    compiled_rules = {expression : compile_native(expression) for expression in expressions}
+
+    return Equipment(name="EQ", ip="127.0.0.1", code="EQ", config=config, compiled_rules=compiled_rules)
+
+
+def walk(steps, seed=7):
+    rng = random.Random(seed)
+    value = 15.0
+    values = []
+    for _ in range(steps):
+        value = min(30.0, max(0.0, value + rng.uniform(-0.6, 0.6)))
+        values.append(value)
+    return values
+
+
+def expressions_cycle(equipment, values):
+    events = 0
+    for value in values:
+        equipment.update_values({'Tag': value})
+        equipment.pop_dirty()
+        for rule in equipment.rules:
+            triggered = rule['expression'](equipment.symtable)
+            if triggered and rule['state'] != triggered:
+                events += 1
+            rule['state'] = triggered
+    return events
+
+
+def index_cycle(equipment, values):
+    events = 0
+    for value in values:
+        equipment.update_values({'Tag': value})
+        dirty, _ = equipment.pop_dirty()
+        for rule, triggered in equipment.flipped_rules(dirty):
+            events += triggered
+            rule['state'] = triggered
+    return events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bands", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--steps", type=int, default=20000)
+    args = parser.parse_args()
+
+    values = walk(args.steps)
+
+    for bands in args.bands:
+        results = {}
+        for label, cycle in (("expressions", expressions_cycle), ("index", index_cycle)):
+            equipment = build(bands)
+            start = time.perf_counter()
+            events = cycle(equipment, values)
+            results[label] = (time.perf_counter() - start) / args.steps, events
+
+        print(f"{2 * bands:>6} rules on one tag: " + "  ".join(
+            f"{label} {elapsed * 1e6:9.2f} us/value ({events} events)" for label, (elapsed, events) in results.items()
+        ))
@@ -0,0 +1,137 @@
+"""Synthetic plant for the benchmarks: configs, a value simulator, an in-process
+MQTT client and a publisher that only counts.
+
+Nothing here talks to a broker, so results only depend on this process.
+"""
+import threading
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from services.event_publisher import MockEventPublisher
+
+# (type, low, high, step) of the value families PLCDataReader simulates
+_TAG_KINDS = (
+    ("float", 17.0, 26.0, 0.6),   # temperature
+    ("float", 1.95, 3.25, 0.3),   # pressure
+    ("float", 0.9, 1.5, 0.02),    # level
+    ("integer", 0, 3, 1),         # state
+)
+
+
+def make_config(equipments, tags, rules, seed=7):
+    """N equipments x M tags x R rules in the config.json format.
+
+    Every equipment shares the same tags and rules, like identical machines of
+    one line. Rules are thresholds on one tag, every fourth one a conjunction of
+    two tags, with thresholds inside each tag's range so they keep flipping.
+    """
+    rng = np.random.default_rng(seed)
+
+    tag_configs = []
+    for t in range(tags):
+        kind, low, high, _ = _TAG_KINDS[t % len(_TAG_KINDS)]
+        tag_configs.append({"name": f"Tag{t}", "type": kind, "plc_address": f"addr{t}"})
+
+    rule_configs = []
+    for r in range(rules):
+        a = r % tags
+        _, low, high, _ = _TAG_KINDS[a % len(_TAG_KINDS)]
+        threshold = round(float(rng.uniform(low, high)), 2)
+        expression = f"Tag{a} > {threshold}"
+
+        if r % 4 == 3 and tags > 1:
+            b = (r + 1) % tags
+            _, low_b, high_b, _ = _TAG_KINDS[b % len(_TAG_KINDS)]
+            expression += f" and Tag{b} < {round(float(rng.uniform(low_b, high_b)), 2)}"
+
+        rule_configs.append({
+            "name": f"Rule{r}",
+            "expression": expression,
+            "routing_key": f"rule_{r}",
+            "output": f"Tag{a}" if r % 2 else None,
+        })
+
+    return {
+        f"EQ{i:05d}": {
+            "ip": "127.0.0.1",
+            "code": f"EQ{i:05d}",
+            "metadata": {"plant": "Bench", "localization": f"Line {i % 10}"},
+            "tags": tag_configs,
+            "event_rules": rule_configs,
+        }
+        for i in range(equipments)
+    }
+
+
+class PlantSimulator():
+    """Vectorized PLCDataReader: one random walk step for every tag of every
+    equipment per call, as an (equipments, tags) array."""
+
+    def __init__(self, equipments, tags, seed=7):
+        self.rng = np.random.default_rng(seed)
+        kinds = [_TAG_KINDS[t % len(_TAG_KINDS)] for t in range(tags)]
+
+        self.low = np.array([kind[1] for kind in kinds])
+        self.high = np.array([kind[2] for kind in kinds])
+        self.step = np.array([kind[3] for kind in kinds])
+        self.integer = np.array([kind[0] == "integer" for kind in kinds])
+        self.values = self.rng.uniform(self.low, self.high, size=(equipments, tags))
+
+    def step_values(self):
+        noise = self.rng.uniform(-1.0, 1.0, size=self.values.shape) * self.step
+        self.values = np.clip(self.values + noise, self.low, self.high)
+        return np.where(self.integer, np.rint(self.values), np.round(self.values, 3))
+
+
+class LoopbackClient():
+    """Stands in for the paho client of MqttAdapter: publish() hands the message
+    to the adapter's callback on the calling thread."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        adapter._client = self
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def subscribe(self, topics):
+        pass
+
+    def unsubscribe(self, topics):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def publish(self, topic, payload):
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.adapter._on_message_callback(self, None, message)
+
+
+class Tally():
+    """Thread-safe event and batch count shared by CountingPublishers."""
+
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def add(self, events):
+        with self._lock:
+            self.events += events
+            self.batches += 1
+
+
+class CountingPublisher(MockEventPublisher):
+    """MockEventPublisher without the prints and sleeps, it only counts."""
+
+    def __init__(self, tally=None):
+        self.tally = tally or Tally()
+
+    def send_event(self, events):
+        self.tally.add(len(events))
+
+    def close(self):
+        pass
@@ -1,30 +1,64 @@
 from functools import wraps
-from prometheus_client import Gauge, Counter
+import os
+from prometheus_client import Gauge, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
-plc_sensor_readings = Gauge('plc_sensor_reading', 'Current value of a PLC sensor', ['equipment', 'sensor'])
-raw_data_events_counter = Counter('raw_data_events_total', 'Total number of PLC value readings')
+# multiprocess_mode only matters when the sharded runtime sets PROMETHEUS_MULTIPROC_DIR
 events_triggered_counter = Counter('events_triggered_total', 'Total number of events rule triggered')
+rule_events_counter = Counter('rule_events_total', 'Events triggered per rule', ['rule'])
 
-low_pressure_counter = Counter('low_pressure_total', 'low pressures total triggers')
-temp_out_counter = Counter('temp_out_total', 'temp out of bounds total triggers')
+dispatch_queue_depth = Gauge('event_dispatch_queue_depth', 'Event batches waiting for a dispatch worker', multiprocess_mode='livesum')
+dispatch_rejected_counter = Counter('event_dispatch_rejected_total', 'Events left to the outbox relay because the dispatch queue was full', ['policy'])
+# events a publisher sent after its lease on them had expired, so another one
+# took them over: "dispatch" is the direct-publish path, "relay" the outbox relay,
+# "late_confirm" a broker confirm arriving after the sender gave up on the event
+duplicate_publish_counter = Counter('outbox_duplicate_publishes_total', 'Events published by more than one publisher', ['path'])
 
-def update_prometheus_on_read(func):
-    
-    @wraps(func)
-    def wrapper(self, equipment, *args, **kwargs):
-        readings = func(self, equipment, *args, **kwargs)
-
-        if readings:
-            for tag_name, value in readings.items():
-                try:
-                    numeric_value = float(value)
-                    plc_sensor_readings.labels(equipment=equipment.name, sensor=tag_name).set(numeric_value)
-                    raw_data_events_counter.inc()
-                except (ValueError, TypeError):
-                    pass
-        
-        return readings
-    return wrapper
+# Latency of each stage between a PLC value arriving and its event being published:
+#   callback_to_read   MQTT callback -> value picked up by the polling loop (timer mode)
+#   read_to_evaluate   value stored in the equipment -> its rules evaluated
+#   evaluate           evaluating one equipment (one rule group with the columnar engine)
+#   outbox_insert      storing one cycle's events
+#   queue_wait         events waiting for a dispatch worker
+#   publish            publish round-trip of one batch, confirms included
+#   read_to_publish    value stored in the equipment -> its event confirmed by the broker
+#   relay_publish      publish round-trip of one batch sent by the outbox relay
+STAGES = ('callback_to_read', 'read_to_evaluate', 'evaluate', 'outbox_insert', 'queue_wait', 'publish', 'read_to_publish', 'relay_publish')
+pipeline_stage_seconds = Histogram(
+    'pipeline_stage_seconds', 'Time spent in each stage of the event pipeline', ['stage'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+stage_latency = {stage : pipeline_stage_seconds.labels(stage=stage) for stage in STAGES}
+
+# only observed when rule timing is enabled, timing a native rule costs more than running it
+rule_evaluation_seconds = Histogram(
+    'rule_evaluation_seconds', 'Time spent evaluating one rule', ['rule'],
+    buckets=(.000001, .0000025, .000005, .00001, .000025, .00005, .0001, .00025, .0005, .001, .01),
+)
+
+outbox_event_age_seconds = Histogram(
+    'outbox_event_age_seconds', 'Age of the events claimed by the outbox relay',
+    buckets=(1, 5, 15, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600),
+)
+
+# how late ScanScheduler runs a scan after it was due, and the scans it skipped
+# after falling more than a whole period behind
+scheduler_lag_seconds = Histogram(
+    'scheduler_lag_seconds', 'Delay between a scan being due and the scheduler running it',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+scheduler_skipped_scans_counter = Counter('scheduler_skipped_scans_total', 'Scans skipped to catch up with the schedule')
+
+# rule name -> its rule_events_total child, so counting an event is one dict lookup
+_rule_counters = {}
+
+def register_rule_counters(equipments):
+    """Creates the event counter of every configured rule, they are exported at 0
+    until the rule first triggers."""
+    for equipment in equipments:
+        for rule in equipment.rules:
+            if rule['name'] not in _rule_counters:
+                _rule_counters[rule['name']] = rule_events_counter.labels(rule=rule['name'])
 
 def update_event_counter(func):
 
@@ -37,10 +71,63 @@ def update_event_counter(func):
 
             for evt in triggered_events:
 
-                if evt["event_name"] == "PressaoCO2Baixa" : low_pressure_counter.inc()
-                else : temp_out_counter.inc()
+                counter = _rule_counters.get(evt["event_name"])
+                if counter is None:
+                    counter = _rule_counters[evt["event_name"]] = rule_events_counter.labels(rule=evt["event_name"])
+                counter.inc()
 
             events_triggered_counter.inc(len(triggered_events))
 
         return triggered_events
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+class TagValueCollector():
+    """Reports the last value of every tag and the reading count when Prometheus
+    scrapes, straight from the equipments, so reading a tag costs no metric update.
+
+    ``equipments`` is the live list, equipments added by a config reload show up
+    on the next scrape.
+    """
+
+    def __init__(self, equipments):
+        self.equipments = equipments
+
+    def collect(self):
+        values = GaugeMetricFamily('plc_sensor_reading', 'Current value of a PLC sensor', labels=['equipment', 'sensor'])
+        readings = 0
+
+        for equipment in list(self.equipments):
+            readings += equipment.readings
+            for tag, value in list(equipment.symtable.items()):
+                if isinstance(value, (int, float)):
+                    values.add_metric([equipment.name, tag], value)
+
+        yield values
+        yield CounterMetricFamily('raw_data_events', 'Total number of PLC value readings', value=readings)
+
+class OutboxCollector():
+    """Reports outbox row counts and database size when Prometheus scrapes.
+
+    ``db_paths`` lists the outbox shards to report, labelled by file name;
+    by default only the process' own outbox is reported.
+    """
+
+    def __init__(self, outbox, db_paths=None):
+        self.outbox = outbox
+        self.db_paths = db_paths or [outbox.DB_PATH]
+
+    def collect(self):
+        rows = GaugeMetricFamily('outbox_rows', 'Rows in the outbox by status', labels=['db', 'status'])
+        size = GaugeMetricFamily('outbox_db_size_bytes', 'Outbox database size on disk, WAL included', labels=['db'])
+
+        for path in self.db_paths:
+            with self.outbox.database(path):
+                stats = self.outbox.stats()
+
+            db = os.path.basename(path)
+            for status, count in stats['rows'].items():
+                rows.add_metric([db, status], count)
+            size.add_metric([db], stats['size_bytes'])
+
+        yield rows
+        yield size
@@ -1,12 +1,24 @@
-from threading import Event, Timer
 import time
+_started = time.perf_counter()
+
+from threading import Event
+import argparse
+import os
 import signal
 import sys
 from services.config_loader import ConfigLoader
-from services.data_reader import MqttAdapter, PLCDataReader
+from services.control import ControlServer
+from services.data_reader import ModbusAdapter, MqttAdapter
+from services.event_dispatcher import EventDispatcher
 from services.event_generator import EventGenerator
-from prometheus_client import start_http_server
-from services.event_publisher import EventPublisher, MockEventPublisher, RabbitMQEventPublisher
+from services.scan_scheduler import ScanScheduler
+from services.supervisor import Supervisor, shard_of
+from services import outbox
+from prometheus_client import REGISTRY, CollectorRegistry, start_http_server
+from decorator.metric_decorator import OutboxCollector, TagValueCollector, register_rule_counters
+from services.event_publisher import get_publisher
+from utils.codec import get_codec
+from utils.startup_profile import StartupProfile
 
 shutdown_event = Event()
 def handle_signal(signum, frame):
@@ -15,38 +27,184 @@ def handle_signal(signum, frame):
     shutdown_event.set()
 
 if __name__ == "__main__":
+
+    profile = StartupProfile(_started)
+    profile.mark("imports")
     
     signal.signal(signal.SIGTERM, handle_signal) 
     signal.signal(signal.SIGINT, handle_signal) 
 
-    start_http_server(8001)
+    parser = argparse.ArgumentParser(description="Reads the PLCs, evaluates the event rules and stores the events in the outbox.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("AGENT_WORKERS", "1")),
+                        help="Run as a supervisor of this many worker processes, each one handling a shard of the equipments")
+    parser.add_argument("--shard", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--shards", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Start up, run the first evaluation, print the time spent in each phase and exit")
+    args = parser.parse_args()
+
+    # EVENT_CODEC, checked before anything starts: a missing orjson or msgpack
+    # stops the supervisor before it spawns its workers
+    codec = get_codec()
+
+    if args.workers > 1 and args.shard is None:
+        Supervisor(args.workers, shutdown_event, relay_workers = int(os.getenv("RELAY_WORKERS", "1"))).run()
+        sys.exit(0)
+
+    # "timer" evaluates every equipment each timespan, "event" evaluates an
+    # equipment as soon as one of its readings arrives
+    evaluation_mode = os.getenv("EVALUATION_MODE", "timer")
+    # "columnar" evaluates each rule once over all equipments sharing it (timer mode, needs numpy)
+    evaluation_engine = os.getenv("EVALUATION_ENGINE", "scalar")
+    min_interval = float(os.getenv("EVALUATION_MIN_INTERVAL", "0.5"))
+    # event mode: how often the equipments with windowed rules are evaluated without readings
+    timed_rules_interval = float(os.getenv("TIMED_RULES_INTERVAL", "1.0"))
+    # "mqtt" subscribes to the PLCs' MQTT bridge, "modbus" polls them over Modbus TCP (needs pymodbus)
+    plc_adapter = os.getenv("PLC_ADAPTER", "mqtt")
+
+    # a shard worker's push-style metrics are served by its supervisor, only its
+    # scrape-time collectors (tag values) are served by the worker, on 8002 + shard
+    if args.shard is None:
+        registry = REGISTRY
+        start_http_server(8001)
+    else:
+        registry = CollectorRegistry()
+        start_http_server(8002 + args.shard, registry = registry)
+    profile.mark("metrics server")
+    outbox.init_db()
+    if args.shard is None:
+        REGISTRY.register(OutboxCollector(outbox))
+    outbox.start_retention(
+        interval_seconds = float(os.getenv("OUTBOX_RETENTION_INTERVAL", "3600")),
+        stop_event = shutdown_event,
+        older_than_seconds = int(os.getenv("OUTBOX_RETENTION_SECONDS", str(7 * 86400))),
+        mode = os.getenv("OUTBOX_ARCHIVE_MODE", "table"),
+        archive_dir = os.getenv("OUTBOX_ARCHIVE_DIR", "outbox_archive"),
+        keep_archive_days = int(os.getenv("OUTBOX_ARCHIVE_KEEP_DAYS", "30")),
+    )
+    profile.mark("outbox")
     loader = ConfigLoader()
     equipments , interpreter = loader.initialize()
-    sender = RabbitMQEventPublisher()
-    generator = EventGenerator(sender=sender, shutdown_event = shutdown_event)
-    plc_reader = MqttAdapter(equipments)
-    
-    count = 1
+    if args.shard is not None:
+        equipments = [equipment for equipment in equipments if shard_of(equipment.name, args.shards) == args.shard]
+        print(f"Shard {args.shard}/{args.shards}: {[equipment.name for equipment in equipments]}")
+    registry.register(TagValueCollector(equipments))
+    register_rule_counters(equipments)
+    profile.mark("config and rules")
+    sender = get_publisher()
+    profile.mark("publisher")
+    dispatcher = EventDispatcher(
+        sender,
+        workers = int(os.getenv("DISPATCH_WORKERS", "4")),
+        max_queue_size = int(os.getenv("DISPATCH_QUEUE_SIZE", "100")),
+        policy = os.getenv("DISPATCH_POLICY", "block"),
+        # the relay takes over the events not confirmed within this lease
+        lease_seconds = int(os.getenv("DISPATCH_LEASE_SECONDS", "60")),
+    )
+    engine = None
+    if evaluation_engine == "columnar" and evaluation_mode == "timer":
+        # numpy is only imported when the columnar engine is used
+        from services.columnar_engine import ColumnarEngine
+        engine = ColumnarEngine(equipments)
+    generator = EventGenerator(
+        sender=sender, shutdown_event = shutdown_event, min_interval = min_interval, dispatcher = dispatcher, engine = engine, codec = codec,
+        # per-rule evaluation histograms, off by default as timing a rule costs more than running it
+        rule_timing = os.getenv("RULE_TIMING", "0") == "1",
+    )
+
+    if plc_adapter == "modbus":
+        # polled at each tag's scan rate by the scheduler below
+        plc_reader = ModbusAdapter(equipments, workers = int(os.getenv("MODBUS_WORKERS", "8")), scan_timeout = float(os.getenv("MODBUS_SCAN_TIMEOUT", "0.5")))
+    else:
+        plc_reader = MqttAdapter(equipments, on_reading = generator.on_reading if evaluation_mode == "event" else None)
+
+    def notify_scanned(scanned):
+        for equipment in scanned:
+            generator.notify(equipment)
+
+    # reads every tag at its scan rate (SCAN_RATE seconds unless configured) and
+    # evaluates what was read. MQTT readings of the event mode need no scan, the
+    # columnar engine evaluates the whole plant on its own timer
+    scheduler = None
+    if plc_adapter == "modbus" or evaluation_mode != "event":
+        if evaluation_mode == "event":
+            on_scan = notify_scanned
+        elif engine is not None:
+            on_scan = None
+        else:
+            on_scan = generator.evaluate_equipments
+        scheduler = ScanScheduler(equipments, plc_reader, shutdown_event, on_scan = on_scan, default_rate = float(os.getenv("SCAN_RATE", "1.0")))
+
+    def reload_config(message):
+        """Applies a config pushed by the agent without restarting: only the
+        changed equipments and rules are touched."""
+        select = None
+        if args.shard is not None:
+            select = lambda name: shard_of(name, args.shards) == args.shard
+
+        # no evaluation runs while rules, thresholds and windows are swapped, a
+        # rule picked before the swap could read a window that's gone after it
+        with generator.paused():
+            added, removed, updated = loader.reload(message['config'], equipments, select)
+            register_rule_counters(equipments)
+
+            plc_reader.remove_equipments(removed)
+            plc_reader.update_equipments(updated)
+            plc_reader.add_equipments(added)
+            if scheduler is not None:
+                scheduler.remove_equipments(removed)
+                scheduler.update_equipments(updated)
+                scheduler.add_equipments(added)
+
+            if generator.engine is not None:
+                from services.columnar_engine import ColumnarEngine
+                generator.engine = ColumnarEngine(equipments)
+
+        changes = {
+            'added' : [equipment.name for equipment in added],
+            'removed' : [equipment.name for equipment in removed],
+            'updated' : [equipment.name for equipment in updated],
+        }
+        print(f"Config reloaded: {changes}")
+        return changes
+
+    control = ControlServer({'reload' : reload_config})
+    profile.mark("generator")
 
     try:
         
         plc_reader.connect(equipments)
-        generator.start(interpreter = interpreter, timespan = 3.0, equipments = equipments)
-        
-        while not shutdown_event.is_set():
-            print(f"---------------------------- Cycle Number {count} ----------------------------------------")
+        control.start()
+        profile.mark("plc connect")
+
+        if evaluation_mode == "event":
+            print(f"Event-driven evaluation (min interval {min_interval}s)")
+        elif engine is not None:
+            generator.start(interpreter = interpreter, timespan = 3.0, equipments = equipments)
+            profile.mark("first evaluation")
+
+        if scheduler is not None:
+            scheduler.step()
+            profile.mark("first scan")
 
-            for equipment in equipments:
-                readings = plc_reader.read(equipment)
-                if (readings):
-                    equipment.update_values(readings)
-                    print("Cycle Readings: ", readings)
+        if args.startup_profile:
+            print(f"Startup profile ({evaluation_mode} mode):\n{profile.report()}")
+            shutdown_event.set()
 
-            time.sleep(1)
-            count += 1
+        if scheduler is not None:
+            scheduler.run()
+        else:
+            # a windowed rule (max_over(Voltagem, 30) < 6.0) turns true with time
+            # alone, MQTT readings don't arrive when a value stops changing
+            while not shutdown_event.wait(timed_rules_interval):
+                for equipment in list(equipments):
+                    if equipment.timed_rules:
+                        generator.notify(equipment)
     
     finally:
         
         print("\nMain loop exited. Performing cleanup...")
+        control.stop()
+        plc_reader.close()
         generator.shutdown()
         print("Cleanup complete. Exiting.")
\ No newline at end of file
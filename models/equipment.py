@@ -1,42 +1,189 @@
-from asteval import asteval
+from threading import Lock
+import time
+
+from models.threshold_index import ThresholdIndex
+from models.window import Windows
 
 class Equipment():
 
     def __init__(self, name : str, ip : str, code : str, config : dict, compiled_rules : dict):
 
         self.name = name
-        self.ip = ip
-        self.code = code
-
-        self.tags = config['tags']
         self.rules = []
-        self.symtable = asteval.make_symbol_table()
-        self.metadata = config['metadata']
-        
+        self.symtable = {}
+        # values received so far, exported by TagValueCollector
+        self.readings = 0
+
+        # tag name -> rules whose expression reads that tag. Rules reading no
+        # tag at all are indexed under None, which starts dirty so they run once
+        self.rules_by_tag = {}
+        # tag name -> its threshold rules (``Tag > 22.0``...), which rules_by_tag
+        # leaves out: flipped_rules resolves them with one lookup per tag
+        self.thresholds = {}
+        self.dirty_tags = set()
+        # time.monotonic() of the oldest change not evaluated yet
+        self.dirty_since = None
+        self._dirty_lock = Lock()
+
+        # rolling windows of the tags the rules reference through window
+        # functions, in the symtable as __windows__ once some rule needs one
+        self.windows = Windows()
+        # rules using window functions, their value changes with time alone so
+        # they're evaluated every cycle
+        self.timed_rules = []
+
+        self.configure(ip, code, config, compiled_rules)
+
+    def configure(self, ip : str, code : str, config : dict, compiled_rules : dict):
+        """Applies this equipment's (new) config.
+
+        A rule keeping its name and expression keeps its edge state, only its
+        routing key and output are updated. New or changed rules start false and
+        are evaluated on the next cycle; values of removed tags are forgotten.
+        Windows still referenced keep their history, the others are freed.
+        """
+        self.apply(self.prepare(ip, code, config, compiled_rules))
+
+    def prepare(self, ip : str, code : str, config : dict, compiled_rules : dict) -> dict:
+        """Builds everything configure changes without touching the equipment, so
+        a config missing a key or a rule raises here and leaves it as it was."""
+        tags = config['tags']
+        metadata = config['metadata']
+
+        previous = {(rule['name'], rule['expression'].source) : rule for rule in self.rules}
+        rules = []
+        # (kept rule, routing key, output), applied with the rest
+        updates = []
+        rules_by_tag = {}
+        thresholds = {}
+        timed_rules = []
+        windows = set()
+        dirty = set()
+
         for rule in config['event_rules']:
 
             expression = rule['expression']
 
             compiled_rule = compiled_rules[expression]
 
-            self.rules.append({
-                'name' : rule['name'],
-                'expression' : compiled_rule,
-                'routing_key' : rule['routing_key'] or "",
-                'output' : rule['output'],
-                'state' : False
-            })
+            equipment_rule = previous.get((rule['name'], expression))
+            if equipment_rule is None:
+                equipment_rule = {
+                    'name' : rule['name'],
+                    'expression' : compiled_rule,
+                    'state' : False
+                }
+                dirty.update(tag for tag in compiled_rule.tags if tag in self.symtable)
+                if not compiled_rule.tags:
+                    dirty.add(None)
+
+            updates.append((equipment_rule, rule['routing_key'] or "", rule['output']))
+            rules.append(equipment_rule)
+
+            if compiled_rule.threshold is not None:
+                tag, operator, threshold = compiled_rule.threshold
+                thresholds.setdefault(tag, ThresholdIndex()).add(operator, threshold, len(rules), equipment_rule)
+                continue
+
+            for tag in compiled_rule.tags or (None,):
+                rules_by_tag.setdefault(tag, []).append(equipment_rule)
+
+            if compiled_rule.windows:
+                timed_rules.append(equipment_rule)
+                windows.update(compiled_rule.windows)
+
+        tag_names = {tag['name'] for tag in tags}
+
+        return {
+            'ip' : ip,
+            'code' : code,
+            'config' : config,
+            'tags' : tags,
+            'metadata' : metadata,
+            'scan' : config.get('scan'),
+            'rules' : rules,
+            'updates' : updates,
+            'rules_by_tag' : rules_by_tag,
+            'thresholds' : thresholds,
+            'timed_rules' : timed_rules,
+            'windows' : windows,
+            'forgotten' : [tag for tag in self.symtable if tag not in tag_names and tag != '__windows__'],
+            'dirty' : dirty,
+        }
+
+    def apply(self, prepared : dict):
+        """Swaps in a config built by prepare."""
+        self.ip = prepared['ip']
+        self.code = prepared['code']
+        self.config = prepared['config']
+        self.tags = prepared['tags']
+        self.metadata = prepared['metadata']
+        self.scan = prepared['scan']
+
+        for rule, routing_key, output in prepared['updates']:
+            rule['routing_key'] = routing_key
+            rule['output'] = output
+
+        for tag in prepared['forgotten']:
+            self.symtable.pop(tag, None)
+
+        windows = prepared['windows']
+        self.windows.configure(windows)
+        if windows:
+            self.symtable['__windows__'] = self.windows
+        else:
+            self.symtable.pop('__windows__', None)
+
+        self.rules = prepared['rules']
+        self.rules_by_tag = prepared['rules_by_tag']
+        self.thresholds = prepared['thresholds']
+        self.timed_rules = prepared['timed_rules']
+
+        with self._dirty_lock:
+            self.dirty_tags.update(prepared['dirty'])
 
     def update_values(self, new_values):
-        try:
-            self.symtable.update(new_values)
-        except AttributeError:
-            self.symtable = new_values
+        self.readings += len(new_values)
+        changed = [tag for tag, value in new_values.items() if tag not in self.symtable or self.symtable[tag] != value]
+
+        self.symtable.update(new_values)
+
+        if self.windows.by_tag:
+            self.windows.add(new_values)
+
+        if changed:
+            with self._dirty_lock:
+                self.dirty_tags.update(changed)
+                if self.dirty_since is None:
+                    self.dirty_since = time.monotonic()
+
+    def pop_dirty(self):
+        """Returns the tags changed since the last call and when the first of them changed."""
+        with self._dirty_lock:
+            dirty, self.dirty_tags = self.dirty_tags, set()
+            since, self.dirty_since = self.dirty_since, None
 
-    
-    
+        return dirty, since
 
+    def flipped_rules(self, dirty):
+        """Returns, in config order, (rule, state) for the threshold rules on the
+        ``dirty`` tags whose truth changed. The caller stores the new states."""
+        flipped = []
+        for tag in dirty:
+            index = self.thresholds.get(tag)
+            if index is not None:
+                flipped.extend(index.flips(self.symtable.get(tag)))
 
+        flipped.sort(key=lambda flip: flip[0])
+        return [(rule, state) for _, rule, state in flipped]
 
+    def rules_for(self, dirty):
+        """Returns, in config order, the rules besides threshold rules reading any
+        of the ``dirty`` tags, and the rules using window functions."""
+        if not dirty:
+            return list(self.timed_rules)
 
+        affected = {id(rule) for tag in dirty for rule in self.rules_by_tag.get(tag, ())}
+        affected.update(id(rule) for rule in self.timed_rules)
 
+        return [rule for rule in self.rules if id(rule) in affected]
@@ -0,0 +1,69 @@
+from bisect import bisect_left, bisect_right
+import math
+
+# operator -> (bisect giving the number of thresholds below the boundary, whether
+# the rules true for a value are the thresholds before that boundary)
+#   Tag >  c  is true for c <  value: thresholds[:bisect_left]
+#   Tag >= c  is true for c <= value: thresholds[:bisect_right]
+#   Tag <  c  is true for c >  value: thresholds[bisect_right:]
+#   Tag <= c  is true for c >= value: thresholds[bisect_left:]
+_BOUNDARIES = {
+    '>' : (bisect_left, True),
+    '>=' : (bisect_right, True),
+    '<' : (bisect_right, False),
+    '<=' : (bisect_left, False),
+}
+
+
+class ThresholdIndex():
+    """The threshold rules of one tag (``Voltagem > 22.0``, ``Voltagem < 6.0``...),
+    sorted by threshold per operator.
+
+    The rules true for a value are a prefix or a suffix of each sorted list, so
+    between the previous value and a new one only the rules whose threshold lies
+    in between flip: two bisects per operator find them, whatever the number of
+    alarm bands on the tag. Until it saw a value (and after a value that isn't a
+    number) the index compares every rule's truth with its state instead.
+    """
+
+    def __init__(self):
+        # operator -> (sorted thresholds, [(position, rule)] in the same order)
+        self.groups = {}
+        # value the rule states reflect, None when they must be checked one by one
+        self.value = None
+
+    def add(self, operator : str, threshold : float, position : int, rule : dict):
+        thresholds, rules = self.groups.setdefault(operator, ([], []))
+        index = bisect_right(thresholds, threshold)
+        thresholds.insert(index, threshold)
+        rules.insert(index, (position, rule))
+
+    def flips(self, value):
+        """Returns (position, rule, state) for every rule whose truth changed with ``value``."""
+        if not isinstance(value, (int, float)) or math.isnan(value):
+            # like a failed comparison, the rules are false until the next number
+            self.value = None
+            return [(position, rule, False) for _, rules in self.groups.values() for position, rule in rules if rule['state']]
+
+        flipped = []
+        previous = self.value
+
+        for operator, (thresholds, rules) in self.groups.items():
+            boundary, before = _BOUNDARIES[operator]
+            k = boundary(thresholds, value)
+
+            if previous is None:
+                for index, (position, rule) in enumerate(rules):
+                    state = (index < k) == before
+                    if bool(rule['state']) != state:
+                        flipped.append((position, rule, state))
+                continue
+
+            k_previous = boundary(thresholds, previous)
+            # the rules between both boundaries are true now iff they're on the true side of k
+            for index in range(min(k, k_previous), max(k, k_previous)):
+                position, rule = rules[index]
+                flipped.append((position, rule, (index < k) == before))
+
+        self.value = value
+        return flipped
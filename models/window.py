@@ -0,0 +1,217 @@
+from array import array
+from threading import Lock
+import math
+import time
+
+# buckets per window: the cost of a window doesn't depend on its length, its
+# edges are precise to seconds / BUCKETS
+BUCKETS = 32
+
+_NAN = math.nan
+
+
+class Window():
+    """Readings of one tag over the last ``seconds``, in a ring of time buckets.
+
+    Every bucket keeps the sum, count, min, max, first and last value of the
+    readings that fell in it, in flat arrays. Sum and count are also kept for
+    the whole window and updated as buckets enter and leave it, so adding a
+    reading and averaging are O(1). The others scan the fixed number of buckets.
+
+    ``carry`` is the value in effect when the window starts (the last reading
+    before it), so a tag that stopped changing still has a value over the window.
+    Aggregates without any value are NaN, which every comparison treats as false.
+    """
+
+    def __init__(self, seconds : float, buckets : int = BUCKETS):
+        self.seconds = seconds
+        self.size = buckets
+        self.width = seconds / buckets
+
+        # absolute bucket index (time // width) held by each slot, None when
+        # empty: any integer could be a bucket index, negative ones included
+        self.ids = [None] * buckets
+        self.sums = array('d', [0.0]) * buckets
+        self.counts = array('q', [0]) * buckets
+        self.mins = array('d', [0.0]) * buckets
+        self.maxs = array('d', [0.0]) * buckets
+        self.firsts = array('d', [0.0]) * buckets
+        self.lasts = array('d', [0.0]) * buckets
+
+        self.total = 0.0
+        self.count = 0
+        self.oldest = None
+        self.carry = None
+        self.last = None
+        self.first_time = None
+        self.last_time = None
+
+    def _expire(self, now):
+        """Drops the buckets that left the window, returns the current bucket index."""
+        if self.last_time is not None and now < self.last_time:
+            now = self.last_time
+
+        current = int(now // self.width)
+        start = current - self.size + 1
+
+        if self.oldest is None or self.oldest >= start:
+            return current
+
+        if start - self.oldest > self.size:
+            # idle for longer than the window: everything left it
+            if self.count:
+                self.carry = self.last
+            self.total = 0.0
+            self.count = 0
+            self.oldest = start
+            return current
+
+        while self.oldest < start:
+            slot = self.oldest % self.size
+            if self.ids[slot] == self.oldest:
+                self.total -= self.sums[slot]
+                self.count -= self.counts[slot]
+                self.carry = self.lasts[slot]
+                self.ids[slot] = None
+            self.oldest += 1
+
+        return current
+
+    def add(self, now : float, value : float):
+        value = float(value)
+        current = self._expire(now)
+
+        if self.oldest is None:
+            self.oldest = current
+            self.first_time = now
+
+        slot = current % self.size
+        if self.ids[slot] != current:
+            self.ids[slot] = current
+            self.sums[slot] = value
+            self.counts[slot] = 1
+            self.mins[slot] = self.maxs[slot] = self.firsts[slot] = value
+        else:
+            self.sums[slot] += value
+            self.counts[slot] += 1
+            if value < self.mins[slot]:
+                self.mins[slot] = value
+            if value > self.maxs[slot]:
+                self.maxs[slot] = value
+
+        self.lasts[slot] = value
+        self.total += value
+        self.count += 1
+        self.last = value
+        self.last_time = max(now, self.last_time or now)
+
+    def _slots(self, current):
+        """Slots holding a bucket of the window, oldest first."""
+        for index in range(current - self.size + 1, current + 1):
+            slot = index % self.size
+            if self.ids[slot] == index:
+                yield slot
+
+    def avg(self, now : float) -> float:
+        self._expire(now)
+        if self.count:
+            return self.total / self.count
+        return self.last if self.last is not None else _NAN
+
+    def delta(self, now : float) -> float:
+        """Last value minus the value in effect when the window starts."""
+        current = self._expire(now)
+        if self.last is None:
+            return _NAN
+
+        start = self.carry
+        if start is None:
+            start = next((self.firsts[slot] for slot in self._slots(current)), self.last)
+
+        return self.last - start
+
+    def covered(self, now : float) -> bool:
+        """True once the tag has history for the whole window."""
+        return self.first_time is not None and now - self.first_time >= self.seconds
+
+    def max_over(self, now : float) -> float:
+        """Highest value in effect during the window, NaN until the window is covered."""
+        current = self._expire(now)
+        if not self.covered(now):
+            return _NAN
+
+        values = [self.maxs[slot] for slot in self._slots(current)]
+        if self.carry is not None:
+            values.append(self.carry)
+        return max(values) if values else self.last
+
+    def min_over(self, now : float) -> float:
+        """Lowest value in effect during the window, NaN until the window is covered."""
+        current = self._expire(now)
+        if not self.covered(now):
+            return _NAN
+
+        values = [self.mins[slot] for slot in self._slots(current)]
+        if self.carry is not None:
+            values.append(self.carry)
+        return min(values) if values else self.last
+
+
+class Windows():
+    """The windows an equipment's rules reference, one per (tag, seconds).
+
+    Rule expressions reach it as ``__windows__``: ``avg(Voltagem, 30)`` is
+    compiled to ``__windows__.avg('Voltagem', 30)``. ``clock`` gives the time of
+    readings and evaluations, a replay sets its virtual clock there.
+    """
+
+    def __init__(self, clock = time.time):
+        self.clock = clock
+        self.windows = {}
+        # tag name -> its windows, what update_values feeds
+        self.by_tag = {}
+        # readings and evaluations may come from different threads
+        self._lock = Lock()
+
+    def configure(self, keys):
+        """Keeps the windows still referenced, with their history, and allocates the new ones."""
+        windows = {key : self.windows.get(key) or Window(key[1]) for key in keys}
+
+        by_tag = {}
+        for (tag, _), window in windows.items():
+            by_tag.setdefault(tag, []).append(window)
+
+        with self._lock:
+            self.windows = windows
+            self.by_tag = by_tag
+
+    def add(self, readings):
+        now = self.clock()
+        with self._lock:
+            for tag, value in readings.items():
+                for window in self.by_tag.get(tag, ()):
+                    try:
+                        window.add(now, value)
+                    except (TypeError, ValueError):
+                        # not a number, the window keeps its previous value
+                        pass
+
+    def _query(self, function, tag, seconds):
+        with self._lock:
+            return function(self.windows[(tag, seconds)], self.clock())
+
+    def avg(self, tag, seconds):
+        return self._query(Window.avg, tag, seconds)
+
+    def delta(self, tag, seconds):
+        return self._query(Window.delta, tag, seconds)
+
+    def rate(self, tag, seconds):
+        """Change per second over the window."""
+        return self._query(Window.delta, tag, seconds) / seconds
+
+    def max_over(self, tag, seconds):
+        return self._query(Window.max_over, tag, seconds)
+
+    def min_over(self, tag, seconds):
+        return self._query(Window.min_over, tag, seconds)
@@ -0,0 +1,204 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import time
+
+from decorator.metric_decorator import stage_latency
+from services.rule_compiler import UnsupportedExpression, compile_vector
+
+_VECTOR_GLOBALS = {
+    '__builtins__': {},
+    '__vnot__': lambda value: np.logical_not(value),
+}
+
+
+class RuleGroup():
+    """Equipments sharing the same rules, with their tags stored column-wise.
+
+    Each tag is one float64 column holding one row per equipment (NaN until the
+    first reading), each rule is evaluated once over every row, and the rising
+    edges come out of a boolean state array per rule.
+
+    Unread tags are handled like the scalar path does: an equipment whose
+    first tag wasn't read yet is not evaluated, and a rule reaching a tag the
+    equipment didn't read is false.
+    """
+
+    def __init__(self, equipments):
+        self.equipments = equipments
+        self.rows = {equipment.name : row for row, equipment in enumerate(equipments)}
+
+        size = len(equipments)
+        template = equipments[0]
+        tags = sorted({tag['name'] for equipment in equipments for tag in equipment.tags})
+
+        self.columns = {tag : np.full(size, np.nan) for tag in tags}
+        # rows that didn't read the tag yet, NaN may be a value read as well
+        self.unread = {tag : np.ones(size, dtype=bool) for tag in tags}
+        # the tags some row didn't read, the others need no check
+        self.unread_tags = set(tags)
+        # rows whose first tag wasn't read, the scalar path skips them
+        self.skipped = np.ones(size, dtype=bool)
+        self.state = np.zeros((len(template.rules), size), dtype=bool)
+
+        # rows where the rule being evaluated divided by zero or read an unread
+        # tag: the scalar rule reports a ZeroDivisionError or a NameError and is
+        # false there, so is the vector one. Only rows reaching them count, ``and``/``or`` narrow ``reached``
+        # to the rows their previous operands didn't decide
+        self.errors = np.zeros(size, dtype=bool)
+        self.reached = np.ones(size, dtype=bool)
+        self.globals = dict(
+            _VECTOR_GLOBALS,
+            __vand__=self._and,
+            __vor__=self._or,
+            __vdiv__=self._division(np.true_divide),
+            __vfloordiv__=self._division(np.floor_divide),
+            __vmod__=self._division(np.mod),
+            __vtag__=self._tag,
+        )
+
+        # equipments that already ran (e.g. the engine is rebuilt after a config
+        # reload) carry over their values and edge states
+        for row, equipment in enumerate(equipments):
+            for tag, value in equipment.symtable.items():
+                if tag in self.columns:
+                    self.columns[tag][row] = value
+                    self.unread[tag][row] = False
+            for index, rule in enumerate(equipment.rules):
+                self.state[index, row] = bool(rule['state'])
+
+        # code per rule, None for the rules that can't be vectorized and are
+        # evaluated row by row
+        self.rules = []
+        for rule in template.rules:
+            try:
+                code = compile_vector(rule['expression'].source)
+            except UnsupportedExpression:
+                code = None
+
+            if not rule['expression'].tags <= self.columns.keys():
+                code = None
+
+            self.rules.append(code)
+
+    def _division(self, operation):
+        def divide(left, right):
+            self.errors |= self.reached & (np.asarray(right) == 0)
+            return operation(left, right)
+        return divide
+
+    def _tag(self, tag):
+        if tag in self.unread_tags:
+            self.errors |= self.reached & self.unread[tag]
+        return self.columns[tag]
+
+    def _and(self, *operands):
+        reached = self.reached
+        result = np.ones(len(reached), dtype=bool)
+        for operand in operands:
+            # later operands only run where every previous one was true
+            self.reached = reached & result
+            result = result & np.asarray(operand(), dtype=bool)
+        self.reached = reached
+        return result
+
+    def _or(self, *operands):
+        reached = self.reached
+        result = np.zeros(len(reached), dtype=bool)
+        for operand in operands:
+            # later operands only run where every previous one was false
+            self.reached = reached & ~result
+            result = result | np.asarray(operand(), dtype=bool)
+        self.reached = reached
+        return result
+
+    def load(self):
+        """Copies the tags changed since the last cycle into the columns."""
+        now = time.monotonic()
+        # per row, time.monotonic() of the oldest change loaded this cycle
+        self.read_at = [None] * len(self.equipments)
+
+        for row, equipment in enumerate(self.equipments):
+            dirty, read_at = equipment.pop_dirty()
+            if read_at is not None:
+                self.read_at[row] = read_at
+                stage_latency['read_to_evaluate'].observe(now - read_at)
+
+            for tag in dirty:
+                column = self.columns.get(tag)
+                if column is not None:
+                    column[row] = equipment.symtable[tag]
+                    self.unread[tag][row] = False
+
+            self.skipped[row] = equipment.tags[0]['name'] not in equipment.symtable
+
+        if self.unread_tags:
+            self.unread_tags = {tag for tag in self.unread_tags if self.unread[tag].any()}
+
+    def evaluate(self):
+        """Yields (equipment, rule, read_at) for every rule that became true this cycle."""
+        size = len(self.equipments)
+
+        skipped = self.skipped.any()
+
+        for index, code in enumerate(self.rules):
+            previous = self.state[index]
+
+            if code is not None:
+                self.errors[:] = False
+                self.reached[:] = True
+                with np.errstate(all='ignore'):
+                    result = np.broadcast_to(np.asarray(eval(code, self.globals), dtype=bool), (size,))
+
+                result = result & ~self.errors
+                if skipped:
+                    result = np.where(self.skipped, previous, result)
+            else:
+                result = np.fromiter(
+                    (previous[row] if self.skipped[row] else bool(equipment.rules[index]['expression'](equipment.symtable))
+                     for row, equipment in enumerate(self.equipments)),
+                    dtype=bool, count=size
+                )
+
+            rising = result & ~previous
+
+            for row in np.flatnonzero(result != previous):
+                self.equipments[row].rules[index]['state'] = bool(result[row])
+
+            self.state[index] = result
+
+            for row in np.flatnonzero(rising):
+                equipment = self.equipments[row]
+                yield equipment, equipment.rules[index], self.read_at[row]
+
+
+class ColumnarEngine():
+    """Evaluates the rules of many identical equipments as vectorized NumPy expressions.
+
+    Equipments are grouped by rule set (names, expressions and outputs), so each
+    rule of a group runs once per cycle no matter how many machines share it.
+    The gain is modest at a few hundred equipments: bench_columnar at 500 ran
+    a cycle 1.25x (8.90 vs 7.16 ms) to 3x faster depending on the machine, so
+    measure before switching. Needs numpy, which is an optional dependency.
+    """
+
+    def __init__(self, equipments):
+
+        if np is None:
+            raise ImportError("The columnar engine needs numpy, install it with 'pip install numpy'")
+
+        groups = {}
+        for equipment in equipments:
+            signature = tuple((rule['name'], rule['expression'].source, rule['output']) for rule in equipment.rules)
+            groups.setdefault(signature, []).append(equipment)
+
+        self.groups = [RuleGroup(members) for members in groups.values()]
+
+    def evaluate(self):
+        for group in self.groups:
+            started = time.monotonic()
+            group.load()
+            yield from group.evaluate()
+            stage_latency['evaluate'].observe(time.monotonic() - started)
@@ -1,13 +1,22 @@
+import hashlib
 import json
-import asteval
+import os
 from models.equipment import Equipment
+from services.rule_compiler import CACHE_KEY, LazyInterpreter, compile_rule, dump_rules, load_rules
+
+RULE_CACHE_DIR = os.getenv("RULE_CACHE_DIR", ".rule_cache")
+# compiled rule sets kept in RULE_CACHE_DIR, the least recently used are removed
+RULE_CACHE_ENTRIES = int(os.getenv("RULE_CACHE_ENTRIES", "8"))
 
 
 class ConfigLoader():
 
+    def __init__(self, config_path = "config.json"):
+        self.config_path = config_path
+
     def _load_config(self):
         try:
-            with open("config.json", "r", encoding="utf-8") as f:
+            with open(self.config_path, "r", encoding="utf-8") as f:
                 config = json.load(f)
 
                 return config
@@ -16,17 +25,74 @@ class ConfigLoader():
             print(f"Error while decoding JSON config file: {e}")
             exit(0)
 
-    def _compile_event_rules(self, config, interpreter):
+    def _compile_event_rules(self, config, interpreter, compiled_rules = None):
+        """Compiles every expression of the config, reusing those already in ``compiled_rules``."""
 
+        previous = compiled_rules or {}
         compiled_rules = {}
 
         for eq_name, eq_cfg in config.items():
             for rule in eq_cfg['event_rules']:
                 if (rule['expression'] not in compiled_rules.keys()):
-                    compiled_rules[rule["expression"]] = interpreter.parse(rule["expression"])
+                    compiled_rules[rule["expression"]] = previous.get(rule["expression"]) or compile_rule(rule["expression"], interpreter)
     
         return compiled_rules
     
+    def _cache_path(self, config):
+        # hashed from the parsed config, so a reload pushed by the agent and the
+        # config.json it writes for the next start share the same entry, and
+        # from the compiler that made it
+        digest = hashlib.sha256(f"{CACHE_KEY}\n{json.dumps(config, sort_keys=True)}".encode('utf-8')).hexdigest()
+        return os.path.join(RULE_CACHE_DIR, f"{digest}.rules")
+
+    def _load_cached_rules(self, config, interpreter):
+        """Compiled rules of this exact config from the on-disk cache, compiled
+        and cached now if this config wasn't seen before."""
+        path = self._cache_path(config)
+        compiled_rules = load_rules(path, interpreter)
+
+        if compiled_rules is None:
+            compiled_rules = self._compile_event_rules(config, interpreter)
+            self._save_cached_rules(config, compiled_rules)
+        else:
+            try:
+                # used now, the last entry to be evicted
+                os.utime(path)
+            except OSError:
+                pass
+
+        return compiled_rules
+
+    def _save_cached_rules(self, config, compiled_rules):
+        path = self._cache_path(config)
+        try:
+            os.makedirs(RULE_CACHE_DIR, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            dump_rules(compiled_rules, temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not write the rule cache {path}: {e}")
+            return
+
+        self._evict_cached_rules()
+
+    def _evict_cached_rules(self):
+        """Removes all but the RULE_CACHE_ENTRIES most recently used entries,
+        which other loaders (a benchmark, another config) may share."""
+        try:
+            entries = []
+            for name in os.listdir(RULE_CACHE_DIR):
+                if name.endswith(".rules"):
+                    path = os.path.join(RULE_CACHE_DIR, name)
+                    entries.append((os.path.getmtime(path), path))
+
+            entries.sort(reverse=True)
+            for _, path in entries[RULE_CACHE_ENTRIES:]:
+                os.remove(path)
+        except OSError as e:
+            # removed meanwhile by another process, evicted on the next save
+            print(f"Could not evict old rule cache entries: {e}")
+
     def _build_equipments(self,config, compiled_rules):
 
         equipments = []
@@ -45,16 +111,64 @@ class ConfigLoader():
 
         return equipments
 
+    def build(self, config):
+        """Compiles the rules of an already parsed config and builds its
+        equipments, without the rule cache."""
+        self.interpreter = LazyInterpreter()
+        self.compiled_rules = self._compile_event_rules(config, self.interpreter)
+
+        return self._build_equipments(config, self.compiled_rules)
+
     def initialize(self):
 
         try:
-            interpreter = asteval.Interpreter()
+            self.interpreter = LazyInterpreter()
             config = self._load_config()
-            compiled_rules = self._compile_event_rules(config, interpreter)
-            equipments = self._build_equipments(config, compiled_rules)
+            self.compiled_rules = self._load_cached_rules(config, self.interpreter)
+            equipments = self._build_equipments(config, self.compiled_rules)
                                
-            return equipments, interpreter
+            return equipments, self.interpreter
 
         except Exception as e:
             raise e
 
+    def reload(self, config, equipments, select = None):
+        """Applies a new config to the running ``equipments`` list, in place.
+
+        Only expressions that weren't compiled before are compiled, equipments
+        whose config is unchanged are left alone and the others are reconfigured,
+        which keeps the state of their unchanged rules. Everything is compiled
+        and built before the first equipment is touched, so a bad config
+        changes nothing.
+
+        ``select(name)`` restricts the equipments taken from the config (a shard
+        worker's own), the rules of the whole config are compiled and cached.
+
+        Returns the (added, removed, updated) equipments.
+        """
+        compiled_rules = self._compile_event_rules(config, self.interpreter, self.compiled_rules)
+        full_config = config
+        if select is not None:
+            config = {name : eq_cfg for name, eq_cfg in config.items() if select(name)}
+
+        current = {equipment.name : equipment for equipment in equipments}
+
+        added = self._build_equipments({name : eq_cfg for name, eq_cfg in config.items() if name not in current}, compiled_rules)
+        removed = [equipment for name, equipment in current.items() if name not in config]
+        updated = [equipment for name, equipment in current.items() if name in config and equipment.config != config[name]]
+
+        # every updated config is checked before the first one is applied
+        prepared = []
+        for equipment in updated:
+            eq_cfg = config[equipment.name]
+            prepared.append((equipment, equipment.prepare(ip = eq_cfg['ip'], code = eq_cfg['code'], config = eq_cfg, compiled_rules = compiled_rules)))
+
+        for equipment, state in prepared:
+            equipment.apply(state)
+
+        equipments[:] = [equipment for equipment in equipments if equipment.name in config] + added
+        self.compiled_rules = compiled_rules
+        self._save_cached_rules(full_config, compiled_rules)
+
+        return added, removed, updated
+
@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from typing import Callable, Dict
+
+CONTROL_SOCKET = os.getenv("CONTROL_SOCKET", "control.sock")
+
+
+class ControlServer():
+    """Local control channel of a running generator, on a Unix socket.
+
+    A request is one JSON object per line, ``{"command": "reload", ...}``, and
+    is answered with one JSON line: ``{"status": "ok", ...}`` with whatever the
+    command's handler returned, or ``{"status": "error", "error": "..."}``.
+    """
+
+    def __init__(self, handlers : Dict[str, Callable[[dict], dict]], path : str = None):
+        self.handlers = handlers
+        self.path = path or CONTROL_SOCKET
+        self._server = None
+
+    def start(self):
+        # a socket left behind by a process that was killed
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        control = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write(json.dumps(control.handle(line)).encode('utf-8') + b'\n')
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="control-server", daemon=True).start()
+        print(f"Control channel listening on {self.path}")
+
+    def handle(self, line : bytes) -> dict:
+        try:
+            message = json.loads(line)
+            handler = self.handlers.get(message.get('command'))
+            if handler is None:
+                return {'status' : 'error', 'error' : f"Unknown command {message.get('command')!r}"}
+            return {'status' : 'ok', **(handler(message) or {})}
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            print(f"Error while handling control request: {error}")
+            return {'status' : 'error', 'error' : error}
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def request(message : dict, path : str = None, timeout : float = 30.0) -> dict:
+    """Sends one request to a ControlServer and returns its answer. Raises OSError
+    when nothing is listening on the socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path or CONTROL_SOCKET)
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with sock.makefile('rb') as answer:
+            line = answer.readline()
+
+    if not line:
+        raise ConnectionError("The control channel closed without answering")
+
+    return json.loads(line)
@@ -1,38 +1,190 @@
 from abc import ABC, abstractmethod
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from threading import Lock
+import csv
+import gzip
+import importlib.util
+import inspect
+import json
+import struct
 import paho.mqtt.client as mqtt
 import random
+import time
 
-from decorator.metric_decorator import update_prometheus_on_read
+from decorator.metric_decorator import stage_latency
 from utils.converter import Converter
 
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_TOPIC = "oven/01"
 
+# "/<equipment>/scan" carries a whole PLC scan in one message
+SCAN_TOPIC = "scan"
+
 class CommunicationAdapter(ABC):
     @abstractmethod
     def connect(self):
         pass
 
     @abstractmethod
-    def read(self, equipment):
+    def read(self, equipment, tags=None):
+        """Returns the new readings of the equipment, only of ``tags`` (names) if given."""
+        pass
+
+    def scan(self, requests):
+        """Reads several (equipment, tag names) at once for ScanScheduler and returns
+        [(equipment, readings)]. Adapters able to read concurrently override it."""
+        return [(equipment, self.read(equipment, tags)) for equipment, tags in requests]
+
+    def close(self):
         pass
 
+class JsonScanDecoder():
+    """Decodes a JSON object of {plc_address : value} into tag readings."""
+
+    def __init__(self, tags):
+        self._tags = {tag['plc_address'] : (tag['name'], Converter.caster(tag['type'])) for tag in tags}
+
+    def decode(self, payload):
+        readings = {}
+
+        for address, value in json.loads(payload).items():
+            tag = self._tags.get(address)
+            if tag:
+                readings[tag[0]] = tag[1](value)
+
+        return readings
+
+class BinaryScanDecoder():
+    """Decodes a packed binary frame into tag readings in a single unpack.
+
+    The layout comes from the equipment's "scan" config:
+
+        "scan": {
+            "format": "binary",
+            "byte_order": "<",
+            "fields": [
+                {"plc_address": "voltage", "format": "f", "offset": 0},
+                {"plc_address": "good_pieces", "format": "I", "offset": 4}
+            ]
+        }
+
+    Field formats are struct format characters. Fields are sorted by offset
+    and the gaps between them become pad bytes, so the whole frame is read
+    by one precompiled struct.Struct straight from a memoryview.
+    """
+
+    def __init__(self, tags, layout):
+        names = {tag['plc_address'] : tag['name'] for tag in tags}
+        fields = sorted(layout['fields'], key=lambda field: field['offset'])
+
+        fmt = layout.get('byte_order', '<')
+        position = 0
+        self._names = []
+
+        for field in fields:
+            if field['plc_address'] not in names:
+                raise ValueError(f"Scan field '{field['plc_address']}' is not a tag of this equipment")
+            if field['offset'] < position:
+                raise ValueError(f"Scan field '{field['plc_address']}' overlaps the previous field")
+
+            if field['offset'] > position:
+                fmt += f"{field['offset'] - position}x"
+
+            fmt += field['format']
+            position = field['offset'] + struct.calcsize(layout.get('byte_order', '<') + field['format'])
+            self._names.append(names[field['plc_address']])
+
+        self._struct = struct.Struct(fmt)
+
+    def decode(self, payload):
+        frame = memoryview(payload)
+
+        if len(frame) < self._struct.size:
+            raise ValueError(f"frame has {len(frame)} bytes, layout needs {self._struct.size}")
+
+        return dict(zip(self._names, self._struct.unpack_from(frame)))
+
+def scan_decoder(equipment):
+    layout = equipment.scan or {'format' : 'json'}
+
+    match layout['format']:
+        case 'json':
+            return JsonScanDecoder(equipment.tags)
+        case 'binary':
+            return BinaryScanDecoder(equipment.tags, layout)
+        case _:
+            raise ValueError(f"Unknown scan format '{layout['format']}' for {equipment.name}")
+
 class MqttAdapter(CommunicationAdapter):
     
-    def __init__(self, equipments):
+    def __init__(self, equipments, on_reading=None):
         self._host = MQTT_BROKER
         self._port = MQTT_PORT
         self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self._client.on_message = self._on_message_callback
-        self._message_queues = {}
-        self.plc_address_map = {}
 
+        # full topic -> (equipment, tag name, caster), resolved once here so the
+        # callback does a single dict lookup per message
+        self._routes = {}
+        self._scan_routes = {}
+        self._unknown_topics = set()
+
+        # equipment name -> {tag name : latest value} since the last read().
+        # Bursts overwrite the same keys, so memory stays bounded by the tag count
+        self._latest = {}
+        self._latest_lock = Lock()
+        # equipment name -> arrival of the oldest value not read yet
+        self._received_at = {}
+
+        # event-driven mode: readings are decoded in the MQTT callback and handed
+        # straight to on_reading(equipment, readings) instead of being cached
+        self._on_reading = on_reading
+
+        self._connected = False
+
+        for equipment in equipments:
+            self._add_routes(equipment)
+
+    def _add_routes(self, equipment):
+        self._latest.setdefault(equipment.name, {})
+        self._scan_routes[f"/{equipment.name}/{SCAN_TOPIC}"] = (equipment, scan_decoder(equipment))
+        for tag in equipment.tags:  
+            topic = f"/{equipment.name}/{tag['plc_address']}"
+            self._routes[topic] = (equipment, tag['name'], Converter.caster(tag['type']))
+
+    def _remove_routes(self, equipment, keep=()):
+        prefix = f"/{equipment.name}/"
+        for routes in (self._routes, self._scan_routes):
+            for topic in [topic for topic in routes if topic.startswith(prefix) and topic not in keep]:
+                del routes[topic]
+        self._unknown_topics = {topic for topic in self._unknown_topics if not topic.startswith(prefix)}
+
+    def add_equipments(self, equipments):
+        """Starts routing and, once connected, subscribing to new equipments."""
+        for equipment in equipments:
+            self._add_routes(equipment)
+
+        if self._connected and equipments:
+            self._client.subscribe([(f"/{equipment.name}/#", 0) for equipment in equipments])
+
+    def remove_equipments(self, equipments):
+        for equipment in equipments:
+            self._remove_routes(equipment)
+            with self._latest_lock:
+                self._latest.pop(equipment.name, None)
+                self._received_at.pop(equipment.name, None)
+
+        if self._connected and equipments:
+            self._client.unsubscribe([f"/{equipment.name}/#" for equipment in equipments])
+
+    def update_equipments(self, equipments):
+        """Rebuilds the routes of reconfigured equipments, their subscription stays the same."""
         for equipment in equipments:
-            self._message_queues[equipment.name] = Queue()
-            for tag in equipment.tags:  
-                self.plc_address_map[tag['plc_address']] = {'name' : tag['name'], 'type' : tag['type']}
+            # add before removing, a message arriving meanwhile still finds its route
+            self._add_routes(equipment)
+            self._remove_routes(equipment, keep={f"/{equipment.name}/{SCAN_TOPIC}", *(f"/{equipment.name}/{tag['plc_address']}" for tag in equipment.tags)})
                 
     def connect(self, equipments):
         print(f"Connecting MQTT client to {self._host}...")
@@ -45,49 +197,540 @@ class MqttAdapter(CommunicationAdapter):
 
         self._client.subscribe(topics)
         self._client.loop_start()
+        self._connected = True
         print("MQTT client connected and listening.")
 
     def _on_message_callback(self, client, userdata, msg):
-        
+
+        route = self._routes.get(msg.topic)
+        if route is None:
+            if msg.topic in self._scan_routes:
+                self._on_scan(msg)
+            elif msg.topic not in self._unknown_topics:
+                self._unknown_topics.add(msg.topic)
+                print(f"Warning: Received message on unknown topic: {msg.topic}")
+            return
+
+        equipment, tag_name, caster = route
+
         try:
-            equip_name = msg.topic.split('/')[1]
-        except IndexError:
-            print(f"Warning: Could not parse equipment name from topic: {msg.topic}")
+            # float() and int() parse the raw bytes, no decode needed
+            value = caster(msg.payload)
+        except ValueError:
+            print(f"Warning: Could not parse {msg.payload!r} received on {msg.topic}")
             return
 
-        print(equip_name)
+        if self._on_reading:
+            self._on_reading(equipment, {tag_name : value})
+            return
 
-        if equip_name in self._message_queues:
-            self._message_queues[equip_name].put(msg)
-        else:
-            print(f"Warning: Received message for unknown equipment queue: {equip_name}")
-            print(self._message_queues)
-        
+        with self._latest_lock:
+            self._latest[equipment.name][tag_name] = value
+            self._received_at.setdefault(equipment.name, time.monotonic())
+
+    def _on_scan(self, msg):
+
+        equipment, decoder = self._scan_routes[msg.topic]
+
+        try:
+            readings = decoder.decode(msg.payload)
+        except (ValueError, TypeError, AttributeError, struct.error) as e:
+            print(f"Warning: Could not decode scan received on {msg.topic}: {e}")
+            return
+
+        if not readings:
+            return
+
+        if self._on_reading:
+            self._on_reading(equipment, readings)
+            return
+
+        with self._latest_lock:
+            self._latest[equipment.name].update(readings)
+            self._received_at.setdefault(equipment.name, time.monotonic())
         
-    def read(self, equipment=None):
-        readings = {}
+    def read(self, equipment=None, tags=None):
+
+        if not equipment or equipment.name not in self._latest:
+            return {} # Cannot read without knowing which equipment
+
+        with self._latest_lock:
+            if tags is None:
+                # swap the cache out instead of copying it: O(changed tags)
+                readings = self._latest[equipment.name]
+                self._latest[equipment.name] = {}
+                received_at = self._received_at.pop(equipment.name, None)
+            else:
+                # the values of the other tags wait for their own scan
+                latest = self._latest[equipment.name]
+                readings = {tag : latest.pop(tag) for tag in tags if tag in latest}
+                received_at = self._received_at.get(equipment.name) if readings else None
+                if not latest:
+                    self._received_at.pop(equipment.name, None)
+
+        if received_at is not None:
+            stage_latency['callback_to_read'].observe(time.monotonic() - received_at)
+
+        return readings
+
+
+# Modbus register types -> (struct format, registers)
+MODBUS_TYPES = {
+    'int16' : ('h', 1),
+    'uint16' : ('H', 1),
+    'int32' : ('i', 2),
+    'uint32' : ('I', 2),
+    'float32' : ('f', 2),
+}
+MODBUS_TABLES = ('holding', 'input')
+# registers a single read may return, by the Modbus spec
+MODBUS_MAX_REGISTERS = 125
+
+class ModbusBlock():
+    """One multi-register read and the struct decoding every tag it covers at once.
+
+    The registers are packed back into bytes in the equipment's byte order, with
+    the words of 32-bit values swapped first for a little word order, then a
+    single precompiled big-endian struct unpacks all the tags, skipping the gaps.
+    The values are then cast to their tag's type (``casters``: tag name -> caster).
+    """
+
+    def __init__(self, table, start, fields, byte_order='big', word_order='big', casters=None):
+        self.table = table
+        self.start = start
+        self.count = fields[-1][0] + MODBUS_TYPES[fields[-1][1]][1] - start
+        self.names = []
+        self._casters = []
+
+        fmt = '>'
+        position = start
+        order = list(range(self.count))
+
+        for address, kind, name in fields:
+            code, size = MODBUS_TYPES[kind]
+            if address > position:
+                fmt += f"{2 * (address - position)}x"
+            fmt += code
+            if size == 2 and word_order == 'little':
+                offset = address - start
+                order[offset], order[offset + 1] = order[offset + 1], order[offset]
+            position = address + size
+            self.names.append(name)
+            self._casters.append((casters or {}).get(name))
+
+        self._order = order if order != sorted(order) else None
+        self._registers = struct.Struct(('<' if byte_order == 'little' else '>') + f"{self.count}H")
+        self._fields = struct.Struct(fmt)
+
+    def decode(self, registers):
+        if self._order:
+            registers = [registers[index] for index in self._order]
+
+        values = self._fields.unpack_from(self._registers.pack(*registers))
+        return {name : value if caster is None else caster(value) for name, caster, value in zip(self.names, self._casters, values)}
+
+def plan_modbus_reads(equipment, tags=None, max_gap=None, max_registers=MODBUS_MAX_REGISTERS):
+    """Merges the registers of the equipment's tags (or only of ``tags``) into the fewest reads.
+
+    The register map comes from the equipment's "modbus" config:
+
+        "modbus": {
+            "port": 502,
+            "unit": 1,
+            "byte_order": "big",
+            "word_order": "big",
+            "max_gap": 8,
+            "registers": [
+                {"plc_address": "voltage", "address": 0, "type": "float32"},
+                {"plc_address": "good_pieces", "address": 2, "type": "uint32", "table": "input"}
+            ]
+        }
+
+    Registers of the same table closer than ``max_gap`` registers are read by
+    the same request, the unused registers in between costing less than a
+    round trip, as long as a request stays within ``max_registers``.
+    """
+    layout = equipment.config.get('modbus') or {}
+    names = {tag['plc_address'] : tag['name'] for tag in equipment.tags}
+    casters = {tag['name'] : Converter.caster(tag['type']) for tag in equipment.tags}
+    max_gap = layout.get('max_gap', 8) if max_gap is None else max_gap
+
+    fields = {}
+    for register in layout.get('registers', ()):
+        if register['plc_address'] not in names:
+            raise ValueError(f"Modbus register '{register['plc_address']}' is not a tag of {equipment.name}")
+        if register.get('type', 'uint16') not in MODBUS_TYPES:
+            raise ValueError(f"Unknown Modbus type '{register['type']}' for '{register['plc_address']}', expected one of {tuple(MODBUS_TYPES)}")
+        table = register.get('table', layout.get('table', 'holding'))
+        if table not in MODBUS_TABLES:
+            raise ValueError(f"Unknown Modbus table '{table}' for '{register['plc_address']}', expected one of {MODBUS_TABLES}")
+
+        if tags is not None and names[register['plc_address']] not in tags:
+            continue
+
+        fields.setdefault(table, []).append((int(register['address']), register.get('type', 'uint16'), names[register['plc_address']]))
+
+    blocks = []
+    for table, table_fields in fields.items():
+        table_fields.sort()
+        current = []
+        end = None
+
+        for field in table_fields:
+            address, kind, name = field
+            size = MODBUS_TYPES[kind][1]
+            if end is not None and address < end:
+                raise ValueError(f"Modbus register of '{name}' overlaps the previous one")
+
+            if current and (address - end > max_gap or address + size - current[0][0] > max_registers):
+                blocks.append(ModbusBlock(table, current[0][0], current, layout.get('byte_order', 'big'), layout.get('word_order', 'big'), casters))
+                current = []
+
+            current.append(field)
+            end = address + size
+
+        if current:
+            blocks.append(ModbusBlock(table, current[0][0], current, layout.get('byte_order', 'big'), layout.get('word_order', 'big'), casters))
+
+    return blocks
+
+class ModbusConnection():
+    """One Modbus TCP client shared by every equipment behind the same ip and port.
+
+    The client is created on first use and dropped after a failure, so the next
+    read reconnects. Reads are serialized: a Modbus TCP client handles one
+    transaction at a time.
+    """
+
+    def __init__(self, host, port=502, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._client = None
+        self._unit_keyword = None
+        self.lock = Lock()
+        self.failing = False
+
+    def _connect(self):
+        from pymodbus.client import ModbusTcpClient
+
+        client = ModbusTcpClient(self.host, port=self.port, timeout=self.timeout, retries=0)
+        if not client.connect():
+            client.close()
+            raise ConnectionError(f"can't connect to {self.host}:{self.port}")
+
+        # the unit id keyword was renamed in pymodbus 3.10
+        parameters = inspect.signature(client.read_holding_registers).parameters
+        self._unit_keyword = 'device_id' if 'device_id' in parameters else 'slave'
+        self._client = client
+
+    def read(self, block, unit):
+        """Returns the registers of ``block``, the caller holds ``lock``."""
+        if self._client is None:
+            self._connect()
+
+        function = self._client.read_holding_registers if block.table == 'holding' else self._client.read_input_registers
+
+        try:
+            response = function(block.start, count=block.count, **{self._unit_keyword : unit})
+        except Exception:
+            self.close()
+            raise
+
+        if response.isError():
+            raise IOError(f"{block.table} registers {block.start}-{block.start + block.count - 1}: {response}")
+
+        return response.registers
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+class ModbusAdapter(CommunicationAdapter):
+    """Reads equipments over Modbus TCP, for PLCs without an MQTT bridge.
+
+    Nothing polls in the background: ScanScheduler calls scan() at each tag's
+    scan rate. A scan reads its equipments concurrently, one task per
+    connection: equipments sharing an ip (and port) share one pooled connection
+    and are read one after the other on it. Each equipment's registers are read
+    with the fewest requests (see plan_modbus_reads) and decoded in bulk.
+
+    A scan returns what was read within ``scan_timeout`` seconds, a PLC slow to
+    answer (or to refuse a connection) doesn't hold up the others. Its late
+    results are dropped and its connection is left out of the scans until the
+    read in progress ends. Needs pymodbus, which is an optional dependency.
+    """
+
+    def __init__(self, equipments, workers=8, timeout=3.0, scan_timeout=0.5):
+        # pymodbus is imported by the first connection, only looked up here so
+        # a missing install fails at startup rather than at the first scan
+        if importlib.util.find_spec("pymodbus") is None:
+            raise ImportError("The Modbus adapter needs pymodbus, install it with 'pip install pymodbus'")
+
+        self.workers = workers
+        self.timeout = timeout
+        self.scan_timeout = scan_timeout
+
+        # equipment name -> (equipment, (ip, port), unit, blocks)
+        self._plans = {}
+        # (equipment name, tag names) -> blocks reading only those tags, for scan()
+        self._tag_plans = {}
+        # (ip, port) -> ModbusConnection
+        self._connections = {}
+        self._plans_lock = Lock()
+        # (ip, port) -> future of a read that outlived its scan
+        self._late = {}
+
+        self._executor = None
+
+        self.add_equipments(equipments)
+
+    def _plan(self, equipment):
+        layout = equipment.config.get('modbus') or {}
+        key = (equipment.ip, int(layout.get('port', 502)))
+        return equipment, key, int(layout.get('unit', 1)), plan_modbus_reads(equipment)
+
+    def add_equipments(self, equipments):
+        plans = [self._plan(equipment) for equipment in equipments]
+
+        with self._plans_lock:
+            for plan in plans:
+                self._plans[plan[0].name] = plan
+                self._forget_tag_plans(plan[0].name)
+                if plan[1] not in self._connections:
+                    self._connections[plan[1]] = ModbusConnection(*plan[1], timeout=self.timeout)
+
+    def _forget_tag_plans(self, name):
+        for key in [key for key in self._tag_plans if key[0] == name]:
+            del self._tag_plans[key]
+
+    def _close_unused(self):
+        with self._plans_lock:
+            used = {plan[1] for plan in self._plans.values()}
+            unused = [self._connections.pop(key) for key in list(self._connections) if key not in used]
+
+        for connection in unused:
+            with connection.lock:
+                connection.close()
+
+    def remove_equipments(self, equipments):
+        with self._plans_lock:
+            for equipment in equipments:
+                self._plans.pop(equipment.name, None)
+                self._forget_tag_plans(equipment.name)
+
+        self._close_unused()
+
+    def update_equipments(self, equipments):
+        """Plans the reads of reconfigured equipments again, their ip may have changed too."""
+        self.add_equipments(equipments)
+        self._close_unused()
+
+    def connect(self, equipments=None):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="modbus")
+        print(f"Reading {len(self._plans)} equipments over {len(self._connections)} Modbus connections")
+
+    def _read_connection(self, connection, reads):
+        """Reads (equipment, unit, blocks) one after the other on the connection,
+        returns [(equipment, readings)]; a failed equipment reads nothing."""
+        results = []
+
+        with connection.lock:
+            for equipment, unit, blocks in reads:
+                readings = {}
+                try:
+                    for block in blocks:
+                        readings.update(block.decode(connection.read(block, unit)))
+                except Exception as e:
+                    if not connection.failing:
+                        print(f"Warning: Modbus read of {equipment.name} at {connection.host}:{connection.port} failed: {e}")
+                    connection.failing = True
+                    readings = {}
+                else:
+                    connection.failing = False
+
+                results.append((equipment, readings))
+
+        return results
+
+    def scan(self, requests):
+        """Reads (equipment, tag names) requests right away, concurrently across
+        connections, and returns [(equipment, readings)]. Tag names None reads every tag."""
+        by_connection = {}
+
+        with self._plans_lock:
+            for equipment, tags in requests:
+                plan = self._plans.get(equipment.name)
+                if plan is None:
+                    continue
+
+                if tags is None:
+                    blocks = plan[3]
+                else:
+                    key = (equipment.name, tuple(tags))
+                    blocks = self._tag_plans.get(key)
+                    if blocks is None:
+                        blocks = self._tag_plans[key] = plan_modbus_reads(equipment, tags=set(tags))
+
+                connection = self._connections[plan[1]]
+                by_connection.setdefault(plan[1], (connection, []))[1].append((equipment, plan[2], blocks))
+
+        # a connection still busy with a late read would only queue more reads behind it
+        for key, future in list(self._late.items()):
+            if future.done():
+                del self._late[key]
+            else:
+                by_connection.pop(key, None)
+
+        futures = {key : self._executor.submit(self._read_connection, connection, reads) for key, (connection, reads) in by_connection.items()}
+        done, _ = wait(futures.values(), timeout=self.scan_timeout)
+
+        results = []
+        for key, future in futures.items():
+            if future in done:
+                results.extend(future.result())
+            else:
+                self._late[key] = future
+
+        return results
+
+    def read(self, equipment=None, tags=None):
 
         if not equipment:
-            return readings # Cannot read without knowing which equipment
+            return {}
 
-        # --- CHANGE 3: Read from the specific equipment's queue ---
-        equip_name = equipment.name
-        
-        # Get the correct queue for this equipment; return if not found.
-        target_queue = self._message_queues.get(equip_name)
-        if not target_queue:
+        for _, readings in self.scan([(equipment, tags)]):
             return readings
 
-        # Drain only the messages from this equipment's queue
-        while not target_queue.empty():
-            msg = target_queue.get()
-            plc_address = msg.topic.split("/")[-1]
+        return {}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+        for connection in list(self._connections.values()):
+            with connection.lock:
+                connection.close()
+
+
+def _parse_timestamp(value):
+    """Epoch seconds, or an ISO 8601 date and time."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(value).timestamp()
+
+def _open_history(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+def read_history(path):
+    """Streams (timestamp, equipment, tag, value) records from a CSV or JSONL file,
+    optionally gzipped, without loading it.
+
+    CSV needs a header with timestamp, equipment, tag and value columns. JSONL
+    lines are either one value, {"timestamp", "equipment", "tag", "value"}, or a
+    whole scan, {"timestamp", "equipment", "values" : {tag : value}}. Tags are
+    matched by name or by plc_address.
+    """
+    with _open_history(path) as f:
+
+        if path.endswith((".csv", ".csv.gz")):
+            rows = csv.reader(f)
+            header = next(rows)
+            columns = [header.index(column) for column in ("timestamp", "equipment", "tag", "value")]
+            for row in rows:
+                if row:
+                    timestamp, equipment, tag, value = (row[column] for column in columns)
+                    yield _parse_timestamp(timestamp), equipment, tag, value
+            return
+
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            timestamp = _parse_timestamp(record["timestamp"])
+            if "values" in record:
+                for tag, value in record["values"].items():
+                    yield timestamp, record["equipment"], tag, value
+            else:
+                yield timestamp, record["equipment"], record["tag"], record["value"]
+
+class ReplayAdapter(CommunicationAdapter):
+    """Plays recorded tag history back instead of reading the PLCs.
+
+    Records are streamed in file order, which must be chronological. The replay
+    driver moves the time forward with advance(); readings received up to then
+    are cached per equipment and returned by read(), like MqttAdapter does.
+    """
+
+    def __init__(self, equipments, path):
+        self.path = path
+        self._equipments = {equipment.name : equipment for equipment in equipments}
+
+        # (equipment name, tag name or plc address) -> (tag name, caster)
+        self._tags = {}
+        for equipment in equipments:
+            for tag in equipment.tags:
+                route = (tag['name'], Converter.caster(tag['type']))
+                self._tags[(equipment.name, tag['plc_address'])] = route
+                self._tags[(equipment.name, tag['name'])] = route
 
-            if plc_address in self.plc_address_map:
-                tag_name = self.plc_address_map[plc_address]['name']
-                payload = msg.payload.decode("utf-8")
-                readings[tag_name] = Converter.cast(payload, self.plc_address_map[plc_address]['type'])
-        
+        self._records = None
+        self._next = None
+        self._latest = {}
+        self.records = 0
+        self.skipped = 0
+
+    def connect(self):
+        self._records = read_history(self.path)
+        self._next = next(self._records, None)
+
+    def next_timestamp(self):
+        """Timestamp of the next record, None once the history is exhausted."""
+        return self._next[0] if self._next is not None else None
+
+    def advance(self, until):
+        """Consumes the records up to ``until`` and returns the equipments that
+        received readings, in the order they first did."""
+        touched = {}
+        latest = self._latest
+        record = self._next
+
+        while record is not None and record[0] <= until:
+            self.records += 1
+            timestamp, equipment_name, tag, value = record
+
+            route = self._tags.get((equipment_name, tag))
+            try:
+                if route is None:
+                    raise ValueError(f"unknown tag {tag!r}")
+                value = route[1](value)
+            except (ValueError, TypeError):
+                self.skipped += 1
+            else:
+                readings = latest.get(equipment_name)
+                if readings is None:
+                    readings = latest[equipment_name] = {}
+                readings[route[0]] = value
+                if equipment_name not in touched:
+                    touched[equipment_name] = self._equipments[equipment_name]
+
+            record = next(self._records, None)
+
+        self._next = record
+        return list(touched.values())
+
+    def read(self, equipment, tags=None):
+        readings = self._latest.pop(equipment.name, {})
+        if tags is not None:
+            # the values of the other tags wait for their own read
+            rest = {tag : value for tag, value in readings.items() if tag not in tags}
+            readings = {tag : value for tag, value in readings.items() if tag in tags}
+            if rest:
+                self._latest[equipment.name] = rest
         return readings
 
 
@@ -100,8 +743,7 @@ class PLCDataReader(CommunicationAdapter):
     def connect(self):
         print("Connected To PLC (MOCKED DATA)")
 
-    @update_prometheus_on_read
-    def read(self, equipment):
+    def read(self, equipment, tags=None):
         readings = {}
         eq_name = equipment.name
 
@@ -110,6 +752,8 @@ class PLCDataReader(CommunicationAdapter):
 
         for tag in equipment.tags:
             tag_name = tag['name']
+            if tags is not None and tag_name not in tags:
+                continue
             
             if tag_name not in self.simulation_state[eq_name]:
                 if "Temperatura" in tag_name:
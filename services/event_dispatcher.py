@@ -0,0 +1,165 @@
+from queue import Empty, Full, Queue
+import os
+import socket
+import threading
+import time
+
+from decorator.metric_decorator import dispatch_queue_depth, dispatch_rejected_counter, duplicate_publish_counter, stage_latency
+from services.outbox import mark_published_many, release_events, renew_leases
+
+_STOP = object()
+
+class EventDispatcher():
+    """Fixed pool of threads sending event batches through one publisher.
+
+    This is the direct-publish fast path of the outbox. Every batch is already
+    stored when it gets here, leased to ``owner`` for ``lease_seconds`` so the
+    relay leaves it alone. The lease is renewed right before the batch is sent,
+    so it outlasts the send whatever the batch waited in the queue; events the
+    relay took over meanwhile are not sent. A published batch is marked
+    published in one transaction. A batch that failed, was dropped or spilled
+    is handed back to OutboxRelay, which publishes it later.
+    What happens when the queue is full depends on the policy:
+
+    - ``block``: the generator waits for room in the queue
+    - ``drop_oldest``: the oldest queued batch is discarded to make room
+    - ``spill``: the new batch is not queued and is left to the relay
+    """
+
+    POLICIES = ("block", "drop_oldest", "spill")
+
+    def __init__(self, sender, workers : int = 4, max_queue_size : int = 100, policy : str = "block", lease_seconds : int = 60):
+
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown overload policy '{policy}', expected one of {self.POLICIES}")
+
+        # a send outlasting the lease lets the relay publish the batch a second time
+        send_timeout = getattr(sender, 'send_timeout', None)
+        if send_timeout is not None and lease_seconds <= send_timeout:
+            raise ValueError(f"The dispatch lease ({lease_seconds}s) must be longer than the publisher's send timeout ({send_timeout}s)")
+
+        self.sender = sender
+        self.policy = policy
+        # outbox lease owner of the stored batches, distinct from every relay worker
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-dispatch"
+        self.lease_seconds = lease_seconds
+        self._duplicates = duplicate_publish_counter.labels(path="dispatch")
+        self._queue = Queue(maxsize=max_queue_size)
+        self._rejected = dispatch_rejected_counter.labels(policy=policy)
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f"event-dispatcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, events) -> bool:
+        """Queues a batch for sending. Returns False if the batch was left to the relay."""
+
+        # queued with the time it was submitted, for the queue_wait stage
+        item = (events, time.monotonic())
+
+        if self.policy == "block":
+            self._queue.put(item)
+            dispatch_queue_depth.set(self._queue.qsize())
+            return True
+
+        try:
+            self._queue.put_nowait(item)
+            dispatch_queue_depth.set(self._queue.qsize())
+            return True
+        except Full:
+            pass
+
+        if self.policy == "spill":
+            self._reject(events)
+            return False
+
+        # drop_oldest
+        try:
+            dropped, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            self._reject(dropped)
+        except Empty:
+            pass
+
+        return self._put_or_reject(item)
+
+    def _put_or_reject(self, item) -> bool:
+        try:
+            self._queue.put_nowait(item)
+            dispatch_queue_depth.set(self._queue.qsize())
+            return True
+        except Full:
+            self._reject(item[0])
+            return False
+
+    def _reject(self, events):
+        self._rejected.inc(len(events))
+        self._release(events)
+
+    def _release(self, events, error=None):
+        """Hands the batch back to the relay instead of waiting for its lease to expire."""
+        try:
+            release_events(_ids(events), self.owner, error)
+        except Exception as e:
+            print(f"Could not release {len(events)} events, the relay takes them over when their lease expires: {e}")
+
+    def shutdown(self):
+        """Sends everything still queued, then stops the workers."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            # set explicitly rather than through set_function, which the
+            # multiprocess mode of the sharded runtime doesn't support
+            dispatch_queue_depth.set(self._queue.qsize())
+            try:
+                if item is _STOP:
+                    return
+
+                events, submitted_at = item
+                started = time.monotonic()
+                stage_latency['queue_wait'].observe(started - submitted_at)
+
+                # the relay claims rows whose lease expired, those it may have
+                # claimed while the batch was queued are left to it
+                try:
+                    held = set(renew_leases(_ids(events), self.owner, self.lease_seconds))
+                except Exception as e:
+                    print(f"Could not renew the lease of {len(events)} events, the relay takes them over when it expires: {e}")
+                    continue
+                events = [event for event in events if event.get('id') is None or event['id'] in held]
+                if not events:
+                    continue
+
+                try:
+                    self.sender.send_event(events)
+                except Exception as e:
+                    print(f"Error while sending {len(events)} events, the outbox relay will retry them: {e}")
+                    self._release(events, str(e) or type(e).__name__)
+                    continue
+
+                done = time.monotonic()
+                stage_latency['publish'].observe(done - started)
+                for event in events:
+                    if event.get('read_at') is not None:
+                        stage_latency['read_to_publish'].observe(done - event['read_at'])
+
+                ids = _ids(events)
+                confirmed = mark_published_many(ids, owner=self.owner)
+                if confirmed < len(ids):
+                    self._duplicates.inc(len(ids) - confirmed)
+            except Exception as e:
+                print(f"Error while confirming {len(events)} published events, the outbox relay may send them again: {e}")
+            finally:
+                self._queue.task_done()
+
+def _ids(events):
+    # events stored without a lease (no id) belong to the relay already
+    return [event['id'] for event in events if event.get('id') is not None]
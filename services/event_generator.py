@@ -1,95 +1,298 @@
-from datetime import datetime
-from threading import Event, Timer
-import threading
+from contextlib import contextmanager
+from threading import Condition, Event, Lock, Thread
+import heapq
 import time
 
-from asteval import Interpreter
-from services.outbox import store_event
+from services.event_dispatcher import EventDispatcher
+from services.outbox import store_events
 
-from decorator.metric_decorator import update_event_counter
+from decorator.metric_decorator import rule_evaluation_seconds, stage_latency, update_event_counter
 
 from models.equipment import Equipment
+from utils.codec import PayloadTemplate, get_codec
 
 class EventGenerator():    
 
-    def __init__(self, sender,  shutdown_event : Event):
+    def __init__(self, sender,  shutdown_event : Event, min_interval : float = 0.0, dispatcher : EventDispatcher = None, codec = None, engine = None,
+                 rule_timing : bool = False, clock = time.time, verbose : bool = True):
         self.sender = sender
         self.shutdown_event = shutdown_event
-        self.active_threads = []
+        # without a sender (replay), events are only returned, never dispatched
+        self.dispatcher = dispatcher or (EventDispatcher(sender) if sender is not None else None)
+        # thread of the timer mode started by start(), stopped by shutdown()
+        self.timer = None
+        self._stopped = Event()
+
+        # source of the events' timestamps, a replay steps a virtual clock instead
+        self.clock = clock
+        # prints every evaluated rule and event
+        self.verbose = verbose
+
+        # optional ColumnarEngine evaluating the timer cycle vectorized
+        self.engine = engine
+
+        # equipment name -> (metadata, PayloadTemplate) built from that metadata
+        self.codec = codec or get_codec()
+        self._templates = {}
+
+        # event-driven mode: minimum time between two evaluations of the same
+        # equipment. Readings arriving inside that window are coalesced into
+        # one evaluation scheduled at the end of it. notify() only queues the
+        # evaluation, one long-lived worker thread runs it: the callers (MQTT's
+        # network thread) never wait for the rules, the outbox or the dispatcher
+        self.min_interval = min_interval
+        self._last_evaluation = {}
+        # (due, sequence, equipment) of the queued evaluations, and their equipment names
+        self._pending = []
+        self._scheduled = set()
+        self._sequence = 0
+        self._schedule_lock = Lock()
+        self._schedule_changed = Condition(self._schedule_lock)
+        self._worker = None
+        self._evaluation_lock = Lock()
+
+        # times every rule into rule_evaluation_seconds, off by default since
+        # timing a native rule costs more than evaluating it
+        self.rule_timing = rule_timing
+        self._rule_histograms = {}
 
     @update_event_counter
-    def evaluate_rules(self, interpreter : Interpreter, timespan, equipments):
+    def evaluate_rules(self, interpreter, timespan, equipments):
 
         if self.shutdown_event.is_set():
             print("Shutdown detected, stopping rule evaluation.")
-            return
+            return []
        
-        events = []
-
-        for equipment in equipments:
+        events = self.evaluate(equipments)
             
-            if equipment.tags[0]['name'] not in equipment.symtable:
-                continue
+        self.dispatch(events)
 
-            interpreter.symtable.update(equipment.symtable)
-            for rule in equipment.rules:
-                
-                print(f"\n ---------- Evaluating Rule : {rule['name']} ----------------")
-                triggered = interpreter.run(rule['expression'])
+        return events
 
-                if triggered and rule['state'] != triggered:
-                    event = self._create_event_payload(rule, equipment)
-                    events.append(event)
-                    store_event(event['event_name'], event['metadata'], event['timestamp'])
-                    print(event)
+    def evaluate(self, equipments):
+        """Evaluates the equipments once and returns the new events, without dispatching them."""
+        events = []
 
-                rule['state'] = triggered
-                
-                # if triggered:
-                #     event = self._create_event_payload(rule, equipment)
-                #     events.append(event)
-                #     print(event)
-            
-        self._cleanup_finished_threads()
+        if self.engine:
+            with self._evaluation_lock:
+                for equipment, rule, read_at in self.engine.evaluate():
+                    events.append(self._create_event(rule, equipment, read_at))
+        else:
+            for equipment in equipments:
+                events.extend(self._evaluate_equipment(equipment))
+
+        return events
 
-        ## SERVICE BUS CALL. BACKGROUND TASK USING A LIGHTWEIGHT THREAD
-        if events:
-            thread = threading.Thread(target=self.sender.send_event, kwargs={'events' : events})
-            thread.start()
+    @update_event_counter
+    def evaluate_equipments(self, equipments):
+        """ScanScheduler callback: evaluates the equipments a scan just read and
+        dispatches their events together."""
+
+        if self.shutdown_event.is_set():
+            return []
 
-        # scheduling new rule evaluation
-        if not self.shutdown_event.is_set():
-            self.timer = Timer(timespan, self.evaluate_rules, kwargs={'interpreter' : interpreter, 'timespan' : timespan, 'equipments' : equipments})
-            self.timer.daemon = True
-            self.timer.start()
+        events = self.evaluate(equipments)
+        self.dispatch(events)
 
         return events
 
+    def on_reading(self, equipment : Equipment, readings):
+        """Communication adapter callback used in event-driven mode."""
+        equipment.update_values(readings)
+        self.notify(equipment)
+
+    def notify(self, equipment : Equipment):
+        """Queues an evaluation of the equipment, due now or ``min_interval``
+        after its previous one. Returns without evaluating anything."""
+
+        if self.shutdown_event.is_set():
+            return
+
+        with self._schedule_lock:
+            if equipment.name in self._scheduled:
+                # the pending evaluation will pick this reading up
+                return
+
+            due = max(time.monotonic(), self._last_evaluation.get(equipment.name, float('-inf')) + self.min_interval)
+            self._sequence += 1
+            heapq.heappush(self._pending, (due, self._sequence, equipment))
+            self._scheduled.add(equipment.name)
+
+            if self._worker is None:
+                self._worker = Thread(target=self._run_notified, name="event-evaluator", daemon=True)
+                self._worker.start()
+            self._schedule_changed.notify()
+
+    @contextmanager
+    def paused(self):
+        """Holds every evaluation off until the block exits, e.g. while a config
+        reload swaps the rules, thresholds and windows of the equipments."""
+        with self._evaluation_lock:
+            yield
+
     def start(self, interpreter, timespan, equipments):
+        """Evaluates the equipments now, then every ``timespan`` seconds on one
+        long-lived thread, which keeps its outbox connection from cycle to cycle."""
         print("Starting event generator...")
         self.evaluate_rules(interpreter, timespan, equipments)
 
+        self.timer = Thread(target=self._run_timer, args=(interpreter, timespan, equipments), name="event-generator-timer", daemon=True)
+        self.timer.start()
+
+    def _run_timer(self, interpreter, timespan, equipments):
+        while not (self._stopped.wait(timespan) or self.shutdown_event.is_set()):
+            try:
+                self.evaluate_rules(interpreter, timespan, equipments)
+            except Exception as e:
+                # the next cycle runs anyway
+                print(f"Error while evaluating the rules: {e}")
+
     def shutdown(self):
 
+        self._stopped.set()
         if self.timer:
-            self.timer.cancel()
-            
-        for thread in self.active_threads:
-            thread.join()
+            self.timer.join()
+
+        with self._schedule_lock:
+            self._pending.clear()
+            self._scheduled.clear()
+            worker, self._worker = self._worker, None
+            self._schedule_changed.notify()
+        if worker is not None:
+            worker.join()
 
-        self.sender.close()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        if self.sender is not None:
+            self.sender.close()
     
-    def _create_event_payload(self, rule, equipment : Equipment):
+    def _run_notified(self):
+        """Evaluation worker of the event-driven mode: runs the queued
+        evaluations as they come due, those due together in one batch."""
+
+        while not self.shutdown_event.is_set():
+            with self._schedule_lock:
+                if self._worker is None:
+                    return
+
+                now = time.monotonic()
+                if not self._pending or self._pending[0][0] > now:
+                    # woken by notify() or shutdown(), and at least every 0.5 s to see the shutdown event
+                    self._schedule_changed.wait(min(self._pending[0][0] - now, 0.5) if self._pending else 0.5)
+                    continue
 
-        event = {
+                due = []
+                while self._pending and self._pending[0][0] <= now:
+                    equipment = heapq.heappop(self._pending)[2]
+                    self._scheduled.discard(equipment.name)
+                    self._last_evaluation[equipment.name] = now
+                    due.append(equipment)
+
+            try:
+                self.evaluate_equipments(due)
+            except Exception as e:
+                print(f"Error while evaluating {[equipment.name for equipment in due]}: {e}")
+
+    def _evaluate_equipment(self, equipment : Equipment):
+
+        events = []
+
+        if equipment.tags[0]['name'] not in equipment.symtable:
+            return events
+
+        with self._evaluation_lock:
+
+            started = time.monotonic()
+            dirty, read_at = equipment.pop_dirty()
+            if read_at is not None:
+                stage_latency['read_to_evaluate'].observe(started - read_at)
+
+            # threshold rules come out of the tags' indexes already resolved
+            for rule, triggered in equipment.flipped_rules(dirty):
+                if triggered:
+                    event = self._create_event(rule, equipment, read_at)
+                    events.append(event)
+                    if self.verbose:
+                        print(event)
+
+                rule['state'] = triggered
+
+            # only rules reading a tag that changed since the last cycle can flip
+            for rule in equipment.rules_for(dirty):
+                
+                if self.verbose:
+                    print(f"\n ---------- Evaluating Rule : {rule['name']} ----------------")
+                if self.rule_timing:
+                    rule_started = time.perf_counter()
+                    triggered = rule['expression'](equipment.symtable)
+                    self._rule_histogram(rule['name']).observe(time.perf_counter() - rule_started)
+                else:
+                    triggered = rule['expression'](equipment.symtable)
+
+                if triggered and rule['state'] != triggered:
+                    event = self._create_event(rule, equipment, read_at)
+                    events.append(event)
+                    if self.verbose:
+                        print(event)
+
+                rule['state'] = triggered
+
+            stage_latency['evaluate'].observe(time.monotonic() - started)
+
+        return events
+
+    def _rule_histogram(self, rule_name):
+        histogram = self._rule_histograms.get(rule_name)
+        if histogram is None:
+            histogram = self._rule_histograms[rule_name] = rule_evaluation_seconds.labels(rule=rule_name)
+        return histogram
+
+    def dispatch(self, events):
+        """Stores the events in the outbox and hands them to the dispatch pool."""
+
+        if not events:
+            return
+
+        # every event of the cycle goes to the outbox in one transaction. Events
+        # the dispatch pool is about to publish are stored leased to it, so the
+        # relay only gets those it fails to publish or to confirm
+        started = time.monotonic()
+        if self.dispatcher is not None:
+            ids = store_events(events, lease_owner=self.dispatcher.owner, lease_seconds=self.dispatcher.lease_seconds)
+            for event, event_id in zip(events, ids):
+                event['id'] = event_id
+        else:
+            store_events(events)
+        stage_latency['outbox_insert'].observe(time.monotonic() - started)
+
+        ## SERVICE BUS CALL. BACKGROUND TASK ON THE DISPATCH POOL
+        if self.dispatcher is not None:
+            self.dispatcher.submit(events)
+
+    def _create_event(self, rule, equipment : Equipment, read_at : float = None):
+
+        timestamp = int(self.clock())
+
+        # same shape as the events OutboxRelay publishes, the body is encoded
+        # once here and sent as-is by the outbox and the publishers
+        return {
             "event_name": rule['name'],
-            "timestamp": int(datetime.now().timestamp()),
-            "metadata" : metadata
+            "routing_key": rule['routing_key'],
+            "created_at": timestamp,
+            "content_type": self.codec.content_type,
+            "body": self._create_event_payload(rule, equipment, timestamp),
+            # time.monotonic() of the reading that triggered it, for the latency metrics
+            "read_at": read_at
         }
 
-        if rule['output'] : event['data'] =  {rule['output'] : equipment.symtable.get(rule['output'])}
-    
-        return event
-    
-    def _cleanup_finished_threads(self):
-        self.active_threads = [t for t in self.active_threads if t.is_alive()]
+    def _create_event_payload(self, rule, equipment : Equipment, timestamp : int) -> bytes:
+
+        metadata, template = self._templates.get(equipment.name, (None, None))
+
+        if metadata is not equipment.metadata:
+            template = PayloadTemplate(self.codec, equipment.metadata)
+            self._templates[equipment.name] = (equipment.metadata, template)
+
+        data = {rule['output'] : equipment.symtable.get(rule['output'])} if rule['output'] else None
+
+        return template.encode(rule['name'], timestamp, data)
@@ -1,13 +1,22 @@
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from queue import Empty, Full, Queue
+import threading
 import time
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
 import os
-import json
-import pika
 from dotenv import load_dotenv
 
+from decorator.metric_decorator import duplicate_publish_counter
+
+# The broker SDKs (pika, azure-servicebus) are imported by the publisher that
+# needs them, only the configured backend pays for its import at startup.
+
 class EventPublisher(ABC):
 
+    # longest a send_event may take before it returns or raises, None if unbounded
+    send_timeout = None
+
     @abstractmethod
     def send_event(self, events):
         pass
@@ -18,12 +27,14 @@ class EventPublisher(ABC):
 
 class MockEventPublisher(EventPublisher):
 
+    send_timeout = 1.5
+
     def __init__(self):
         print("CONNECTED TO FAKE BROKER")
 
     def send_event(self, events):
         for event in events:
-            print(f'{event['event_name']} succefully sent')
+            print(f"{event['event_name']} succefully sent")
         time.sleep(1.5)
 
     def close(self):
@@ -31,44 +42,381 @@ class MockEventPublisher(EventPublisher):
         time.sleep(1)
         print("Connection Closed")
 
+class PublishError(Exception):
+    pass
+
+class PikaTransport():
+    """Runs a pika SelectConnection in confirm mode on the calling thread.
+
+    This is the only part of RabbitMQEventPublisher talking to pika, so an
+    in-process stand-in implementing run/call_soon/publish/close, like
+    LoopbackTransport, can replace it.
+    """
+
+    def __init__(self, parameters, exchange):
+        import pika
+        self._pika = pika
+        self.parameters = parameters
+        self.exchange = exchange
+        self._connection = None
+        self._channel = None
+        self._delivery_tag = 0
+        self._properties = {}
+
+    def run(self, on_ready, on_confirm, on_closed):
+        """Connects and runs the I/O loop until the connection closes."""
+
+        def on_channel_open(channel):
+            self._channel = channel
+            self._delivery_tag = 0
+            channel.add_on_close_callback(lambda ch, reason: self.close())
+            channel.confirm_delivery(
+                lambda frame: on_confirm(
+                    frame.method.delivery_tag,
+                    frame.method.multiple,
+                    isinstance(frame.method, self._pika.spec.Basic.Ack)
+                ),
+                callback=lambda frame: on_ready()
+            )
+
+        def stop(connection, reason):
+            self._channel = None
+            connection.ioloop.stop()
+            on_closed(reason)
+
+        self._connection = self._pika.SelectConnection(
+            self.parameters,
+            on_open_callback=lambda connection: connection.channel(on_open_callback=on_channel_open),
+            on_open_error_callback=stop,
+            on_close_callback=stop,
+        )
+        self._connection.ioloop.start()
+
+    def call_soon(self, callback):
+        """Thread-safe: runs callback on the I/O thread."""
+        self._connection.ioloop.add_callback_threadsafe(callback)
+
+    def publish(self, routing_key, body, content_type='application/json'):
+        properties = self._properties.get(content_type)
+        if properties is None:
+            properties = self._properties[content_type] = self._pika.BasicProperties(content_type=content_type, delivery_mode=2)
+
+        self._channel.basic_publish(self.exchange, routing_key, body, properties=properties)
+        self._delivery_tag += 1
+        return self._delivery_tag
+
+    def close(self):
+        if self._connection and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+class LoopbackTransport():
+    """In-process stand-in for PikaTransport, to run RabbitMQEventPublisher
+    without a broker (tests, benchmarks).
+
+    run() is the I/O loop, on the publisher's thread. Every publish is confirmed
+    from that loop according to ``confirm``: 'ack', 'nack', or None to hold the
+    confirm until confirm_held(). drop() ends the connection like a broker
+    restart, the first ``refused`` connection attempts fail.
+    """
+
+    def __init__(self, confirm='ack', refused=0):
+        self.confirm = confirm
+        self.refused = refused
+        self.connections = 0
+        # (routing_key, body, content_type) of every publish, re-sends included
+        self.published = []
+        # same, for the acknowledged ones
+        self.acked = []
+        self._loop = None
+        self._open = False
+        self._delivery_tag = 0
+        self._unconfirmed = {}
+        self._held = []
+
+    def run(self, on_ready, on_confirm, on_closed):
+        self.connections += 1
+        if self.refused:
+            self.refused -= 1
+            raise ConnectionError("connection refused")
+
+        # delivery tags and unconfirmed messages don't survive a connection
+        self._loop = loop = Queue()
+        self._on_confirm = on_confirm
+        self._delivery_tag = 0
+        self._unconfirmed = {}
+        self._held = []
+        self._open = True
+
+        on_ready()
+        while (callback := loop.get()) is not None:
+            callback()
+        on_closed("connection dropped")
+
+    def call_soon(self, callback):
+        """Thread-safe: runs callback on the I/O thread."""
+        if not self._open:
+            raise ConnectionError("not connected")
+        self._loop.put(callback)
+
+    def publish(self, routing_key, body, content_type='application/json'):
+        self._delivery_tag += 1
+        tag = self._delivery_tag
+        self._unconfirmed[tag] = (routing_key, body, content_type)
+        self.published.append(self._unconfirmed[tag])
+
+        if self.confirm is None:
+            self._held.append(tag)
+        else:
+            ack = self.confirm == 'ack'
+            self._loop.put(lambda: self._confirm(tag, False, ack))
+        return tag
+
+    def confirm_held(self, ack=True):
+        """Thread-safe: confirms every held message at once, as one multiple ack (or nack)."""
+        def confirm():
+            if self._held:
+                tag, self._held = self._held[-1], []
+                self._confirm(tag, True, ack)
+        self.call_soon(confirm)
+
+    def _confirm(self, tag, multiple, ack):
+        tags = [t for t in self._unconfirmed if t <= tag] if multiple else [tag]
+        for t in tags:
+            message = self._unconfirmed.pop(t)
+            if ack:
+                self.acked.append(message)
+        self._on_confirm(tag, multiple, ack)
+
+    def drop(self):
+        """Thread-safe: closes the connection, unconfirmed messages are lost."""
+        if self._open:
+            self._open = False
+            self._loop.put(None)
+
+    def close(self):
+        self.drop()
+
 class RabbitMQEventPublisher(EventPublisher):
+    """Publishes from one dedicated I/O thread that owns the AMQP connection.
 
-    def __init__(self):
+    Callers only touch a bounded queue, which blocks them for up to
+    ``enqueue_timeout`` when the broker falls behind, then fails. The I/O thread
+    publishes in batches with up to ``max_in_flight`` unconfirmed messages,
+    resolves each message's future on the broker's ack/nack, and reconnects on
+    failure, re-sending anything left unconfirmed.
+
+    A send_event that fails or times out abandons its messages: the ones still
+    queued are never published, since the caller hands them to someone else
+    (the outbox relay). Only the ones already on the wire may still reach the broker.
+    """
+
+    def __init__(
+        self,
+        exchange='events',
+        max_queue_size=10000,
+        batch_size=100,
+        max_in_flight=1000,
+        confirm_timeout=30.0,
+        enqueue_timeout=5.0,
+        reconnect_delay=5.0,
+        transport=None,
+    ):
         load_dotenv()
-        host = os.getenv("RABBIT_URL")
-    
-        print("Connecting to RMQ")
+        host = os.getenv("RABBIT_URL", "localhost")
 
-        try:
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.confirm_timeout = confirm_timeout
+        self.enqueue_timeout = enqueue_timeout
+        self.send_timeout = enqueue_timeout + confirm_timeout
+        self.reconnect_delay = reconnect_delay
+        if transport is None:
+            import pika
+            transport = PikaTransport(pika.ConnectionParameters(host=host), exchange)
+        self._transport = transport
 
-            parameters = pika.ConnectionParameters(host=host)
-            self.connection = pika.BlockingConnection(parameters=parameters)
+        self._queue = Queue(maxsize=max_queue_size)
+        # only touched from the I/O thread
+        self._in_flight = {}
+        self._retry = deque()
 
-            self.channel = self.connection.channel()
+        self._ready = False
+        self._running = True
+        self._drain_scheduled = False
+        self._late_confirms = duplicate_publish_counter.labels(path="late_confirm")
 
-        except Exception as e:
-            print("Error while connecting")
+        print("Connecting to RMQ")
+        self._thread = threading.Thread(target=self._run, name="rabbitmq-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, events):
+        """Queues the events and returns one Future per event, resolved on broker confirm.
+
+        Raises PublishError when the queue stays full for ``enqueue_timeout``,
+        the events queued by this call are then abandoned.
+        """
+        futures = []
 
-        print("success")
+        for event in events:
+            future = Future()
+            try:
+                self._queue.put((event.get('routing_key', ''), event['body'], event['content_type'], future), timeout=self.enqueue_timeout)
+            except Full:
+                self._abandon(futures)
+                raise PublishError(f"Publish queue still full after {self.enqueue_timeout}s, the broker is not keeping up")
+            futures.append(future)
 
+        self._wake()
+        return futures
 
     def send_event(self, events):
-        
+        futures = self.publish(events)
+        deadline = time.monotonic() + self.confirm_timeout
 
-        for event in events:
-            self.channel.basic_publish(
-                exchange='events',
-                routing_key='',
-                body=json.dumps(event)
-            )
+        try:
+            for future in futures:
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except Exception:
+            self._abandon(futures)
+            raise
+
+    def _abandon(self, futures):
+        """Gives up on the futures: a queued one is cancelled so the I/O thread
+        skips it, one already published is failed so its confirm is ignored."""
+        error = PublishError("Abandoned by the caller before the broker confirmed the message")
+        for future in futures:
+            if not future.cancel():
+                _fail(future, error)
 
     def close(self):
-        self.connection.close()
+        deadline = time.monotonic() + self.confirm_timeout
+        while (not self._queue.empty() or self._in_flight) and self._ready and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self._running = False
+        if self._ready:
+            self._transport.call_soon(self._transport.close)
+        self._thread.join(timeout=self.confirm_timeout)
+
+    def _wake(self):
+        if self._ready and not self._drain_scheduled:
+            self._drain_scheduled = True
+            try:
+                self._transport.call_soon(self._drain)
+            except Exception:
+                # the connection is going down, _on_ready drains after reconnecting
+                self._drain_scheduled = False
+
+    # --- I/O thread -------------------------------------------------------
+
+    def _run(self):
+        try:
+            while self._running:
+                try:
+                    self._transport.run(self._on_ready, self._on_confirm, self._on_closed)
+                except Exception as e:
+                    print(f"RMQ connection error: {e}")
+                finally:
+                    # however the connection ended, its delivery tags are gone
+                    self._ready = False
+                    self._drain_scheduled = False
+                    self._requeue_in_flight()
+
+                if self._running:
+                    time.sleep(self.reconnect_delay)
+        finally:
+            error = PublishError("Publisher closed before the broker confirmed the message")
+            for *_, future in list(self._in_flight.values()) + list(self._retry) + list(self._queue.queue):
+                _fail(future, error)
+            self._in_flight.clear()
+            self._retry.clear()
+
+    def _on_ready(self):
+        print("RMQ connected, confirm mode enabled")
+        self._ready = True
+        self._drain()
+
+    def _on_closed(self, reason):
+        self._ready = False
+        self._drain_scheduled = False
+        if self._running:
+            print(f"RMQ connection closed ({reason}), reconnecting in {self.reconnect_delay}s")
+        self._requeue_in_flight()
+
+    def _requeue_in_flight(self):
+        # delivery tags restart with the next channel, re-send what wasn't confirmed
+        self._retry.extend(self._in_flight.values())
+        self._in_flight.clear()
+
+    def _drain(self):
+        self._drain_scheduled = False
+        if not self._ready:
+            return
+
+        published = 0
+        while published < self.batch_size and len(self._in_flight) < self.max_in_flight:
+            if self._retry:
+                item = self._retry.popleft()
+                if item[3].done():
+                    # abandoned since it was first sent
+                    continue
+            else:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if not item[3].set_running_or_notify_cancel():
+                    # abandoned while queued
+                    continue
+
+            routing_key, body, content_type, _ = item
+            self._in_flight[self._transport.publish(routing_key, body, content_type)] = item
+            published += 1
+
+        # let the I/O loop flush and read confirms before the next batch
+        if published == self.batch_size:
+            self._wake()
+
+    def _on_confirm(self, delivery_tag, multiple, ack):
+        if multiple:
+            tags = [tag for tag in self._in_flight if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._in_flight else []
+
+        for tag in tags:
+            *_, future = self._in_flight.pop(tag)
+            if ack:
+                if not _resolve(future, tag):
+                    # the caller gave up and handed the event to someone else, who
+                    # publishes it again
+                    self._late_confirms.inc()
+            else:
+                _fail(future, PublishError("Message rejected by the broker"))
+
+        self._drain()
+
+def _resolve(future, result):
+    """Sets the result unless the caller abandoned the future, returns whether it did."""
+    try:
+        future.set_result(result)
+        return True
+    except InvalidStateError:
+        return False
+
+def _fail(future, error):
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        # already resolved, failed or cancelled
+        pass
 
 
 class AzureEventPublisher(EventPublisher):
 
     def __init__(self):
+        from azure.servicebus import ServiceBusClient, ServiceBusMessage
+        self._message_type = ServiceBusMessage
+
         load_dotenv()
         connection_string = os.getenv("SERVICE_BUS_CONNECTION_STRING")
         topic_name = os.getenv("SERVICE_BUS_TOPIC_NAME")
@@ -84,7 +432,7 @@ class AzureEventPublisher(EventPublisher):
             batch = self.sender.create_message_batch()
             for event in events:
 
-                message = ServiceBusMessage(json.dumps(event))
+                message = self._message_type(event['body'], content_type=event['content_type'], subject=event.get('routing_key') or None)
                 
                 try:
 
@@ -98,10 +446,11 @@ class AzureEventPublisher(EventPublisher):
 
             if batch:
                 self.sender.send_messages(batch)
-            
 
         except Exception as e:
+            # raised so the caller hands the events back to the outbox relay
             print(f"Error sending event batch to Azure: {e}")
+            raise
 
     def close(self):
         print("Closing Azure Service Bus sender...")
@@ -109,3 +458,21 @@ class AzureEventPublisher(EventPublisher):
         self.client.close()
         print("Azure sender closed.")
 
+_PUBLISHERS = {
+    'rabbitmq': RabbitMQEventPublisher,
+    'azure': AzureEventPublisher,
+    'mock': MockEventPublisher,
+}
+
+def register_publisher(name : str, factory) -> None:
+    """Makes another backend available to get_publisher()."""
+    _PUBLISHERS[name] = factory
+
+def get_publisher(name : str = None, **kwargs) -> EventPublisher:
+    """Creates the publisher named by ``name`` or the EVENT_PUBLISHER env var (default "rabbitmq")."""
+    name = name or os.getenv("EVENT_PUBLISHER", "rabbitmq")
+
+    if name not in _PUBLISHERS:
+        raise ValueError(f"Unknown event publisher '{name}', expected one of {list(_PUBLISHERS)}")
+
+    return _PUBLISHERS[name](**kwargs)
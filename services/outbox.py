@@ -1,104 +1,572 @@
+import base64
 import datetime
 import json
 import os
 import random
 import sqlite3
+import threading
 import time
 from contextlib import contextmanager
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 DB_PATH =  os.getenv("OUTBOX_DB_PATH", "outbox.db")
 
+# Applied to every connection when it is opened. cache_size is in KiB when negative.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+}
+
+# one long-lived connection per thread and database file, the schema is only
+# created once per process and file
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
 _SCHEMA = [
     """
     CREATE TABLE IF NOT EXISTS outbox_events (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         event_name TEXT NOT NULL,
-        payload_json TEXT NOT NULL,
+        payload BLOB NOT NULL,
         created_at INTEGER NOT NULL,
         published_at INTEGER NULL,
         attempts INTEGER NOT NULL DEFAULT 0,
         last_error TEXT NULL,
         status TEXT NOT NULL DEFAULT 'pending',
-        next_retry_at INTEGER NOT NULL DEFAULT 0
+        next_retry_at INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT NULL,
+        lease_expires_at INTEGER NULL,
+        routing_key TEXT NOT NULL DEFAULT '',
+        content_type TEXT NOT NULL DEFAULT 'application/json'
     );
     """,
     """
     CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox_events(status, next_retry_at);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_outbox_lease ON outbox_events(status, lease_expires_at);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_outbox_published ON outbox_events(published_at) WHERE status = 'published';
     """
 ]
 
+# columns changed after the first release, applied to databases that predate them
+_RENAMED_COLUMNS = {
+    "payload_json": "payload",
+}
+
+_ADDED_COLUMNS = {
+    "lease_owner": "TEXT NULL",
+    "lease_expires_at": "INTEGER NULL",
+    "routing_key": "TEXT NOT NULL DEFAULT ''",
+    "content_type": "TEXT NOT NULL DEFAULT 'application/json'",
+}
+
+# wakes up relay workers of this process as soon as events are stored
+_stored = threading.Condition()
+
+def init_db(**pragmas: Any) -> None:
+    """Creates the schema up front, optionally overriding PRAGMAS (e.g. synchronous="FULL")."""
+    PRAGMAS.update(pragmas)
+    close()
+    with _conn():
+        pass
+
+def close() -> None:
+    """Closes the calling thread's connections."""
+    for conn in getattr(_local, "conns", {}).values():
+        conn.close()
+    _local.conns = {}
+
 @contextmanager
-def _conn():
-    conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None) 
+def database(path: str):
+    """Points the outbox functions called by this thread at another database file,
+    e.g. one shard of a sharded runtime."""
+    previous = getattr(_local, "db_path", None)
+    _local.db_path = path
     try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        for statement in _SCHEMA:
-            conn.execute(statement)
-        yield conn
+        yield
     finally:
-        conn.close()
+        _local.db_path = previous
+
+def _db_path() -> str:
+    return getattr(_local, "db_path", None) or DB_PATH
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    # before anything else: a new database only gets it until its file is
+    # created, which journal_mode=WAL already does. Older databases are
+    # converted by the first vacuum() of the retention job
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value};")
+
+    with _schema_lock:
+        if path not in _schema_ready:
+            _ensure_schema(conn)
+            _schema_ready.add(path)
+
+    return conn
 
-def store_event(event_name: str, payload: Dict[str, Any], created_at: datetime) -> int:
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    table, indexes = _SCHEMA[0], _SCHEMA[1:]
+
+    conn.execute(table)
+
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(outbox_events)")}
+    for old, new in _RENAMED_COLUMNS.items():
+        if old in existing:
+            conn.execute(f"ALTER TABLE outbox_events RENAME COLUMN {old} TO {new}")
+            existing.add(new)
+
+    for column, definition in _ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE outbox_events ADD COLUMN {column} {definition}")
+
+    for statement in indexes:
+        conn.execute(statement)
+
+@contextmanager
+def _conn():
+    path = _db_path()
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _connect(path)
+    yield conn
+
+@contextmanager
+def _transaction():
     with _conn() as conn:
-        cur = conn.execute(
-            "INSERT INTO outbox_events (event_name, payload_json, created_at) VALUES (?, ?, ?)",
-            (event_name, json.dumps(payload, ensure_ascii=False), created_at),
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def _as_bytes(payload: Any) -> bytes:
+    # rows written before payloads were stored as BLOBs come back as TEXT
+    return payload.encode("utf-8") if isinstance(payload, str) else payload
+
+def store_events(events: List[Dict[str, Any]], lease_owner: Optional[str] = None, lease_seconds: int = 30) -> List[int]:
+    """Stores a batch of events in a single transaction and returns their ids, in order.
+
+    Events have the shape EventGenerator creates and OutboxRelay publishes:
+    event_name, routing_key, created_at, content_type and the encoded body.
+
+    With a ``lease_owner`` the rows are stored already claimed by it, 'in_flight'
+    for ``lease_seconds``: the direct-publish path keeps the relay off the events
+    it is about to publish, and the relay only gets them if the lease expires.
+    """
+    if not events:
+        return []
+
+    status = 'in_flight' if lease_owner else 'pending'
+    lease_expires_at = int(time.time()) + lease_seconds if lease_owner else None
+    rows = [
+        (event["event_name"], event["body"], event["created_at"], event.get("routing_key", ""), event["content_type"], status, lease_owner, lease_expires_at)
+        for event in events
+    ]
+
+    with _transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO outbox_events (event_name, payload, created_at, routing_key, content_type, status, lease_owner, lease_expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
         )
-        return int(cur.lastrowid)
+        # the write lock is held for the whole transaction, so the ids are contiguous
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+    if not lease_owner:
+        with _stored:
+            _stored.notify_all()
+
+    return list(range(last_id - len(rows) + 1, last_id + 1))
     
-def fetch_unpublished(limit: int = 100) -> Iterable[Dict[str, Any]]:
-    """Fetches unpublished events that are ready for processing."""
+def claim_batch(owner: str, limit: int = 100, lease_seconds: int = 60) -> List[Dict[str, Any]]:
+    """Atomically claims up to ``limit`` publishable events for ``owner``.
+
+    Claimed rows move to 'in_flight' until ``lease_seconds`` from now. Rows
+    whose lease expired (the worker died or hung) are claimable again.
+    """
     now = int(time.time())
-    with _conn() as conn:
+    with _transaction() as conn:
         rows = conn.execute(
             """
-            SELECT id, event_name, payload_json, created_at, attempts 
+            SELECT id, event_name, payload, created_at, attempts, routing_key, content_type 
             FROM outbox_events 
             WHERE 
-                status IN ('pending', 'failed') AND
-                next_retry_at <= ?
+                (status IN ('pending', 'failed') AND next_retry_at <= ?) OR
+                (status = 'in_flight' AND lease_expires_at <= ?)
             ORDER BY id ASC 
             LIMIT ?
             """,
-            (now, limit,),
+            (now, now, limit),
         ).fetchall()
-        for r in rows:
-            yield {
-                "id": r[0],
-                "event_name": r[1],
-                "payload": json.loads(r[2]),
-                "created_at": r[3],
-                "attempts": r[4],
-            }
+
+        conn.executemany(
+            "UPDATE outbox_events SET status = 'in_flight', lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+            [(owner, now + lease_seconds, r[0]) for r in rows],
+        )
+
+    return [
+        {
+            "id": r[0],
+            "event_name": r[1],
+            "body": _as_bytes(r[2]),
+            "created_at": r[3],
+            "attempts": r[4],
+            "routing_key": r[5],
+            "content_type": r[6],
+        }
+        for r in rows
+    ]
+
+def wait_for_events(timeout: float, poll_interval: float = 0.1) -> bool:
+    """Blocks until new events may be available or ``timeout`` elapses.
+
+    Stores made by this process wake the caller immediately. Commits made by
+    any other connection, including other processes, are noticed through
+    PRAGMA data_version within ``poll_interval``.
+    """
+    deadline = time.monotonic() + timeout
+    with _conn() as conn:
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            with _stored:
+                if _stored.wait(min(poll_interval, remaining)):
+                    return True
+
+            if conn.execute("PRAGMA data_version").fetchone()[0] != version:
+                return True
 
 def mark_published(event_id: int) -> None:
+    mark_published_many([event_id])
+
+def mark_published_many(event_ids: List[int], owner: Optional[str] = None) -> int:
+    """Marks a whole batch as published in one transaction.
+
+    With an ``owner``, only the rows it still holds the lease of are marked, and
+    the number of those is returned: the others were taken over by another
+    publisher after the lease expired, so they were (or will be) sent twice.
+    """
+    if not event_ids:
+        return 0
+
     now = int(time.time())
     status = 'published'
-    with _conn() as conn:
-        conn.execute("UPDATE outbox_events SET published_at = ?, status = ?, last_error = NULL WHERE id = ?", (now, status, event_id))
+    with _transaction() as conn:
+        if owner is None:
+            cur = conn.executemany(
+                """
+                UPDATE outbox_events 
+                SET published_at = ?, status = ?, last_error = NULL, lease_owner = NULL, lease_expires_at = NULL 
+                WHERE id = ?
+                """,
+                [(now, status, event_id) for event_id in event_ids],
+            )
+        else:
+            cur = conn.executemany(
+                """
+                UPDATE outbox_events 
+                SET published_at = ?, status = ?, last_error = NULL, lease_owner = NULL, lease_expires_at = NULL 
+                WHERE id = ? AND status = 'in_flight' AND lease_owner = ?
+                """,
+                [(now, status, event_id, owner) for event_id in event_ids],
+            )
+        return cur.rowcount
 
-def mark_failed(event_id: int, error: str, current_attempts: int, max_retries: int, base_delay: int) -> None:
+def renew_leases(event_ids: List[int], owner: str, lease_seconds: int) -> List[int]:
+    """Extends ``owner``'s lease on the rows to ``lease_seconds`` from now and
+    returns the ids it still held, in order. The others were claimed by another
+    publisher once their lease expired and must not be sent by ``owner``."""
+    if not event_ids:
+        return []
+
+    now = int(time.time())
+    with _transaction() as conn:
+        return [
+            event_id for event_id in event_ids
+            if conn.execute(
+                """
+                UPDATE outbox_events SET lease_expires_at = ? 
+                WHERE id = ? AND status = 'in_flight' AND lease_owner = ?
+                """,
+                (now + lease_seconds, event_id, owner),
+            ).rowcount
+        ]
+
+def release_events(event_ids: List[int], owner: str, error: Optional[str] = None) -> None:
+    """Hands rows ``owner`` stored or claimed back to the relay, to be published
+    right away. With an ``error``, the failed publish counts as an attempt."""
+    if not event_ids:
+        return
+
+    with _transaction() as conn:
+        conn.executemany(
+            """
+            UPDATE outbox_events 
+            SET status = ?, attempts = attempts + ?, last_error = COALESCE(?, last_error), next_retry_at = 0,
+                lease_owner = NULL, lease_expires_at = NULL 
+            WHERE id = ? AND status = 'in_flight' AND lease_owner = ?
+            """,
+            [('failed' if error else 'pending', 1 if error else 0, error, event_id, owner) for event_id in event_ids],
+        )
+
+    with _stored:
+        _stored.notify_all()
+
+def _failure_row(event_id: int, error: str, current_attempts: int, max_retries: int, base_delay: int, now: float) -> Tuple:
     new_attempts = current_attempts + 1
+
+    if new_attempts >= max_retries:
+        # next_retry_at is left untouched, see the COALESCE in _MARK_FAILED
+        return (new_attempts, error[:500], 'permanently_failed', None, event_id)
+
+    backoff_delay = base_delay * (2 ** current_attempts)
+    jitter = random.uniform(0, 0.2 * backoff_delay) # Add up to 20% jitter
+    next_attempt_time = int(now + backoff_delay + jitter)
+
+    return (new_attempts, error[:500], 'failed', next_attempt_time, event_id)
+
+_MARK_FAILED = """
+    UPDATE outbox_events 
+    SET attempts = ?, last_error = ?, status = ?, next_retry_at = COALESCE(?, next_retry_at), 
+        lease_owner = NULL, lease_expires_at = NULL 
+    WHERE id = ?
+"""
+
+def mark_failed(event_id: int, error: str, current_attempts: int, max_retries: int, base_delay: int) -> None:
+    mark_failed_many([(event_id, error, current_attempts)], max_retries, base_delay)
+
+def mark_failed_many(failures: Iterable[Tuple[int, str, int]], max_retries: int, base_delay: int) -> None:
+    """Records a batch of (event_id, error, current_attempts) failures in one transaction,
+    each row getting its own exponential backoff."""
+    now = time.time()
+    rows = [
+        _failure_row(event_id, error, current_attempts, max_retries, base_delay, now)
+        for event_id, error, current_attempts in failures
+    ]
+
+    if not rows:
+        return
+
+    with _transaction() as conn:
+        conn.executemany(_MARK_FAILED, rows)
+
+
+# --- Retention -------------------------------------------------------------
+
+ARCHIVE_MODES = ("table", "file", "delete")
+_ARCHIVE_PREFIX = "outbox_archive_"
+_DEAD_LETTERS = "outbox_dead_letters"
+
+def _move_rows(conn: sqlite3.Connection, target: str, where: str, params: Tuple) -> int:
+    """Moves the outbox_events rows matching ``where`` into ``target``, creating it if needed."""
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {target} AS SELECT * FROM outbox_events WHERE 0")
+
+    # tables created before a column was added to outbox_events get it too
+    source_columns = [row[1] for row in conn.execute("PRAGMA table_info(outbox_events)")]
+    target_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({target})")}
+    for column in source_columns:
+        if column not in target_columns:
+            conn.execute(f"ALTER TABLE {target} ADD COLUMN {column}")
+
+    columns = ", ".join(source_columns)
+    conn.execute(f"INSERT INTO {target} ({columns}) SELECT {columns} FROM outbox_events WHERE {where}", params)
+    return conn.execute(f"DELETE FROM outbox_events WHERE {where}", params).rowcount
+
+def _archive_to_file(conn: sqlite3.Connection, path: str, where: str, params: Tuple) -> int:
+    cur = conn.execute(f"SELECT * FROM outbox_events WHERE {where}", params)
+    columns = [d[0] for d in cur.description]
+
+    with open(path, "a", encoding="utf-8") as f:
+        for row in cur:
+            record = dict(zip(columns, row))
+            payload = _as_bytes(record["payload"])
+            if record["content_type"] == "application/json":
+                record["payload"] = payload.decode("utf-8")
+            else:
+                record["payload"] = base64.b64encode(payload).decode("ascii")
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    return conn.execute(f"DELETE FROM outbox_events WHERE {where}", params).rowcount
+
+def archive_published(older_than_seconds: int, mode: str = "table", archive_dir: str = "outbox_archive") -> int:
+    """Moves published rows older than ``older_than_seconds`` out of outbox_events.
+
+    ``mode`` is one of ARCHIVE_MODES: one ``outbox_archive_YYYYMMDD`` table per
+    publication day, one ``outbox-YYYY-MM-DD.jsonl`` file per day in
+    ``archive_dir``, or plain deletion. Each day is moved in its own
+    transaction. Returns the number of rows removed from outbox_events.
+    """
+    if mode not in ARCHIVE_MODES:
+        raise ValueError(f"Unknown archive mode '{mode}', expected one of {ARCHIVE_MODES}")
+
+    cutoff = int(time.time()) - older_than_seconds
+    moved = 0
+
     with _conn() as conn:
-        if new_attempts >= max_retries:
-            status = 'permanently_failed'
+        days = [
+            r[0] for r in conn.execute(
+                "SELECT DISTINCT published_at / 86400 FROM outbox_events WHERE status = 'published' AND published_at < ?",
+                (cutoff,),
+            )
+        ]
+
+    if mode == "file":
+        os.makedirs(archive_dir, exist_ok=True)
+
+    for day in days:
+        where = "status = 'published' AND published_at >= ? AND published_at < ?"
+        params = (day * 86400, min((day + 1) * 86400, cutoff))
+        date = datetime.datetime.fromtimestamp(day * 86400, tz=datetime.timezone.utc)
 
-            conn.execute(
-                "UPDATE outbox_events SET attempts = ?, last_error = ?, status = ? WHERE id = ?",
-                (new_attempts,error[:500],status, event_id),
+        with _transaction() as conn:
+            if mode == "table":
+                moved += _move_rows(conn, f"{_ARCHIVE_PREFIX}{date:%Y%m%d}", where, params)
+            elif mode == "file":
+                moved += _archive_to_file(conn, os.path.join(archive_dir, f"outbox-{date:%Y-%m-%d}.jsonl"), where, params)
+            else:
+                moved += conn.execute(f"DELETE FROM outbox_events WHERE {where}", params).rowcount
+
+    return moved
+
+def drop_archives(keep_days: int) -> List[str]:
+    """Drops the daily archive tables older than ``keep_days``."""
+    oldest = datetime.datetime.fromtimestamp(time.time() - keep_days * 86400, tz=datetime.timezone.utc)
+    oldest_name = f"{_ARCHIVE_PREFIX}{oldest:%Y%m%d}"
+
+    with _conn() as conn:
+        tables = [
+            r[0] for r in conn.execute(
+                # not LIKE, where the prefix's underscores match any character
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND substr(name, 1, ?) = ? AND name < ?",
+                (len(_ARCHIVE_PREFIX), _ARCHIVE_PREFIX, oldest_name),
             )
+        ]
+        for table in tables:
+            conn.execute(f"DROP TABLE {table}")
+
+    return tables
+
+def drop_archive_files(archive_dir: str, keep_days: int) -> List[str]:
+    """Deletes the daily ``outbox-YYYY-MM-DD.jsonl`` archives older than ``keep_days``."""
+    oldest = datetime.datetime.fromtimestamp(time.time() - keep_days * 86400, tz=datetime.timezone.utc)
+    oldest_name = f"outbox-{oldest:%Y-%m-%d}.jsonl"
+
+    try:
+        names = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+
+    dropped = []
+    for name in sorted(names):
+        # the ISO dates sort like the days they name
+        if name.startswith("outbox-") and name.endswith(".jsonl") and len(name) == len(oldest_name) and name < oldest_name:
+            path = os.path.join(archive_dir, name)
+            os.remove(path)
+            dropped.append(path)
+
+    return dropped
+
+def move_dead_letters() -> int:
+    """Moves permanently failed rows into outbox_dead_letters, kept for inspection."""
+    with _transaction() as conn:
+        return _move_rows(conn, _DEAD_LETTERS, "status = 'permanently_failed'", ())
+
+def vacuum(pages: int = 1000) -> None:
+    """Returns up to ``pages`` free pages to the filesystem.
+
+    Databases created before auto_vacuum=INCREMENTAL get a one-time full VACUUM.
+    """
+    with _conn() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("VACUUM")
         else:
-            backoff_delay = base_delay * (2 ** current_attempts)
-            jitter = random.uniform(0, 0.2 * backoff_delay) # Add up to 20% jitter
-            next_attempt_time = int(time.time() + backoff_delay + jitter)
-            status = 'failed'
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)});")
 
-            conn.execute(
-                """
-                UPDATE outbox_events 
-                SET attempts = ?, last_error = ?, status = ?, next_retry_at = ? 
-                WHERE id = ?
-                """,
-                (new_attempts, error[:500], status, next_attempt_time, event_id),
-            )
+def checkpoint() -> None:
+    """Copies the WAL back into the database and truncates the WAL file."""
+    with _conn() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+def stats() -> Dict[str, Any]:
+    """Row counts per status (dead letters included) and the on-disk size in bytes."""
+    with _conn() as conn:
+        rows = dict(conn.execute("SELECT status, COUNT(*) FROM outbox_events GROUP BY status").fetchall())
+
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (_DEAD_LETTERS,)).fetchone():
+            rows["dead_letter"] = conn.execute(f"SELECT COUNT(*) FROM {_DEAD_LETTERS}").fetchone()[0]
+
+    size = 0
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            size += os.path.getsize(_db_path() + suffix)
+        except OSError:
+            pass
+
+    return {"rows": rows, "size_bytes": size}
+
+def run_retention(
+    older_than_seconds: int,
+    mode: str = "table",
+    archive_dir: str = "outbox_archive",
+    keep_archive_days: int = 30,
+    vacuum_pages: int = 1000,
+) -> Dict[str, int]:
+    """One retention pass: archive, dead letters, archive expiry, vacuum and WAL checkpoint.
+
+    Archives older than ``keep_archive_days`` are dropped, tables or files
+    depending on ``mode``.
+    """
+    archived = archive_published(older_than_seconds, mode, archive_dir)
+    dead_letters = move_dead_letters()
+
+    if mode == "table":
+        dropped = drop_archives(keep_archive_days)
+    elif mode == "file":
+        dropped = drop_archive_files(archive_dir, keep_archive_days)
+    else:
+        dropped = []
+
+    result = {
+        "archived": archived,
+        "dead_letters": dead_letters,
+        "dropped_archives": len(dropped),
+    }
+    vacuum(vacuum_pages)
+    checkpoint()
+
+    return result
+
+def start_retention(interval_seconds: float, stop_event: threading.Event, **policy: Any) -> threading.Thread:
+    """Runs run_retention(**policy) every ``interval_seconds`` on a daemon thread until ``stop_event`` is set."""
+
+    def loop():
+        while not stop_event.is_set():
+            try:
+                print(f"Outbox retention: {run_retention(**policy)}")
+            except (sqlite3.Error, OSError) as e:
+                print(f"Outbox retention failed: {e}")
+            stop_event.wait(interval_seconds)
+
+    thread = threading.Thread(target=loop, name="outbox-retention", daemon=True)
+    thread.start()
+    return thread
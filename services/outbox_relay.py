@@ -1,8 +1,15 @@
-from event_publisher import EventPublisher
-from outbox import fetch_unpublished, mark_published, mark_failed
+from services.event_publisher import EventPublisher, get_publisher
+from decorator.metric_decorator import duplicate_publish_counter, outbox_event_age_seconds, stage_latency
+from services.outbox import database, claim_batch, mark_published_many, mark_failed_many, wait_for_events
+import argparse
+import os
+import signal
+import socket
+import threading
 import time
 import logging
-from typing import Optional
+from contextlib import nullcontext
+from typing import Callable, List, Optional
 
 
 class OutboxRelay:
@@ -13,25 +20,38 @@ class OutboxRelay:
         ttl_seconds: int = 86400,      # TTL: 24 hours
         max_retries: int = 5,          # Backoff: Max attempts
         base_delay_seconds: int = 2,   # Backoff: Initial delay
+        workers: int = 1,              # Concurrent workers claiming batches
+        lease_seconds: int = 60,       # Claimed rows are reclaimable after this
+        sender_factory: Callable[[], EventPublisher] = get_publisher,
+        db_paths: Optional[List[str]] = None,  # Outbox shards to drain, OUTBOX_DB_PATH if None
     ):
         self.sleep_interval = sleep_interval
         self.batch_size = batch_size
         self.ttl_seconds = ttl_seconds
         self.max_retries = max_retries
         self.base_delay_seconds = base_delay_seconds
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.sender_factory = sender_factory
+        self.db_paths = db_paths or [None]
         self.running = True
-        self.sender: Optional[EventPublisher] = None
 
-    # In outbox_relay.py
+        # unique across hosts and processes sharing the same outbox.db
+        self.relay_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._threads: List[threading.Thread] = []
 
-    def publish_outbox_events(self) -> None:
+    def publish_outbox_events(self, sender: EventPublisher, owner: str) -> int:
+        """Claims one batch, publishes it and records the outcome. Returns the batch size."""
         now = int(time.time())
-        events = list(fetch_unpublished(limit=self.batch_size))
+        events = claim_batch(owner, limit=self.batch_size, lease_seconds=self.lease_seconds)
 
         if not events:
-            return
+            return 0
+
+        for event in events:
+            outbox_event_age_seconds.observe(now - event['created_at'])
+
 
-        
         events_to_publish = []
         events_to_mark_failed = []
 
@@ -45,51 +65,103 @@ class OutboxRelay:
                 events_to_publish.append({
                     "id": event['id'],
                     "event_name": event['event_name'],
-                    "payload": event['payload'],
-                    "created_at": event['created_at']
+                    "routing_key": event['routing_key'],
+                    "content_type": event['content_type'],
+                    "body": event['body'],
+                    "created_at": event['created_at'],
+                    "attempts": event['attempts']
                 })
 
-        try:
-            if events_to_publish:
-                print(f"Publishing a batch of {len(events_to_publish)} events...")
-                
-                self.sender.send_event(events_to_publish)
-                
+        if events_to_publish:
+            print(f"[{owner}] Publishing a batch of {len(events_to_publish)} events...")
+
+            try:
+                started = time.monotonic()
+                sender.send_event(events_to_publish)
+                stage_latency['relay_publish'].observe(time.monotonic() - started)
+            except Exception as e:
+                error_msg = str(e)
+                print(f"[{owner}] Entire batch failed to publish: {error_msg}")
                 for event in events_to_publish:
-                    mark_published(event['id'])
-                
-                print(f"Batch of {len(events_to_publish)} events published successfully.")
-
-        except Exception as e:
-            error_msg = str(e)
-            print(f"Entire batch failed to publish: {error_msg}")
-            for event in events_to_publish:
-                events_to_mark_failed.append((event, error_msg))
+                    events_to_mark_failed.append((event, error_msg))
+            else:
+                # the batch was sent, marking it failed would publish it twice: a
+                # failed confirm leaves the rows leased, they're sent again when it expires
+                try:
+                    # rows whose lease expired meanwhile were claimed and sent again by another worker
+                    confirmed = mark_published_many([event['id'] for event in events_to_publish], owner=owner)
+                    if confirmed < len(events_to_publish):
+                        duplicate_publish_counter.labels(path="relay").inc(len(events_to_publish) - confirmed)
 
-        for event, error_msg in events_to_mark_failed:
-            mark_failed(
-                event_id=event['id'],
-                error=error_msg,
-                current_attempts=event['attempts'],
-                max_retries=self.max_retries,
-                base_delay=self.base_delay_seconds
-            )
+                    print(f"[{owner}] Batch of {len(events_to_publish)} events published successfully.")
+                except Exception as e:
+                    print(f"[{owner}] Error while confirming {len(events_to_publish)} published events, they'll be sent again once their lease expires: {e}")
 
-    def start(self):
-        print("Starting Outbox Relay service...")
-        self.sender = EventPublisher()
-        
+        mark_failed_many(
+            [(event['id'], error_msg, event['attempts']) for event, error_msg in events_to_mark_failed],
+            max_retries=self.max_retries,
+            base_delay=self.base_delay_seconds
+        )
+
+        return len(events)
+
+    def _run_worker(self, worker_id: int, db_path: Optional[str] = None) -> None:
+        owner = f"{self.relay_id}-{worker_id}"
+        sender = self.sender_factory()
+
+        try:
+            with database(db_path) if db_path else nullcontext():
+                self._work(sender, owner)
+        finally:
+            sender.close()
+
+    def _work(self, sender: EventPublisher, owner: str) -> None:
         while self.running:
             try:
-                self.publish_outbox_events()
-                time.sleep(self.sleep_interval)
-            except KeyboardInterrupt:
-                print("Shutting down Outbox Relay...")
-                break
+                # a full batch means there is probably more waiting
+                if self.publish_outbox_events(sender, owner) < self.batch_size:
+                    wait_for_events(self.sleep_interval)
             except Exception as e:
-                logging.error(f"Unexpected error: {e}")
+                logging.error(f"[{owner}] Unexpected error: {e}")
                 time.sleep(self.sleep_interval)  # Wait before retrying
 
+    def start(self):
+        print(f"Starting Outbox Relay service with {self.workers} worker(s) per outbox, {len(self.db_paths)} outbox(es)...")
+
+        # every shard gets its own workers, rows are only ever claimed from one file
+        for db_path in self.db_paths:
+            for _ in range(self.workers):
+                worker_id = len(self._threads)
+                thread = threading.Thread(target=self._run_worker, args=(worker_id, db_path), name=f"outbox-relay-{worker_id}")
+                thread.start()
+                self._threads.append(thread)
+
+        try:
+            while self.running and any(thread.is_alive() for thread in self._threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Shutting down Outbox Relay...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        for thread in self._threads:
+            thread.join()
+
 if __name__ == "__main__":
-    relay = OutboxRelay()
-    relay.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Publishes the events stored in the outbox.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--db", action="append", dest="db_paths", help="Outbox database to drain, repeat for every shard (default: OUTBOX_DB_PATH)")
+    parser.add_argument("--ttl-seconds", type=int, default=86400, help="Events older than this are not published (replayed history keeps its recorded timestamps)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve the relay's metrics on this port (the supervisor serves them in sharded mode)")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+        start_http_server(args.metrics_port)
+
+    relay = OutboxRelay(workers=args.workers, db_paths=args.db_paths, ttl_seconds=args.ttl_seconds)
+    # the supervisor stops the relay with SIGTERM, let the workers finish their batch
+    signal.signal(signal.SIGTERM, lambda signum, frame: setattr(relay, "running", False))
+    relay.start()
@@ -0,0 +1,261 @@
+"""Replays recorded tag history through the rules, faster than real time.
+
+The history goes through ReplayAdapter and EventGenerator like live readings,
+but the time comes from the recorded timestamps: no polling sleep, no Timer.
+Rule states and edges behave as in the live mode chosen, and the events carry
+the recorded timestamps.
+
+    python -m services.replay history.csv.gz --output events.jsonl
+    python -m services.replay history.jsonl --mode event --min-interval 0.5 --output outbox
+
+Events written to the outbox are published by OutboxRelay, whose TTL applies
+to their recorded timestamps: run it with a --ttl-seconds covering the history.
+"""
+import argparse
+import base64
+import heapq
+import json
+import time
+from contextlib import nullcontext
+from threading import Event
+
+from services import outbox
+from services.config_loader import ConfigLoader
+from services.data_reader import ReplayAdapter
+from services.event_generator import EventGenerator
+
+
+class VirtualClock():
+    """Replaces time.time() for the generator, set by the driver."""
+
+    def __init__(self, now : float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FileSink():
+    """Writes events as JSON lines, with the payload decoded when it's JSON."""
+
+    def __init__(self, path : str):
+        self._file = open(path, "w", encoding="utf-8")
+        self.events = 0
+
+    def write(self, events):
+        for event in events:
+            line = {"event_name": event["event_name"], "routing_key": event["routing_key"], "created_at": event["created_at"]}
+            if event["content_type"] == "application/json":
+                line["payload"] = json.loads(event["body"])
+            else:
+                line["payload_base64"] = base64.b64encode(event["body"]).decode("ascii")
+            self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.events += len(events)
+
+    def close(self):
+        self._file.close()
+
+
+class OutboxSink():
+    """Stores events in the outbox, ``batch_size`` per transaction."""
+
+    def __init__(self, db_path : str = None, batch_size : int = 1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._pending = []
+        self.events = 0
+
+    def write(self, events):
+        self._pending.extend(events)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        with outbox.database(self.db_path) if self.db_path else nullcontext():
+            outbox.store_events(self._pending)
+        self.events += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        if self._pending:
+            self._flush()
+
+
+class ReplayDriver():
+    """Steps a virtual clock through the history and evaluates like main.py would.
+
+    - ``timer``: every ``timespan`` seconds of recorded time, the equipments that
+      received readings since the previous tick are evaluated. Stretches without
+      any record are skipped instead of ticked through, unless some rule uses a
+      window function: those equipments are evaluated on every tick.
+    - ``event``: an equipment is evaluated as soon as it receives readings, or
+      ``min_interval`` after its previous evaluation, coalescing what came in
+      between, like EventGenerator.notify. Equipments with windowed rules are
+      also notified every ``timespan``, like main.py does without readings.
+    """
+
+    MODES = ("timer", "event")
+
+    def __init__(self, equipments, adapter : ReplayAdapter, sink, mode : str = "timer", timespan : float = 3.0, min_interval : float = 0.0, engine = None):
+
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown replay mode '{mode}', expected one of {self.MODES}")
+
+        self.equipments = equipments
+        self.adapter = adapter
+        self.sink = sink
+        self.mode = mode
+        self.timespan = timespan
+        self.min_interval = min_interval
+        self.clock = VirtualClock()
+        for equipment in equipments:
+            equipment.windows.clock = self.clock
+        self.generator = EventGenerator(sender=None, shutdown_event=Event(), engine=engine, clock=self.clock, verbose=False)
+        self.evaluations = 0
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        self.adapter.connect()
+        first = self.adapter.next_timestamp()
+
+        try:
+            if self.mode == "timer":
+                self._run_timer()
+            else:
+                self._run_event()
+        finally:
+            self.sink.close()
+
+        elapsed = time.perf_counter() - started
+        span = self.clock.now - first if first is not None else 0.0
+
+        return {
+            "records": self.adapter.records,
+            "skipped": self.adapter.skipped,
+            "evaluations": self.evaluations,
+            "events": self.sink.events,
+            "recorded_seconds": span,
+            "elapsed_seconds": elapsed,
+            "speedup": span / elapsed if elapsed else None,
+        }
+
+    def _apply(self, equipments):
+        for equipment in equipments:
+            readings = self.adapter.read(equipment)
+            if readings:
+                equipment.update_values(readings)
+
+    def _evaluate(self, now, equipments):
+        self.clock.now = now
+        self.evaluations += len(equipments)
+        events = self.generator.evaluate(equipments)
+        if events:
+            self.sink.write(events)
+
+    def _run_timer(self):
+        tick = self.adapter.next_timestamp()
+        # windowed rules can turn true with time alone
+        timed = [equipment for equipment in self.equipments if equipment.timed_rules]
+
+        while (next_timestamp := self.adapter.next_timestamp()) is not None:
+            if next_timestamp > tick and not timed:
+                # jump to the first tick at or after the next record
+                tick += -((tick - next_timestamp) // self.timespan) * self.timespan
+
+            self.clock.now = tick
+            touched = self.adapter.advance(tick)
+            self._apply(touched)
+            if timed:
+                names = {equipment.name for equipment in touched}
+                touched = touched + [equipment for equipment in timed if equipment.name not in names]
+            self._evaluate(tick, touched)
+            tick += self.timespan
+
+    def _run_event(self):
+        # (due, sequence, equipment) of the evaluations delayed by min_interval
+        pending = []
+        scheduled = set()
+        last_evaluation = {}
+        sequence = 0
+
+        def notify(now, equipments):
+            nonlocal sequence
+            ready = []
+            for equipment in equipments:
+                if equipment.name in scheduled:
+                    continue
+
+                due = last_evaluation.get(equipment.name, float("-inf")) + self.min_interval
+                if due > now:
+                    sequence += 1
+                    heapq.heappush(pending, (due, sequence, equipment))
+                    scheduled.add(equipment.name)
+                else:
+                    last_evaluation[equipment.name] = now
+                    ready.append(equipment)
+
+            if ready:
+                self._evaluate(now, ready)
+
+        # windowed rules can turn true with time alone
+        timed = [equipment for equipment in self.equipments if equipment.timed_rules]
+        tick = self.adapter.next_timestamp()
+        if tick is not None:
+            tick += self.timespan
+
+        while True:
+            next_timestamp = self.adapter.next_timestamp()
+            horizon = next_timestamp
+            if timed and next_timestamp is not None:
+                horizon = min(tick, next_timestamp)
+
+            # evaluations due before the next record or tick run first, readings
+            # at the very same instant are coalesced into them
+            while pending and (horizon is None or pending[0][0] < horizon):
+                due, _, equipment = heapq.heappop(pending)
+                scheduled.discard(equipment.name)
+                last_evaluation[equipment.name] = due
+                self._evaluate(due, [equipment])
+
+            if next_timestamp is None:
+                return
+
+            if timed and tick < next_timestamp:
+                self.clock.now = tick
+                notify(tick, timed)
+                tick += self.timespan
+                continue
+
+            self.clock.now = next_timestamp
+            touched = self.adapter.advance(next_timestamp)
+            self._apply(touched)
+            notify(next_timestamp, touched)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("history", help="CSV or JSONL tag history, optionally .gz")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--mode", choices=ReplayDriver.MODES, default="timer")
+    parser.add_argument("--timespan", type=float, default=3.0, help="timer mode evaluation period, in recorded seconds")
+    parser.add_argument("--min-interval", type=float, default=0.5, help="event mode coalescing interval, in recorded seconds")
+    parser.add_argument("--engine", choices=("scalar", "columnar"), default="scalar")
+    parser.add_argument("--output", default="outbox", help="'outbox' or a JSONL file to write the events to")
+    parser.add_argument("--outbox-db", default=None, help="outbox database to store the events in (default: OUTBOX_DB_PATH)")
+    args = parser.parse_args()
+
+    equipments, _ = ConfigLoader(args.config).initialize()
+
+    engine = None
+    if args.engine == "columnar":
+        from services.columnar_engine import ColumnarEngine
+        engine = ColumnarEngine(equipments)
+
+    sink = OutboxSink(args.outbox_db) if args.output == "outbox" else FileSink(args.output)
+    driver = ReplayDriver(equipments, ReplayAdapter(equipments, args.history), sink,
+                          mode=args.mode, timespan=args.timespan, min_interval=args.min_interval, engine=engine)
+    stats = driver.run()
+
+    print(f"Replayed {stats['records']:,} records ({stats['skipped']:,} skipped) covering {stats['recorded_seconds'] / 3600:.1f} h "
+          f"in {stats['elapsed_seconds']:.1f} s ({stats['speedup'] or 0:,.0f}x real time): "
+          f"{stats['evaluations']:,} equipment evaluations, {stats['events']:,} events")
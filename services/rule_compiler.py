@@ -0,0 +1,357 @@
+import ast
+import hashlib
+import marshal
+import pickle
+import sys
+
+# Node types a rule expression may contain to be compiled to native bytecode.
+# Anything outside this set (other calls, attributes, subscripts, lambdas,
+# ``**``...) is left to asteval, which already sandboxes those constructs.
+_ALLOWED_NODES = (
+    ast.Expression,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.Name, ast.Load,
+    ast.Constant,
+)
+
+_ALLOWED_CONSTANTS = (int, float, bool, str, type(None))
+
+# Functions over the recent history of a tag, called as ``avg(Voltagem, 30)``
+# with a tag name and a window length in seconds (see models/window.py):
+#   avg       mean of the readings received during the window
+#   delta     change of the value over the window
+#   rate      delta per second
+#   max_over  highest value during the window, so "Voltagem < 6.0 for 30 s"
+#             is ``max_over(Voltagem, 30) < 6.0``
+#   min_over  lowest value during the window
+# max_over and min_over stay NaN, so false, until the tag has 30 s of history.
+WINDOW_FUNCTIONS = frozenset(('avg', 'delta', 'rate', 'max_over', 'min_over'))
+
+# Compiled rules run without builtins, they can only see the tag values
+_SAFE_GLOBALS = {'__builtins__': {}}
+
+
+class UnsupportedExpression(Exception):
+    pass
+
+
+class CompiledRule():
+
+    native = True
+
+    def __init__(self, source, code, tags, windows=frozenset(), threshold=None):
+        self.source = source
+        self.code = code
+        self.tags = tags
+        # (tag, seconds) of the windows the expression reads
+        self.windows = windows
+        # (tag, operator, constant) when the rule is a plain threshold like
+        # ``Voltagem > 22.0``, which the equipment resolves with a ThresholdIndex
+        self.threshold = threshold
+
+    def __call__(self, symtable):
+        try:
+            return eval(self.code, _SAFE_GLOBALS, symtable)
+        except (NameError, TypeError, ArithmeticError) as e:
+            # same outcome as asteval: the error is reported and the rule is falsy
+            print(f"Error while evaluating rule '{self.source}': {e}")
+            return None
+
+
+class LazyInterpreter():
+    """asteval.Interpreter created on first use, so asteval (and numpy, which it
+    imports) is only loaded when some rule actually falls back to it."""
+
+    def __init__(self):
+        self._interpreter = None
+
+    def __getattr__(self, name):
+        if self._interpreter is None:
+            import asteval
+            self._interpreter = asteval.Interpreter()
+        return getattr(self._interpreter, name)
+
+
+class InterpretedRule():
+
+    native = False
+    windows = frozenset()
+    threshold = None
+
+    def __init__(self, source, node, interpreter, tags):
+        self.source = source
+        self.node = node
+        self.interpreter = interpreter
+        self.tags = tags
+
+    def __call__(self, symtable):
+        for tag in self.tags:
+            if tag in symtable:
+                self.interpreter.symtable[tag] = symtable[tag]
+        return self.interpreter.run(self.node)
+
+
+def referenced_names(tree):
+    return frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+
+def referenced_tags(tree):
+    """The names ``tree`` reads as values, leaving out the functions it calls
+    (``abs``, ``max``...), which are no tags and never change."""
+    functions = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    return frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and id(node) not in functions)
+
+
+def _window_call(node):
+    """Returns (function, tag, seconds) if ``node`` is a call to a window function."""
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in WINDOW_FUNCTIONS):
+        return None
+
+    if node.keywords or len(node.args) != 2:
+        raise UnsupportedExpression(f"{node.func.id}() takes a tag and a window length in seconds")
+
+    tag, seconds = node.args
+    if not isinstance(tag, ast.Name):
+        raise UnsupportedExpression(f"the first argument of {node.func.id}() must be a tag")
+    if not (isinstance(seconds, ast.Constant) and type(seconds.value) in (int, float) and seconds.value > 0):
+        raise UnsupportedExpression(f"the window of {node.func.id}() must be a positive number of seconds")
+
+    return node.func.id, tag.id, seconds.value
+
+
+def _validate(tree, windows=False):
+    for node in ast.walk(tree):
+        if windows and _window_call(node):
+            continue
+
+        if not isinstance(node, _ALLOWED_NODES):
+            raise UnsupportedExpression(f"'{type(node).__name__}' is not supported")
+
+        if isinstance(node, ast.Constant) and not isinstance(node.value, _ALLOWED_CONSTANTS):
+            raise UnsupportedExpression(f"constant {node.value!r} is not supported")
+
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise UnsupportedExpression(f"name '{node.id}' is reserved")
+
+
+class _Windowed(ast.NodeTransformer):
+    """Rewrites ``avg(Voltagem, 30)`` into ``__windows__.avg('Voltagem', 30)``,
+    the equipment's Windows being in its symtable, and collects the windows."""
+
+    def __init__(self):
+        self.tags = set()
+        self.windows = set()
+
+    def visit_Call(self, node):
+        function, tag, seconds = _window_call(node)
+        self.tags.add(tag)
+        self.windows.add((tag, seconds))
+
+        return ast.Call(
+            func=ast.Attribute(value=ast.Name(id='__windows__', ctx=ast.Load()), attr=function, ctx=ast.Load()),
+            args=[ast.Constant(tag), ast.Constant(seconds)],
+            keywords=[]
+        )
+
+
+# comparison with the tag on the left -> same comparison with the tag on the right
+_MIRRORED = {ast.Lt: '>', ast.LtE: '>=', ast.Gt: '<', ast.GtE: '<='}
+_OPERATORS = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+
+
+def _number(node):
+    """The value of a numeric constant like ``22.0`` or ``-5``, None for anything else."""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _number(node.operand)
+        return None if value is None else (-value if isinstance(node.op, ast.USub) else value)
+
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float) and node.value == node.value:
+        return node.value
+
+    return None
+
+
+def threshold_of(tree):
+    """Returns (tag, operator, constant) if the expression is ``Tag op constant``
+    (or ``constant op Tag``) with an ordering operator, None otherwise."""
+    body = tree.body
+    if not (isinstance(body, ast.Compare) and len(body.ops) == 1 and type(body.ops[0]) in _OPERATORS):
+        return None
+
+    left, op, right = body.left, type(body.ops[0]), body.comparators[0]
+
+    if isinstance(left, ast.Name) and (value := _number(right)) is not None:
+        return left.id, _OPERATORS[op], value
+
+    if isinstance(right, ast.Name) and (value := _number(left)) is not None:
+        return right.id, _MIRRORED[op], value
+
+    return None
+
+
+def compile_native(expression):
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise UnsupportedExpression(str(e))
+
+    _validate(tree, windows=True)
+
+    windowed = _Windowed()
+    tree = ast.fix_missing_locations(windowed.visit(tree))
+    # a windowed rule also runs when its tags change, the window functions
+    # themselves are not tags
+    tags = (referenced_names(tree) - {'__windows__'}) | windowed.tags
+
+    code = compile(tree, f"<rule: {expression}>", 'eval')
+
+    return CompiledRule(expression, code, frozenset(tags), frozenset(windowed.windows), threshold_of(tree))
+
+
+# divisions of a vector rule -> the vector engine function running them, which
+# also records the rows dividing by zero (a ZeroDivisionError for a scalar rule)
+_VECTOR_DIVISIONS = {ast.Div: '__vdiv__', ast.FloorDiv: '__vfloordiv__', ast.Mod: '__vmod__'}
+
+
+class _Vectorize(ast.NodeTransformer):
+    """Rewrites the operators that don't broadcast over arrays into calls to
+    __vand__/__vor__/__vnot__, divisions into calls to __vdiv__/
+    __vfloordiv__/__vmod__ and tags into calls to __vtag__, which the vector
+    engine provides.
+
+    The operands of __vand__/__vor__ are passed as lambdas: like ``and``/``or``
+    the engine only runs an operand for the rows that reach it, so a division
+    guarded by ``PecasBoas == 0 or ...`` fails nowhere the guard holds, and
+    an unread tag (a NameError for a scalar rule) only where it's reached."""
+
+    def _call(self, name, args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+    def _lazy(self, node):
+        arguments = ast.arguments(posonlyargs=[], args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+        return ast.Lambda(args=arguments, body=node)
+
+    def visit_Name(self, node):
+        return self._call('__vtag__', [ast.Constant(node.id)])
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        name = _VECTOR_DIVISIONS.get(type(node.op))
+        return self._call(name, [node.left, node.right]) if name else node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        return self._call('__vand__' if isinstance(node.op, ast.And) else '__vor__', [self._lazy(value) for value in node.values])
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        return self._call('__vnot__', [node.operand]) if isinstance(node.op, ast.Not) else node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+
+        # a < b < c -> (a < b) and (b < c)
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            parts.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+
+        return self._call('__vand__', [self._lazy(part) for part in parts])
+
+
+def compile_vector(expression):
+    """Compiles an expression evaluated over columns of values, each tag read
+    through __vtag__: the operands of ``and``/``or`` run inside lambdas.
+
+    Window functions are not vectorized, rules using them run row by row.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise UnsupportedExpression(str(e))
+
+    _validate(tree)
+
+    tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+
+    return compile(tree, f"<vector rule: {expression}>", 'eval')
+
+
+def compile_rule(expression, interpreter):
+
+    try:
+        return compile_native(expression)
+    except UnsupportedExpression as e:
+        reason = e
+
+    # asteval knows nothing of the window functions, such a rule would fail on
+    # every evaluation: refuse it while the config is loaded instead
+    try:
+        window_functions = referenced_names(ast.parse(expression.strip(), mode='eval')) & WINDOW_FUNCTIONS
+    except SyntaxError:
+        window_functions = None
+    if window_functions:
+        raise ValueError(f"Rule '{expression}' can't be compiled natively ({reason}) and asteval has no {', '.join(sorted(window_functions))}()")
+
+    print(f"Rule '{expression}' can't be compiled natively ({reason}), falling back to asteval")
+
+    node = interpreter.parse(expression)
+
+    return InterpretedRule(expression, node, interpreter, referenced_tags(node))
+
+
+# bump when the cached representation of a rule changes
+_CACHE_FORMAT = 3
+
+def _source_digest():
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+# part of the key of every cached rule set: a change to this compiler, or
+# another Python version, compiles the rules again instead of reusing them
+CACHE_KEY = f"{_CACHE_FORMAT}-{sys.implementation.cache_tag}-{_source_digest()}"
+
+def dump_rules(compiled_rules, path):
+    """Saves compiled rules so the next start can skip parsing and compiling them.
+
+    Native rules are stored as marshalled bytecode, which is only readable by
+    the same Python version, so the cache records the interpreter it was made by.
+    """
+    rules = []
+    for expression, rule in compiled_rules.items():
+        if rule.native:
+            rules.append((expression, True, marshal.dumps(rule.code), rule.tags, rule.windows, rule.threshold))
+        else:
+            rules.append((expression, False, rule.node, rule.tags, rule.windows, rule.threshold))
+
+    with open(path, 'wb') as f:
+        pickle.dump((_CACHE_FORMAT, sys.implementation.cache_tag, rules), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_rules(path, interpreter):
+    """Returns the rules saved by dump_rules, or None if there is no usable cache."""
+    try:
+        with open(path, 'rb') as f:
+            cache_format, cache_tag, rules = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable rule cache {path}: {e}")
+        return None
+
+    if cache_format != _CACHE_FORMAT or cache_tag != sys.implementation.cache_tag:
+        return None
+
+    compiled_rules = {}
+    for expression, native, code, tags, windows, threshold in rules:
+        if native:
+            compiled_rules[expression] = CompiledRule(expression, marshal.loads(code), tags, windows, threshold)
+        else:
+            compiled_rules[expression] = InterpretedRule(expression, code, interpreter, tags)
+
+    return compiled_rules
@@ -0,0 +1,167 @@
+"""Scans every tag at its own rate instead of everything once a second.
+
+The scan rate, in seconds, is set per tag or per equipment in config.json:
+
+    "Torra": {
+        "scan_rate": 1.0,
+        "tags": [
+            {"name": "Vibracao", "type": "float", "plc_address": "vibration", "scan_rate": 0.1},
+            {"name": "PecasBoas", "type": "integer", "plc_address": "good_pieces", "scan_rate": 60}
+        ],
+        ...
+    }
+
+The tags of an equipment sharing a rate form a scan group. Groups are kept
+in a heap by due time. Every scan reads only the group's tags from the
+adapter and evaluates the equipment, where the dirty index keeps evaluation
+to the rules reading the tags that changed. Scans of one rate are aligned
+on multiples of it, so the groups due together are read in one batch.
+"""
+import heapq
+import itertools
+import math
+import time
+from threading import Event, Lock
+
+from decorator.metric_decorator import scheduler_lag_seconds, scheduler_skipped_scans_counter
+
+DEFAULT_SCAN_RATE = 1.0
+
+# the longest the loop sleeps, so a shutdown or a reload is picked up quickly
+_MAX_SLEEP = 0.5
+
+
+def scan_groups(equipment, default_rate=DEFAULT_SCAN_RATE):
+    """Returns [(rate, tag names)] of the equipment, tags grouped by scan rate."""
+    equipment_rate = float(equipment.config.get('scan_rate', default_rate))
+
+    groups = {}
+    for tag in equipment.tags:
+        rate = float(tag.get('scan_rate', equipment_rate))
+        if rate <= 0:
+            raise ValueError(f"Scan rate of {equipment.name}.{tag['name']} must be positive, got {rate}")
+        groups.setdefault(rate, []).append(tag['name'])
+
+    return [(rate, tuple(names)) for rate, names in sorted(groups.items())]
+
+
+class ScanScheduler():
+    """Drives the adapter reads, and the evaluation of what was read, from a heap
+    of scan groups ordered by due time.
+
+    A group's next scan is due one period after the previous due time, not after
+    the scan ran, so the schedule doesn't drift. A scheduler falling more than a
+    period behind skips the missed scans instead of bursting through them.
+
+    ``on_scan(equipments)`` is called after every batch with the equipments that
+    were read, it evaluates them (None: only read, evaluation runs elsewhere).
+    """
+
+    def __init__(self, equipments, adapter, shutdown_event : Event, on_scan = None, default_rate : float = DEFAULT_SCAN_RATE, clock = time.monotonic):
+        self.adapter = adapter
+        self.shutdown_event = shutdown_event
+        self.on_scan = on_scan
+        self.default_rate = default_rate
+        self.clock = clock
+
+        # (due, sequence, equipment name, generation, rate, tags, equipment)
+        self._heap = []
+        self._sequence = 0
+        # equipment name -> generation of its scan groups, entries of an older
+        # generation were removed or replaced by a reload and are dropped when popped.
+        # Generations only go up, an equipment removed and added again gets a new one
+        self._generations = {}
+        self._next_generation = itertools.count(1)
+        self._lock = Lock()
+
+        self.scans = 0
+        self.skipped = 0
+
+        self.add_equipments(equipments)
+
+    def _push(self, due, name, generation, rate, tags, equipment):
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, name, generation, rate, tags, equipment))
+
+    def add_equipments(self, equipments):
+        groups = [(equipment, scan_groups(equipment, self.default_rate)) for equipment in equipments]
+        now = self.clock()
+
+        with self._lock:
+            for equipment, equipment_groups in groups:
+                generation = self._generations[equipment.name] = next(self._next_generation)
+                for rate, tags in equipment_groups:
+                    # aligned on the rate, the groups of one rate come due together
+                    self._push(math.ceil(now / rate) * rate, equipment.name, generation, rate, tags, equipment)
+
+    def remove_equipments(self, equipments):
+        with self._lock:
+            for equipment in equipments:
+                self._generations.pop(equipment.name, None)
+
+    def update_equipments(self, equipments):
+        """Regroups reconfigured equipments, their tags or rates may have changed."""
+        self.add_equipments(equipments)
+
+    def _pop_due(self, now):
+        """Pops the scans due at ``now`` and schedules their next one."""
+        due_scans = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, name, generation, rate, tags, equipment = heapq.heappop(self._heap)
+                if self._generations.get(name) != generation:
+                    continue
+
+                due_scans.append((due, equipment, tags))
+
+                next_due = due + rate
+                if next_due <= now:
+                    missed = math.floor((now - due) / rate)
+                    self.skipped += missed
+                    scheduler_skipped_scans_counter.inc(missed)
+                    next_due = due + (missed + 1) * rate
+
+                self._push(next_due, name, generation, rate, tags, equipment)
+
+            next_due = self._heap[0][0] if self._heap else None
+
+        return due_scans, next_due
+
+    def step(self):
+        """Runs the scans due now, returns the time of the next one (None if there's none)."""
+        now = self.clock()
+        due_scans, next_due = self._pop_due(now)
+        if not due_scans:
+            return next_due
+
+        for due, _, _ in due_scans:
+            scheduler_lag_seconds.observe(now - due)
+
+        scanned = {}
+        for equipment, readings in self.adapter.scan([(equipment, tags) for _, equipment, tags in due_scans]):
+            if readings:
+                equipment.update_values(readings)
+            scanned[equipment.name] = equipment
+        self.scans += len(due_scans)
+
+        if self.on_scan is not None and scanned:
+            self.on_scan(list(scanned.values()))
+
+        return next_due
+
+    def _next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def run(self):
+        while not self.shutdown_event.is_set():
+            try:
+                next_due = self.step()
+            except Exception as e:
+                # the failed scans were already rescheduled, the schedule goes on
+                print(f"Error while scanning: {e}")
+                next_due = self._next_due()
+            wait = _MAX_SLEEP if next_due is None else min(_MAX_SLEEP, next_due - self.clock())
+            if wait > 0:
+                self.shutdown_event.wait(wait)
@@ -0,0 +1,180 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from threading import Event
+from typing import List
+
+from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+from decorator.metric_decorator import OutboxCollector
+from services import outbox
+from services.control import CONTROL_SOCKET, ControlServer, request
+
+
+def shard_of(equipment_name : str, shards : int) -> int:
+    """Stable shard of an equipment, the same in every process and across restarts."""
+    return zlib.crc32(equipment_name.encode('utf-8')) % shards
+
+
+def shard_path(base_path : str, index : int) -> str:
+    """Per-shard file of a worker: outbox.db -> outbox-0.db, control.sock -> control-0.sock..."""
+    root, ext = os.path.splitext(base_path)
+    return f"{root}-{index}{ext}"
+
+
+class _Child():
+
+    def __init__(self, name : str, args : List[str], env : dict):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+
+    def spawn(self):
+        self.process = subprocess.Popen(self.args, env=self.env)
+        self.started_at = time.monotonic()
+        print(f"[supervisor] started {self.name} (pid {self.process.pid})")
+
+
+class Supervisor():
+    """Runs the agent as N worker processes plus one outbox relay process.
+
+    Every worker reads and evaluates its own subset of the equipments
+    (``shard_of``) and stores events in its own outbox file, so the workers
+    never contend for the same SQLite write lock. The relay drains all the
+    shard files. Workers that die are restarted with an exponential backoff,
+    and the metrics of all processes are served together on ``metrics_port``
+    through Prometheus' multiprocess mode. Scrape-time collectors can't be
+    aggregated that way, each worker serves those itself on 8002 + its shard
+    (scraped by the python-app-shards job of prometheus.yml).
+
+    The multiprocess metric files go to ``metrics_dir``, a new directory the
+    supervisor creates (a temporary one by default) and removes when it stops.
+    Only the children get PROMETHEUS_MULTIPROC_DIR pointing there.
+    """
+
+    def __init__(self, workers : int, shutdown_event : Event, metrics_port : int = 8001, relay_workers : int = 1,
+                 metrics_dir : str = None, max_restart_delay : float = 60.0):
+        self.workers = workers
+        self.shutdown_event = shutdown_event
+        self.metrics_port = metrics_port
+        self.max_restart_delay = max_restart_delay
+        if metrics_dir is None:
+            self.metrics_dir = tempfile.mkdtemp(prefix="agent-metrics-")
+        else:
+            # must not exist, files of another run would be summed with ours
+            os.makedirs(metrics_dir)
+            self.metrics_dir = metrics_dir
+        self.db_paths = [shard_path(outbox.DB_PATH, i) for i in range(workers)]
+        self.control_paths = [shard_path(CONTROL_SOCKET, i) for i in range(workers)]
+
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.metrics_dir)
+
+        self.children = [
+            _Child(
+                f"worker-{i}",
+                [sys.executable, os.path.abspath(sys.argv[0]), "--shard", str(i), "--shards", str(workers)],
+                dict(env, OUTBOX_DB_PATH=self.db_paths[i], CONTROL_SOCKET=self.control_paths[i]),
+            )
+            for i in range(workers)
+        ]
+
+        relay_args = [sys.executable, "-m", "services.outbox_relay", "--workers", str(relay_workers)]
+        for path in self.db_paths:
+            relay_args += ["--db", path]
+        self.children.append(_Child("outbox-relay", relay_args, env))
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def _run(self):
+        for path in self.db_paths:
+            with outbox.database(path):
+                outbox.init_db()
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=self.metrics_dir)
+        registry.register(OutboxCollector(outbox, self.db_paths))
+        start_http_server(self.metrics_port, registry=registry)
+
+        for child in self.children:
+            child.spawn()
+
+        control = ControlServer({'reload' : self._forward})
+        control.start()
+
+        try:
+            while not self.shutdown_event.wait(1.0):
+                self._check_children()
+        finally:
+            control.stop()
+            self._stop_children()
+
+    def _forward(self, message : dict) -> dict:
+        """Sends a control request to every worker, each one applies its own shard of it."""
+        answers = {}
+        for child, path in zip(self.children, self.control_paths):
+            try:
+                answers[child.name] = request(message, path)
+            except OSError as e:
+                answers[child.name] = {'status' : 'error', 'error' : str(e)}
+
+        failed = [name for name, answer in answers.items() if answer.get('status') != 'ok']
+        if failed:
+            raise RuntimeError(f"Request failed on {failed}: {answers}")
+
+        return {'workers' : answers}
+
+    def _check_children(self):
+        now = time.monotonic()
+
+        for child in self.children:
+            if child.process is None:
+                if now >= child.restart_at:
+                    child.spawn()
+                continue
+
+            code = child.process.poll()
+            if code is None:
+                continue
+
+            multiprocess.mark_process_dead(child.process.pid, self.metrics_dir)
+
+            # a child that ran for a while is restarted right away, one that
+            # keeps crashing waits twice as long each time
+            if now - child.started_at > self.max_restart_delay:
+                child.restart_delay = 0.0
+            else:
+                child.restart_delay = min(max(child.restart_delay * 2, 1.0), self.max_restart_delay)
+
+            print(f"[supervisor] {child.name} (pid {child.process.pid}) exited with code {code}, restarting in {child.restart_delay:.0f}s")
+            child.process = None
+            child.restart_at = now + child.restart_delay
+
+    def _stop_children(self):
+        running = [child.process for child in self.children if child.process is not None and child.process.poll() is None]
+
+        for process in running:
+            process.send_signal(signal.SIGTERM)
+
+        deadline = time.monotonic() + 30
+        for process in running:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                print(f"[supervisor] pid {process.pid} didn't stop in time, killing it")
+                process.kill()
+                process.wait()
+
+            multiprocess.mark_process_dead(process.pid, self.metrics_dir)
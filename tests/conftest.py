@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import outbox
+
+
+@pytest.fixture
+def outbox_db(tmp_path, monkeypatch):
+    """Points every thread's outbox at a fresh database file."""
+    path = str(tmp_path / "outbox.db")
+    monkeypatch.setattr(outbox, "DB_PATH", path)
+    outbox.init_db()
+    yield path
+    outbox.close()
@@ -0,0 +1,56 @@
+from models.equipment import Equipment
+from services.rule_compiler import LazyInterpreter, compile_rule
+
+
+def make_config(expressions, tags=("Voltagem", "PecasBoas", "PecasRejeitadas")):
+    """One equipment's config with a rule per expression, named Rule0, Rule1..."""
+    return {
+        'ip': "127.0.0.1",
+        'code': "T01",
+        'metadata': {'plant': "Blumenau"},
+        'tags': [{'name': tag, 'type': "float", 'plc_address': tag.lower()} for tag in tags],
+        'event_rules': [
+            {'name': f"Rule{i}", 'expression': expression, 'routing_key': f"key{i}", 'output': None}
+            for i, expression in enumerate(expressions)
+        ],
+    }
+
+
+def make_equipments(count, expressions, **kwargs):
+    config = make_config(expressions, **kwargs)
+    interpreter = LazyInterpreter()
+    compiled_rules = {expression: compile_rule(expression, interpreter) for expression in expressions}
+
+    return [Equipment(name=f"EQ{i}", ip=config['ip'], code=f"T{i}", config=config, compiled_rules=compiled_rules) for i in range(count)]
+
+
+def make_events(count, name="MachineWorking"):
+    """Events shaped like those EventGenerator creates."""
+    return [
+        {
+            'event_name': name,
+            'routing_key': "machine_status",
+            'created_at': 1700000000 + i,
+            'content_type': "application/json",
+            'body': f'{{"event_name":"{name}","n":{i}}}'.encode(),
+        }
+        for i in range(count)
+    ]
+
+
+class RecordingPublisher():
+    """Keeps every batch it's asked to send, failing them while ``error`` is set."""
+
+    send_timeout = 1.0
+
+    def __init__(self):
+        self.batches = []
+        self.error = None
+
+    def send_event(self, events):
+        if self.error:
+            raise self.error
+        self.batches.append(list(events))
+
+    def close(self):
+        pass
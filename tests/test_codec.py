@@ -0,0 +1,31 @@
+import sys
+
+import pytest
+
+from utils.codec import PayloadTemplate, get_codec
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgpack"])
+def test_payloads_decode_to_the_event(name):
+    pytest.importorskip(name)
+    codec = get_codec(name)
+    template = PayloadTemplate(codec, {'plant': "Blumenau", 'line': 1})
+
+    assert codec.decode(template.encode("MachineWorking", 1700000000)) == {
+        'event_name': "MachineWorking", 'timestamp': 1700000000, 'metadata': {'plant': "Blumenau", 'line': 1},
+    }
+    assert codec.decode(template.encode("PecasBoas", 1700000001, {'PecasBoas': 3}))['data'] == {'PecasBoas': 3}
+
+
+@pytest.mark.parametrize("name", ["orjson", "msgpack"])
+def test_missing_package_is_named(name, monkeypatch):
+    monkeypatch.setitem(sys.modules, name, None)
+
+    with pytest.raises(ImportError, match=f"pip install {name}"):
+        get_codec(name)
+
+
+def test_auto_falls_back_to_json(monkeypatch):
+    monkeypatch.setitem(sys.modules, "orjson", None)
+
+    assert get_codec("auto").name == "json"
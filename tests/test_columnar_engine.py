@@ -0,0 +1,86 @@
+import itertools
+from threading import Event
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from services.columnar_engine import ColumnarEngine
+from services.event_generator import EventGenerator
+
+from helpers import make_equipments
+
+VALUES = [
+    {'Voltagem': voltage, 'PecasBoas': good, 'PecasRejeitadas': bad}
+    for voltage, good, bad in itertools.product((0.0, 12.0, 25.0), (0, 5, 10), (0, 1, 3))
+]
+
+
+def evaluate(expressions, cycles):
+    """Per cycle, the number of events and every equipment's rule states, scalar and columnar."""
+    results = []
+    for columnar in (False, True):
+        equipments = make_equipments(len(VALUES), expressions)
+        engine = ColumnarEngine(equipments) if columnar else None
+        generator = EventGenerator(sender=None, shutdown_event=Event(), engine=engine, verbose=False)
+
+        outcome = []
+        for values in cycles:
+            for equipment, readings in zip(equipments, values):
+                equipment.update_values(readings)
+            events = generator.evaluate(equipments)
+            outcome.append((len(events), [[bool(rule['state']) for rule in equipment.rules] for equipment in equipments]))
+        results.append(outcome)
+
+    return results
+
+
+@pytest.mark.parametrize("expression", [
+    "PecasBoas == 0 or PecasRejeitadas / PecasBoas > 0.1",
+    "PecasBoas > 0 and PecasRejeitadas / PecasBoas > 0.1",
+    "PecasBoas != 0 and PecasRejeitadas // PecasBoas >= 1 or Voltagem > 22.0",
+    "not (PecasBoas != 0 and PecasRejeitadas % PecasBoas == 1)",
+    "0 < PecasBoas < PecasRejeitadas / PecasBoas + 5",
+    "PecasRejeitadas / PecasBoas > 0.1 or Voltagem > 22.0",
+    "Voltagem / PecasBoas > 1 and PecasBoas < 10",
+])
+def test_guarded_divisions_agree(expression):
+    scalar, columnar = evaluate([expression, "Voltagem > 22.0"], [VALUES, list(reversed(VALUES))])
+
+    assert scalar == columnar
+    # some rows are true and some false, or the comparison proves little
+    states = [states[0] for states in scalar[0][1]]
+    assert any(states) and not all(states)
+
+
+def test_rows_stay_false_until_read():
+    equipments = make_equipments(2, ["PecasBoas == 0 or Voltagem > 1"])
+    generator = EventGenerator(sender=None, shutdown_event=Event(), engine=ColumnarEngine(equipments), verbose=False)
+
+    equipments[0].update_values({'Voltagem': 5.0, 'PecasBoas': 1, 'PecasRejeitadas': 0})
+
+    assert [event['event_name'] for event in generator.evaluate(equipments)] == ["Rule0"]
+    assert equipments[0].rules[0]['state'] and not equipments[1].rules[0]['state']
+
+
+def partially_read(step):
+    """Per equipment, a subset of its tags' values: every subset appears, first tag read or not."""
+    subsets = [subset for size in range(4) for subset in itertools.combinations(("Voltagem", "PecasBoas", "PecasRejeitadas"), size)]
+    return [
+        {tag: value for tag, value in values.items() if tag in subsets[(i + step) % len(subsets)]}
+        for i, values in enumerate(VALUES)
+    ]
+
+
+@pytest.mark.parametrize("expression", [
+    "PecasBoas == 0 or Voltagem > 1",
+    "Voltagem > 1 or PecasBoas != 5",
+    "not PecasRejeitadas > 1",
+    "PecasBoas != 0 and PecasRejeitadas / PecasBoas > 0.1",
+    "Voltagem != 12.0",
+])
+def test_partially_read_equipments_agree(expression):
+    scalar, columnar = evaluate([expression], [partially_read(0), partially_read(3), VALUES])
+
+    assert scalar == columnar
+    assert any(states[0] for states in scalar[0][1])
@@ -0,0 +1,106 @@
+import copy
+from threading import Event
+
+import pytest
+
+from services import config_loader
+from services.config_loader import ConfigLoader
+from services.event_generator import EventGenerator
+
+from helpers import make_config
+
+@pytest.fixture(autouse=True)
+def rule_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_loader, "RULE_CACHE_DIR", str(tmp_path / "rules"))
+
+
+READINGS = {'Voltagem': 25.0, 'PecasBoas': 3, 'PecasRejeitadas': 1}
+
+
+def running(config):
+    """Equipments built from ``config`` after one evaluation of READINGS."""
+    loader = ConfigLoader()
+    equipments = loader.build(config)
+    generator = EventGenerator(sender=None, shutdown_event=Event(), verbose=False)
+    for equipment in equipments:
+        equipment.update_values(READINGS)
+    generator.evaluate(equipments)
+    return loader, generator, equipments
+
+
+def plant(*expressions):
+    return {'EQ0': make_config(expressions), 'EQ1': make_config(expressions)}
+
+
+def states(equipment):
+    return {rule['name']: rule['state'] for rule in equipment.rules}
+
+
+def test_unchanged_rules_keep_their_state():
+    config = plant("Voltagem > 22.0", "PecasBoas > 0 and PecasRejeitadas > 0")
+    loader, generator, equipments = running(config)
+    eq0 = equipments[0]
+    assert states(eq0) == {'Rule0': True, 'Rule1': True}
+
+    new = copy.deepcopy(config)
+    new['EQ0']['event_rules'][0]['routing_key'] = "status"
+    new['EQ0']['event_rules'][1]['expression'] = "PecasBoas > 5 or PecasRejeitadas > 0"
+    with generator.paused():
+        added, removed, updated = loader.reload(new, equipments)
+
+    assert (added, removed, updated) == ([], [], [eq0])
+    assert equipments[0] is eq0
+    # kept rule: same state, new routing key. Changed rule: starts false
+    assert states(eq0) == {'Rule0': True, 'Rule1': False}
+    assert eq0.rules[0]['routing_key'] == "status"
+
+    # the changed rule runs on the next cycle without a new reading, the kept one doesn't fire again
+    events = generator.evaluate(equipments)
+    assert [event['event_name'] for event in events] == ["Rule1"]
+
+
+def test_equipments_are_added_and_removed():
+    config = plant("Voltagem > 22.0")
+    loader, generator, equipments = running(config)
+    eq0 = equipments[0]
+
+    new = {'EQ0': config['EQ0'], 'EQ2': make_config(["Voltagem > 22.0"])}
+    added, removed, updated = loader.reload(new, equipments)
+
+    assert [equipment.name for equipment in added] == ["EQ2"]
+    assert [equipment.name for equipment in removed] == ["EQ1"]
+    assert updated == []
+    assert [equipment.name for equipment in equipments] == ["EQ0", "EQ2"]
+    assert equipments[0] is eq0 and states(eq0) == {'Rule0': True}
+
+
+def test_removed_tags_are_forgotten_and_windows_kept():
+    config = plant("avg(Voltagem, 30) > 20", "PecasBoas > 0")
+    loader, generator, equipments = running(config)
+    eq0 = equipments[0]
+    window = eq0.windows.windows[('Voltagem', 30)]
+
+    new = copy.deepcopy(config)
+    new['EQ0']['tags'] = [tag for tag in new['EQ0']['tags'] if tag['name'] != "PecasRejeitadas"]
+    new['EQ0']['event_rules'] = new['EQ0']['event_rules'][:1]
+    loader.reload(new, equipments)
+
+    assert 'PecasRejeitadas' not in eq0.symtable
+    assert eq0.windows.windows[('Voltagem', 30)] is window
+    assert eq0.timed_rules == eq0.rules
+
+
+def test_a_bad_config_changes_nothing():
+    config = plant("Voltagem > 22.0")
+    loader, generator, equipments = running(config)
+    before = [(equipment, list(equipment.rules), equipment.config) for equipment in equipments]
+
+    new = copy.deepcopy(config)
+    new['EQ0']['event_rules'].append({'name': "Other", 'expression': "PecasBoas > 1", 'routing_key': "", 'output': None})
+    # EQ1 is checked after EQ0, which must not have been touched when it fails
+    del new['EQ1']['metadata']
+    with pytest.raises(KeyError):
+        loader.reload(new, equipments)
+
+    assert [(equipment, list(equipment.rules), equipment.config) for equipment in equipments] == before
+    assert states(equipments[0]) == {'Rule0': True}
@@ -0,0 +1,84 @@
+import pytest
+
+from services import outbox
+from services.event_dispatcher import EventDispatcher
+
+from helpers import RecordingPublisher, make_events
+
+
+def statuses():
+    with outbox._conn() as conn:
+        return dict(conn.execute("SELECT id, status || ':' || COALESCE(lease_owner, '') FROM outbox_events").fetchall())
+
+
+def stored(dispatcher, events, lease_seconds):
+    for event, event_id in zip(events, outbox.store_events(events, lease_owner=dispatcher.owner, lease_seconds=lease_seconds)):
+        event['id'] = event_id
+    return events
+
+
+def test_lease_must_outlast_the_send():
+    publisher = RecordingPublisher()
+    publisher.send_timeout = 35.0
+
+    with pytest.raises(ValueError):
+        EventDispatcher(publisher, workers=0, lease_seconds=30)
+
+    EventDispatcher(publisher, workers=0, lease_seconds=60)
+
+
+def test_published_batch_is_marked_published(outbox_db):
+    publisher = RecordingPublisher()
+    dispatcher = EventDispatcher(publisher, workers=1)
+
+    events = stored(dispatcher, make_events(3), lease_seconds=dispatcher.lease_seconds)
+    dispatcher.submit(events)
+    dispatcher.shutdown()
+
+    assert [len(batch) for batch in publisher.batches] == [3]
+    assert set(statuses().values()) == {"published:"}
+
+
+def test_rows_the_relay_claimed_are_not_sent(outbox_db):
+    publisher = RecordingPublisher()
+    dispatcher = EventDispatcher(publisher, workers=1)
+
+    # the batch waited past its lease in the queue, the relay took two rows over
+    events = stored(dispatcher, make_events(3), lease_seconds=-1)
+    claimed = outbox.claim_batch("relay-0", limit=2)
+    dispatcher.submit(events)
+    dispatcher.shutdown()
+
+    assert [[event['id'] for event in batch] for batch in publisher.batches] == [[events[2]['id']]]
+    rows = statuses()
+    assert [rows[event['id']] for event in claimed] == ["in_flight:relay-0"] * 2
+    assert rows[events[2]['id']] == "published:"
+
+
+def test_expired_but_unclaimed_lease_is_renewed(outbox_db):
+    publisher = RecordingPublisher()
+    dispatcher = EventDispatcher(publisher, workers=1)
+
+    events = stored(dispatcher, make_events(2), lease_seconds=-1)
+    assert outbox.renew_leases([event['id'] for event in events], dispatcher.owner, 60) == [event['id'] for event in events]
+    # renewed, so the relay can't claim them
+    assert outbox.claim_batch("relay-0") == []
+
+    dispatcher.submit(events)
+    dispatcher.shutdown()
+
+    assert [len(batch) for batch in publisher.batches] == [2]
+
+
+def test_failed_send_is_handed_to_the_relay(outbox_db):
+    publisher = RecordingPublisher()
+    publisher.error = ConnectionError("broker down")
+    dispatcher = EventDispatcher(publisher, workers=1)
+
+    events = stored(dispatcher, make_events(2), lease_seconds=dispatcher.lease_seconds)
+    dispatcher.submit(events)
+    dispatcher.shutdown()
+
+    claimed = outbox.claim_batch("relay-0")
+    assert [event['id'] for event in claimed] == [event['id'] for event in events]
+    assert [event['attempts'] for event in claimed] == [1, 1]
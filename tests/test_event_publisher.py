@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+import pytest
+from prometheus_client import REGISTRY
+
+from services.event_publisher import LoopbackTransport, PublishError, RabbitMQEventPublisher
+
+from helpers import make_events
+
+
+def publisher(transport, **kwargs):
+    kwargs.setdefault('confirm_timeout', 2.0)
+    kwargs.setdefault('reconnect_delay', 0.01)
+    return RabbitMQEventPublisher(transport=transport, **kwargs)
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def late_confirms():
+    return REGISTRY.get_sample_value('outbox_duplicate_publishes_total', {'path': 'late_confirm'}) or 0.0
+
+
+def test_acked_events_are_sent():
+    transport = LoopbackTransport()
+    sender = publisher(transport, batch_size=2)
+    events = make_events(5)
+
+    sender.send_event(events)
+    sender.close()
+
+    assert [body for _, body, _ in transport.acked] == [event['body'] for event in events]
+    assert {routing_key for routing_key, _, _ in transport.acked} == {"machine_status"}
+
+
+def test_nacked_events_fail():
+    sender = publisher(LoopbackTransport(confirm='nack'))
+
+    with pytest.raises(PublishError, match="rejected"):
+        sender.send_event(make_events(2))
+    sender.close()
+
+
+def test_unconfirmed_events_are_sent_again_after_a_reconnect():
+    transport = LoopbackTransport(confirm=None, refused=1)
+    sender = publisher(transport)
+    events = make_events(3)
+
+    sending = threading.Thread(target=sender.send_event, args=(events,))
+    sending.start()
+    wait_until(lambda: len(transport.published) == 3)
+
+    transport.confirm = 'ack'
+    transport.drop()
+    sending.join()
+    sender.close()
+
+    # one refused attempt, the connection dropped, the one that confirmed
+    assert transport.connections == 3
+    assert len(transport.published) == 6
+    assert [body for _, body, _ in transport.acked] == [event['body'] for event in events]
+
+
+def test_confirm_timeout_abandons_the_events():
+    transport = LoopbackTransport(confirm=None)
+    sender = publisher(transport, confirm_timeout=0.1)
+    before = late_confirms()
+
+    with pytest.raises(TimeoutError):
+        sender.send_event(make_events(2))
+
+    # the broker confirms after the caller gave up, the events went to someone else
+    transport.confirm_held()
+    wait_until(lambda: len(transport.acked) == 2)
+    wait_until(lambda: late_confirms() == before + 2)
+    sender.close()
+
+
+def test_events_queued_when_the_caller_gives_up_are_never_sent():
+    transport = LoopbackTransport(refused=1)
+    sender = publisher(transport, max_queue_size=1, enqueue_timeout=0.05, reconnect_delay=0.2)
+
+    # not connected yet: the first event fills the queue, the second can't be queued
+    with pytest.raises(PublishError, match="still full"):
+        sender.publish(make_events(2))
+
+    # the abandoned event leaves the queue once the I/O thread reconnects and skips it
+    sender.enqueue_timeout = 1.0
+    sender.send_event(make_events(1, name="Later"))
+    sender.close()
+
+    assert [body for _, body, _ in transport.published] == [make_events(1, name="Later")[0]['body']]
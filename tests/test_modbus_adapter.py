@@ -0,0 +1,137 @@
+import importlib.util
+import struct
+import time
+from threading import Event, Lock
+from types import SimpleNamespace
+
+import pytest
+
+from services.data_reader import ModbusAdapter, ModbusBlock, plan_modbus_reads
+
+from helpers import make_equipments
+
+
+def test_missing_pymodbus_is_named(monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name, *args: None if name == "pymodbus" else find_spec(name, *args))
+
+    with pytest.raises(ImportError, match="pymodbus"):
+        ModbusAdapter([])
+
+
+def modbus_equipment(name, port):
+    equipment, = make_equipments(1, ["Voltagem > 1"])
+    equipment.name = name
+    equipment.config = dict(equipment.config, modbus={
+        'port': port,
+        'registers': [{'plc_address': "voltagem", 'address': 0, 'type': "float32"}],
+    })
+    return equipment
+
+
+class FakeConnection():
+    def __init__(self, port, answered):
+        self.host = "127.0.0.1"
+        self.port = port
+        self.answered = answered
+        self.lock = Lock()
+        self.failing = False
+
+    def read(self, block, unit):
+        self.answered.wait()
+        return list(struct.unpack(">HH", struct.pack(">f", 230.0)))
+
+    def close(self):
+        pass
+
+
+def test_scan_doesnt_wait_for_a_slow_plc(monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name, *args: object() if name == "pymodbus" else find_spec(name, *args))
+
+    fast, slow = modbus_equipment("Fast", 502), modbus_equipment("Slow", 503)
+    adapter = ModbusAdapter([fast, slow], scan_timeout=0.1)
+    answered = Event()
+    adapter._connections = {("127.0.0.1", 502): FakeConnection(502, Event()), ("127.0.0.1", 503): FakeConnection(503, answered)}
+    adapter._connections[("127.0.0.1", 502)].answered.set()
+    adapter.connect()
+
+    try:
+        started = time.monotonic()
+        assert adapter.scan([(fast, None), (slow, None)]) == [(fast, {'Voltagem': 230.0})]
+        assert time.monotonic() - started < 1.0
+
+        # the slow PLC's read is still running, it isn't queued again
+        assert adapter.scan([(fast, None), (slow, None)]) == [(fast, {'Voltagem': 230.0})]
+
+        answered.set()
+        adapter._late[("127.0.0.1", 503)].result()
+        assert adapter.scan([(fast, None), (slow, None)]) == [(fast, {'Voltagem': 230.0}), (slow, {'Voltagem': 230.0})]
+    finally:
+        answered.set()
+        adapter.close()
+
+
+def planned(registers, **layout):
+    tags = [{'name': register['plc_address'].title(), 'type': "float", 'plc_address': register['plc_address']} for register in registers]
+    equipment = SimpleNamespace(name="EQ0", tags=tags, config={'modbus': dict(layout, registers=registers)})
+    return plan_modbus_reads(equipment)
+
+
+def test_close_registers_are_read_together():
+    blocks = planned([
+        {'plc_address': "a", 'address': 0, 'type': "uint16"},
+        {'plc_address': "b", 'address': 4, 'type': "float32"},
+        {'plc_address': "c", 'address': 20, 'type': "int16"},
+        {'plc_address': "d", 'address': 3, 'type': "int16", 'table': "input"},
+    ], max_gap=8)
+
+    assert [(block.table, block.start, block.count, block.names) for block in blocks] == [
+        ('holding', 0, 6, ["A", "B"]),
+        ('holding', 20, 1, ["C"]),
+        ('input', 3, 1, ["D"]),
+    ]
+
+
+def test_reads_stay_within_max_registers():
+    registers = [{'plc_address': f"r{i}", 'address': 2 * i, 'type': "uint32"} for i in range(100)]
+
+    blocks = planned(registers)
+
+    assert [(block.start, block.count) for block in blocks] == [(0, 124), (124, 76)]
+    assert sum(len(block.names) for block in blocks) == 100
+
+
+def test_overlapping_registers_are_refused():
+    with pytest.raises(ValueError, match="overlaps"):
+        planned([{'plc_address': "a", 'address': 0, 'type': "float32"}, {'plc_address': "b", 'address': 1, 'type': "uint16"}])
+
+
+def registers_of(values, byte_order='big', word_order='big'):
+    """The registers a PLC with this byte and word order holds for [(struct format, value)]."""
+    registers = []
+    for fmt, value in values:
+        data = struct.pack('>' + fmt, value)
+        words = [int.from_bytes(data[i:i + 2], byte_order) for i in range(0, len(data), 2)]
+        registers += words[::-1] if word_order == 'little' else words
+    return registers
+
+
+@pytest.mark.parametrize("byte_order", ["big", "little"])
+@pytest.mark.parametrize("word_order", ["big", "little"])
+def test_decode(byte_order, word_order):
+    fields = [(10, 'float32', "Voltagem"), (12, 'uint32', "PecasBoas"), (14, 'int16', "Delta"), (16, 'int32', "Saldo")]
+    block = ModbusBlock('holding', 10, fields, byte_order, word_order)
+    # the gap at 15 holds garbage
+    registers = registers_of([('f', 230.5), ('I', 4000000000), ('h', -12), ('H', 0xBEEF), ('i', -70000)], byte_order, word_order)
+
+    assert block.decode(registers) == {'Voltagem': 230.5, 'PecasBoas': 4000000000, 'Delta': -12, 'Saldo': -70000}
+
+
+def test_decode_casts_to_the_tag_type():
+    block = ModbusBlock('holding', 0, [(0, 'uint16', "PecasBoas"), (1, 'uint16', "Voltagem")], casters={'Voltagem': float})
+
+    values = block.decode([7, 220])
+
+    assert values == {'PecasBoas': 7, 'Voltagem': 220.0}
+    assert type(values['Voltagem']) is float
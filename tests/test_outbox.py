@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+
+from services import outbox
+
+from helpers import make_events
+
+
+def test_new_database_uses_incremental_vacuum(outbox_db):
+    with outbox._conn() as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_vacuum_converts_an_older_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    # the schema of the first release, without auto_vacuum
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("""
+        CREATE TABLE outbox_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_name TEXT NOT NULL,
+            payload_json TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            published_at INTEGER NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            next_retry_at INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.close()
+
+    monkeypatch.setattr(outbox, "DB_PATH", path)
+    try:
+        outbox.init_db()
+        with outbox._conn() as conn:
+            assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+        outbox.vacuum()
+
+        with outbox._conn() as conn:
+            assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        outbox.close()
+
+
+def rows():
+    with outbox._conn() as conn:
+        return {
+            row[0]: row[1:]
+            for row in conn.execute("SELECT id, status, lease_owner, attempts, next_retry_at FROM outbox_events")
+        }
+
+
+def expire(event_ids):
+    with outbox._conn() as conn:
+        conn.executemany("UPDATE outbox_events SET lease_expires_at = 0 WHERE id = ?", [(event_id,) for event_id in event_ids])
+
+
+def test_claimed_rows_belong_to_their_worker(outbox_db):
+    ids = outbox.store_events(make_events(5))
+
+    first = outbox.claim_batch("relay-0", limit=3)
+    second = outbox.claim_batch("relay-1", limit=10)
+
+    assert [event['id'] for event in first] == ids[:3]
+    assert [event['id'] for event in second] == ids[3:]
+    assert outbox.claim_batch("relay-2") == []
+    assert [rows()[event_id][:2] for event_id in ids] == [("in_flight", "relay-0")] * 3 + [("in_flight", "relay-1")] * 2
+
+
+def test_expired_lease_is_taken_over(outbox_db):
+    ids = outbox.store_events(make_events(2))
+    outbox.claim_batch("relay-0")
+
+    # relay-0 hung past its lease
+    expire(ids)
+    assert [event['id'] for event in outbox.claim_batch("relay-1")] == ids
+
+    # its late confirm marks nothing, relay-1's does
+    assert outbox.mark_published_many(ids, owner="relay-0") == 0
+    assert outbox.mark_published_many(ids, owner="relay-1") == 2
+    assert {row[0] for row in rows().values()} == {"published"}
+    assert outbox.claim_batch("relay-2") == []
+
+
+def test_failed_rows_back_off_then_fail_permanently(outbox_db):
+    event_id, = outbox.store_events(make_events(1))
+
+    for attempts in range(3):
+        event, = outbox.claim_batch("relay-0")
+        assert event['attempts'] == attempts
+        outbox.mark_failed_many([(event_id, "broker down", event['attempts'])], max_retries=3, base_delay=60)
+        status, owner, _, next_retry_at = rows()[event_id]
+        if attempts < 2:
+            assert (status, owner) == ("failed", None) and next_retry_at > time.time()
+            # not claimable until the backoff is over
+            assert outbox.claim_batch("relay-0") == []
+            with outbox._conn() as conn:
+                conn.execute("UPDATE outbox_events SET next_retry_at = 0")
+
+    assert rows()[event_id][:3] == ("permanently_failed", None, 3)
+    assert outbox.claim_batch("relay-0") == []
+    assert outbox.move_dead_letters() == 1
+    assert outbox.stats()['rows'] == {'dead_letter': 1}
+
+
+def test_released_rows_go_back_to_the_relay(outbox_db):
+    ids = outbox.store_events(make_events(3), lease_owner="dispatch", lease_seconds=60)
+    # leased, so invisible to the relay
+    assert outbox.claim_batch("relay-0") == []
+
+    outbox.release_events(ids[:1], "dispatch")
+    outbox.release_events(ids[1:2], "dispatch", error="nack")
+    # only the lease owner can release
+    outbox.release_events(ids[2:], "someone-else")
+
+    claimed = outbox.claim_batch("relay-0")
+    assert [(event['id'], event['attempts']) for event in claimed] == [(ids[0], 0), (ids[1], 1)]
+    assert rows()[ids[2]][:2] == ("in_flight", "dispatch")
+
+
+def test_concurrent_workers_never_claim_a_row_twice(outbox_db):
+    outbox.store_events(make_events(400))
+    claimed = []
+
+    def work(worker):
+        try:
+            while batch := outbox.claim_batch(f"relay-{worker}", limit=7):
+                claimed.extend(event['id'] for event in batch)
+        finally:
+            outbox.close()
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(rows())
+
+
+def test_drop_archives_only_drops_archive_tables(outbox_db):
+    with outbox._conn() as conn:
+        for table in ("outbox_archive_20200101", "outboxXarchive_20200101", "outbox_archive_29990101"):
+            conn.execute(f"CREATE TABLE {table} (id INTEGER)")
+
+    assert outbox.drop_archives(keep_days=1) == ["outbox_archive_20200101"]
+
+    with outbox._conn() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"outboxXarchive_20200101", "outbox_archive_29990101"} <= tables
@@ -0,0 +1,28 @@
+import sqlite3
+
+from services import outbox, outbox_relay
+from services.outbox_relay import OutboxRelay
+
+from helpers import RecordingPublisher, make_events
+
+
+def rows():
+    with outbox._conn() as conn:
+        return conn.execute("SELECT attempts, lease_owner FROM outbox_events").fetchall()
+
+
+def test_failed_confirm_leaves_the_batch_leased(outbox_db, monkeypatch):
+    outbox.store_events(make_events(3))
+    sender = RecordingPublisher()
+    relay = OutboxRelay(ttl_seconds=10**10, sender_factory=lambda: sender)
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(outbox_relay, "mark_published_many", locked)
+    assert relay.publish_outbox_events(sender, "relay-0") == 3
+
+    # sent once, not marked failed and retried on top of that
+    assert len(sender.batches) == 1
+    assert set(rows()) == {(0, "relay-0")}
+    assert outbox.claim_batch("relay-1") == []
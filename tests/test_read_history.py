@@ -0,0 +1,28 @@
+import gzip
+import json
+
+from services.data_reader import read_history
+
+
+def test_csv_is_detected_by_suffix(tmp_path):
+    path = tmp_path / "history.csv.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("equipment,tag,value,timestamp\nTorra,voltage,22.5,2024-01-01T00:00:00+00:00\n")
+
+    assert list(read_history(str(path))) == [(1704067200.0, "Torra", "voltage", "22.5")]
+
+
+def test_jsonl_in_a_directory_named_like_csv(tmp_path):
+    directory = tmp_path / ".csv_exports"
+    directory.mkdir()
+    path = directory / "run.jsonl"
+    path.write_text(
+        json.dumps({"timestamp": 10, "equipment": "Torra", "values": {"voltage": 22.5, "good_pieces": 3}}) + "\n\n"
+        + json.dumps({"timestamp": 11, "equipment": "Torra", "tag": "Voltagem", "value": 5.0}) + "\n"
+    )
+
+    assert list(read_history(str(path))) == [
+        (10.0, "Torra", "voltage", 22.5),
+        (10.0, "Torra", "good_pieces", 3),
+        (11.0, "Torra", "Voltagem", 5.0),
+    ]
@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from services import config_loader
+from services.config_loader import ConfigLoader
+
+from helpers import make_config
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "rules"
+    monkeypatch.setattr(config_loader, "RULE_CACHE_DIR", str(path))
+    return path
+
+
+def loader_for(tmp_path, name, *expressions):
+    path = tmp_path / f"{name}.json"
+    path.write_text(json.dumps({name: make_config(expressions)}))
+    return ConfigLoader(str(path))
+
+
+def entries(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+def test_cached_rules_are_reused(tmp_path, cache_dir):
+    loader_for(tmp_path, "EQ0", "Voltagem > 22.0").initialize()
+    cached = entries(cache_dir)
+
+    equipments, _ = loader_for(tmp_path, "EQ0", "Voltagem > 22.0").initialize()
+
+    assert entries(cache_dir) == cached
+    equipments[0].update_values({'Voltagem': 25.0})
+    assert equipments[0].rules[0]['expression'](equipments[0].symtable)
+
+
+def test_another_config_keeps_the_running_one_cached(tmp_path, cache_dir):
+    loader_for(tmp_path, "EQ0", "Voltagem > 22.0").initialize()
+    loader_for(tmp_path, "Bench", "Voltagem < 6.0").initialize()
+
+    assert len(entries(cache_dir)) == 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, cache_dir, monkeypatch):
+    monkeypatch.setattr(config_loader, "RULE_CACHE_ENTRIES", 2)
+
+    loader_for(tmp_path, "EQ0", "Voltagem > 0").initialize()
+    first = entries(cache_dir)
+    loader_for(tmp_path, "EQ1", "Voltagem > 1").initialize()
+    for name in entries(cache_dir):
+        os.utime(cache_dir / name, (1, 1))
+    # used again, so the newest
+    loader_for(tmp_path, "EQ0", "Voltagem > 0").initialize()
+    loader_for(tmp_path, "EQ2", "Voltagem > 2").initialize()
+
+    assert len(entries(cache_dir)) == 2
+    assert set(first) <= set(entries(cache_dir))
+
+
+def test_another_compiler_compiles_again(tmp_path, cache_dir, monkeypatch):
+    loader_for(tmp_path, "EQ0", "Voltagem > 22.0").initialize()
+    monkeypatch.setattr(config_loader, "CACHE_KEY", "changed")
+    loader_for(tmp_path, "EQ0", "Voltagem > 22.0").initialize()
+
+    assert len(entries(cache_dir)) == 2
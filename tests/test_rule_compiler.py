@@ -0,0 +1,29 @@
+from threading import Event
+
+from services.event_generator import EventGenerator
+from services.rule_compiler import LazyInterpreter, compile_rule
+
+from helpers import make_equipments
+
+
+def test_fallback_rules_leave_called_functions_out_of_their_tags():
+    rule = compile_rule("abs(Voltagem - PecasBoas) > max(PecasRejeitadas, 1)", LazyInterpreter())
+
+    assert not rule.native
+    assert rule.tags == {'Voltagem', 'PecasBoas', 'PecasRejeitadas'}
+
+
+def test_fallback_rules_run_when_their_tags_change():
+    equipment, = make_equipments(1, ["abs(Voltagem) > 5", "round(0.4) < 1"])
+    generator = EventGenerator(sender=None, shutdown_event=Event(), verbose=False)
+
+    equipment.update_values({'Voltagem': -10.0, 'PecasBoas': 0, 'PecasRejeitadas': 0})
+    # reading no tag, the second rule runs on the first cycle only
+    assert [event['event_name'] for event in generator.evaluate([equipment])] == ["Rule0", "Rule1"]
+
+    equipment.update_values({'Voltagem': 1.0})
+    assert generator.evaluate([equipment]) == []
+    assert not equipment.rules[0]['state']
+
+    equipment.update_values({'Voltagem': 6.0})
+    assert [event['event_name'] for event in generator.evaluate([equipment])] == ["Rule0"]
@@ -0,0 +1,27 @@
+from threading import Event
+
+from services.scan_scheduler import ScanScheduler
+
+from helpers import make_equipments
+
+
+class ReadingAdapter():
+    def scan(self, requests):
+        return [(equipment, {tag: 1 for tag in tags}) for equipment, tags in requests]
+
+
+def test_scans_go_on_after_an_error():
+    shutdown_event = Event()
+    calls = []
+
+    def on_scan(equipments):
+        calls.append(equipments)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        shutdown_event.set()
+
+    scheduler = ScanScheduler(make_equipments(1, ["Voltagem > 1"]), ReadingAdapter(), shutdown_event, on_scan=on_scan, default_rate=0.01)
+    scheduler.run()
+
+    assert len(calls) == 2
+    assert scheduler.scans == 2
@@ -0,0 +1,40 @@
+import math
+import random
+from threading import Event
+
+from services.event_generator import EventGenerator
+
+from helpers import make_equipments
+
+RULES = [
+    "Voltagem > 22.0", "Voltagem >= 22.0", "Voltagem < 6.0", "6.0 > Voltagem",
+    "Voltagem <= -5", "Voltagem > 10", "Voltagem >= 10", "30 < Voltagem",
+]
+
+
+def truth(expression, value):
+    try:
+        return bool(eval(expression, {}, {'Voltagem': value}))
+    except TypeError:
+        return False
+
+
+def test_index_matches_evaluating_every_rule():
+    equipment, = make_equipments(1, RULES)
+    generator = EventGenerator(sender=None, shutdown_event=Event(), verbose=False)
+    assert all(rule['expression'].threshold for rule in equipment.rules)
+
+    rng = random.Random(7)
+    values = [rng.choice([22.0, 6.0, 10, -5, 30]) for _ in range(50)] + [rng.uniform(-10, 40) for _ in range(200)]
+    values[60:60] = [math.nan, 25.0, "offline", 25.0, None, 3.0]
+
+    states = [False] * len(RULES)
+    for value in values:
+        equipment.update_values({'Voltagem': value, 'PecasBoas': 0, 'PecasRejeitadas': 0})
+        events = generator.evaluate([equipment])
+
+        expected = [truth(expression, value) for expression in RULES]
+        rising = [f"Rule{i}" for i, (was, now) in enumerate(zip(states, expected)) if now and not was]
+        assert [bool(rule['state']) for rule in equipment.rules] == expected, value
+        assert [event['event_name'] for event in events] == rising, value
+        states = expected
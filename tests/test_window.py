@@ -0,0 +1,59 @@
+import math
+
+from models.window import Window, Windows
+
+
+def test_average_and_extremes_over_the_window():
+    window = Window(10)
+    for second in range(20):
+        window.add(second, second)
+
+    # readings of 10..19 are in the window, 9 is the value it starts with
+    assert window.avg(19.5) == sum(range(10, 20)) / 10
+    assert window.max_over(19.5) == 19
+    assert window.min_over(19.5) == 9
+    assert window.delta(19.5) == 19 - 9
+
+
+def test_extremes_wait_for_a_covered_window():
+    window = Window(30)
+    window.add(0, 5.0)
+
+    assert math.isnan(window.max_over(29))
+    assert window.max_over(30) == 5.0
+
+
+def test_an_idle_tag_keeps_its_last_value():
+    window = Window(10)
+    window.add(0, 3.0)
+    window.add(1, 4.0)
+
+    # nothing received for longer than the window
+    assert window.avg(100) == 4.0
+    assert window.max_over(100) == window.min_over(100) == 4.0
+    assert window.delta(100) == 0.0
+
+
+def test_sustained_condition():
+    now = [0.0]
+    windows = Windows(clock=lambda: now[0])
+    windows.configure({('Voltagem', 30)})
+
+    for second in range(40):
+        now[0] = second
+        windows.add({'Voltagem': 5.0 if second >= 5 else 12.0})
+        # "Voltagem < 6.0 for 30 s", below 6.0 since t=5
+        assert (windows.max_over('Voltagem', 30) < 6.0) == (second >= 35), second
+
+
+def test_reconfigured_windows_keep_their_history():
+    windows = Windows(clock=lambda: 100.0)
+    windows.configure({('Voltagem', 30)})
+    windows.add({'Voltagem': 8.0, 'PecasBoas': 1})
+    window = windows.windows[('Voltagem', 30)]
+
+    windows.configure({('Voltagem', 30), ('PecasBoas', 60)})
+
+    assert windows.windows[('Voltagem', 30)] is window
+    assert windows.avg('Voltagem', 30) == 8.0
+    assert math.isnan(windows.avg('PecasBoas', 60))
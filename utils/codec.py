@@ -0,0 +1,113 @@
+import json
+import os
+
+class JsonCodec():
+
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode_map(self, fields) -> bytes:
+        """Builds a map out of already encoded (key, value) pairs."""
+        return b'{' + b','.join(key + b':' + value for key, value in fields) + b'}'
+
+class OrjsonCodec(JsonCodec):
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, obj) -> bytes:
+        return self._orjson.dumps(obj)
+
+    def decode(self, data):
+        return self._orjson.loads(data)
+
+class MsgpackCodec():
+
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, obj) -> bytes:
+        return self._msgpack.packb(obj)
+
+    def decode(self, data):
+        return self._msgpack.unpackb(data)
+
+    def encode_map(self, fields) -> bytes:
+        fields = list(fields)
+        size = len(fields)
+        header = bytes([0x80 | size]) if size < 16 else b'\xde' + size.to_bytes(2, 'big')
+        return header + b''.join(key + value for key, value in fields)
+
+_CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+def get_codec(name : str = None):
+    """Returns the codec named by ``name`` or the EVENT_CODEC env var.
+
+    "auto" (the default) picks orjson when it is installed and falls back to the
+    standard json module. Both produce JSON, so consumers are unaffected.
+    msgpack changes the wire format and must be asked for explicitly.
+    """
+    name = name or os.getenv("EVENT_CODEC", "auto")
+
+    if name == 'auto':
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return JsonCodec()
+
+    if name not in _CODECS:
+        raise ValueError(f"Unknown event codec '{name}', expected one of {['auto', *_CODECS]}")
+
+    try:
+        return _CODECS[name]()
+    except ImportError:
+        # orjson and msgpack are optional dependencies named like their codec
+        raise ImportError(f"The {name} event codec needs {name}, install it with 'pip install {name}'")
+
+class PayloadTemplate():
+    """Encodes an equipment's event payloads, reusing the bytes of the static parts.
+
+    The metadata and each rule's event_name are encoded once; only the timestamp
+    and the optional output data are encoded per event.
+    """
+
+    def __init__(self, codec, metadata : dict):
+        self.codec = codec
+        self._keys = {key : codec.encode(key) for key in ('event_name', 'timestamp', 'metadata', 'data')}
+        self._metadata = codec.encode(metadata)
+        self._names = {}
+
+    def encode(self, event_name : str, timestamp : int, data : dict = None) -> bytes:
+
+        name = self._names.get(event_name)
+        if name is None:
+            name = self._names[event_name] = self.codec.encode(event_name)
+
+        keys = self._keys
+        fields = [
+            (keys['event_name'], name),
+            (keys['timestamp'], self.codec.encode(timestamp)),
+            (keys['metadata'], self._metadata),
+        ]
+
+        if data is not None:
+            fields.append((keys['data'], self.codec.encode(data)))
+
+        return self.codec.encode_map(fields)
@@ -6,4 +6,14 @@ class Converter():
             case 'float':
                 return float(data)
             case 'integer':
-                return int(data)
\ No newline at end of file
+                return int(data)
+
+    def caster(type):
+
+        match type:
+            case 'float':
+                return float
+            case 'integer':
+                return int
+            case _:
+                return lambda data: Converter.cast(data, type)
@@ -0,0 +1,28 @@
+import time
+
+class StartupProfile():
+    """Wall time spent in each startup phase, from the first line of main.py.
+
+    ``mark(phase)`` closes the phase that started at the previous mark, so the
+    phases add up to the time to the first evaluation. The interpreter's own
+    start-up, before main.py runs, isn't included.
+    """
+
+    def __init__(self, started : float = None):
+        self.started = started if started is not None else time.perf_counter()
+        self._last = self.started
+        self.phases = []
+
+    def mark(self, phase : str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def total(self) -> float:
+        return self._last - self.started
+
+    def report(self) -> str:
+        width = max([len(phase) for phase, _ in self.phases] + [5])
+        lines = [f"{phase:<{width}}  {elapsed * 1000:9.1f} ms" for phase, elapsed in self.phases]
+        lines.append(f"{'total':<{width}}  {self.total() * 1000:9.1f} ms")
+        return "\n".join(lines)